@@ -6,6 +6,8 @@ from sqlalchemy import text
 from datetime import datetime
 from dependencies import get_db, get_engine, DbDep
 from dao.dao import UserDAO, OrderDAO, BalanceDAO, InstrumentDAO
+from services.engine import matching_engine
+from services.trade_execution import trade_executor
 from fastapi.responses import FileResponse
 from pathlib import Path
 
@@ -81,6 +83,17 @@ async def check_locks(engine: AsyncEngine = Depends(get_engine)):
         return {"locks": [dict(row) for row in result.mappings()]}
 
 
+# 7. Проведение сделок
+@health_router.get("/settlement")
+async def settlement_stats():
+    """Размеры пачек группового commit сделок, работа воркеров outbox и повторы после deadlock"""
+    if matching_engine.outbox:
+        return {"mode": "outbox", **matching_engine.outbox.stats(), **trade_executor.stats()}
+    if not matching_engine.settlement:
+        return {"mode": "direct", **trade_executor.stats()}
+    return {"mode": "group", **matching_engine.settlement.stats(), **trade_executor.stats()}
+
+
 @health_router.get("/tables")
 async def get_db(session: DbDep, limit=40):
     res = {}
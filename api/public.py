@@ -1,9 +1,11 @@
-from fastapi import APIRouter
+from fastapi import APIRouter, Query, Response
 from typing import List
+from datetime import datetime
 from dependencies import DbDep
-from schemas.request import NewUserRequest, TransactionRequest
-from schemas.response import UserResponse, InstrumentResponse, L2OrderBook, TransactionResponse
-from services.public import register_user, get_instruments_list, get_transactions_history, get_orderbook
+from misc.enums import ResolutionEnum
+from schemas.request import NewUserRequest, TransactionRequest, CandleRequest
+from schemas.response import UserResponse, InstrumentResponse, L2OrderBook, TransactionResponse, CandleResponse
+from services.public import register_user, get_instruments_list, get_transactions_page, get_orderbook, get_candles
 
 
 public_router = APIRouter(prefix="/api/v1/public", tags=['public'])
@@ -22,10 +24,41 @@ async def api_get_instruments(session: DbDep):
 
 
 @public_router.get("/orderbook/{ticker}", response_model=L2OrderBook)
-async def api_get_orderbook(session: DbDep, ticker: str, limit: int = 10):
+async def api_get_orderbook(ticker: str, limit: int = 10):
     return await get_orderbook(ticker=ticker, limit=limit)
 
 
 @public_router.get("/transactions/{ticker}", response_model=List[TransactionResponse])
-async def api_get_transaction_history(session:DbDep, ticker: str, limit: int = 10):
-    return await get_transactions_history(session, TransactionRequest(ticker=ticker), limit)
\ No newline at end of file
+async def api_get_transaction_history(
+    session: DbDep,
+    response: Response,
+    ticker: str,
+    limit: int = Query(10, ge=1, le=1000),
+    before: str | None = None,
+    after: str | None = None,
+    since: int | None = Query(None, ge=0)
+):
+    page = await get_transactions_page(session, TransactionRequest(ticker=ticker), limit, before, after, since)
+    # Курсоры соседних страниц: X-Cursor-Before - более старые сделки, X-Cursor-After - более новые
+    if page.before:
+        response.headers["X-Cursor-Before"] = page.before
+        response.headers["X-Cursor-After"] = page.after
+    # Номер ленты для следующего опроса с since; X-Tape-Reset - since старше ленты, отдана последняя страница
+    if page.seq is not None:
+        response.headers["X-Tape-Seq"] = str(page.seq)
+    if page.reset:
+        response.headers["X-Tape-Reset"] = "true"
+    return page.transactions
+
+
+@public_router.get("/candles/{ticker}", response_model=List[CandleResponse])
+async def api_get_candles(
+    session: DbDep,
+    ticker: str,
+    resolution: ResolutionEnum = ResolutionEnum.M1,
+    start: datetime | None = None,
+    end: datetime | None = None,
+    limit: int = Query(500, ge=1, le=1000)
+):
+    # Свечи в [start, end) по возрастанию времени; без start - последние limit свечей
+    return await get_candles(session, CandleRequest(ticker=ticker, resolution=resolution, start=start, end=end), limit)
@@ -7,6 +7,55 @@ class Settings(BaseSettings):
     DB_PASSWORD: str
     DB_NAME: str
 
+    # Реализация книги ордеров: "sorted" или "levels", и переопределения по тикерам
+    ENGINE_BOOK_TYPE: str = "sorted"
+    ENGINE_BOOK_TYPES: dict[str, str] = {}
+    # Сводить пересекающий лимитный ордер сразу в запросе, а не в фоновом цикле
+    ENGINE_INLINE_MATCHING: bool = False
+    # Максимальная задержка (сек) перед циклом сопоставления, чтобы собрать ордера в один батч
+    ENGINE_MAX_BATCH_DELAY: float = 0.005
+    # Сколько акторов книг одновременно проводят сделки (каждый держит соединение из пула)
+    ENGINE_MAX_CONCURRENT_SETTLEMENTS: int = 20
+    # Бинарный снапшот книг для быстрого старта (None - выключен), период записи и запас (сек)
+    # назад от отметки снапшота, с которым при старте перечитываются измененные ордера
+    ENGINE_SNAPSHOT_PATH: str | None = None
+    ENGINE_SNAPSHOT_INTERVAL: float = 30.0
+    ENGINE_SNAPSHOT_MARGIN: float = 60.0
+    # Журнал входов движка (None - выключен) и как часто сбрасывать его на диск с fsync (сек)
+    ENGINE_JOURNAL_PATH: str | None = None
+    ENGINE_JOURNAL_FLUSH_INTERVAL: float = 0.01
+    # Балансы и резервы в памяти движка (блокировка под ордер и проведение без БД)
+    # и период фоновой записи измененных балансов в БД (сек)
+    ENGINE_BALANCE_LEDGER: bool = False
+    ENGINE_BALANCE_LEDGER_FLUSH_INTERVAL: float = 0.05
+    # Сколько последних сделок на тикер держать в ленте движка для истории сделок (0 - выключена)
+    ENGINE_TRADE_TAPE_SIZE: int = 1000
+    # Проводить балансы пачки сделок одной блокировкой и одним UPDATE вместо запросов на каждую сделку
+    SETTLEMENT_NETTING: bool = False
+    # Сколько раз повторять проведение сделок, выбранное жертвой deadlock
+    SETTLEMENT_DEADLOCK_RETRIES: int = 3
+    # Как проводятся сделки: "direct" - транзакция на каждый цикл и рыночный ордер,
+    # "group" - групповой commit: копим до SETTLEMENT_MAX_DELAY сек или SETTLEMENT_MAX_EXECUTIONS сделок,
+    # "outbox" - сделки пишутся в settlement_outbox, проводят их SETTLEMENT_OUTBOX_WORKERS воркеров
+    SETTLEMENT_MODE: str = "direct"
+    SETTLEMENT_MAX_DELAY: float = 0.002
+    SETTLEMENT_MAX_EXECUTIONS: int = 500
+    # Воркеры outbox (каждый держит соединение), сколько записей берет один проход,
+    # период опроса без пробуждения (сек) и число попыток, после которого запись откладывается для разбора
+    SETTLEMENT_OUTBOX_WORKERS: int = 4
+    SETTLEMENT_OUTBOX_BATCH: int = 500
+    SETTLEMENT_OUTBOX_POLL_INTERVAL: float = 0.5
+    SETTLEMENT_OUTBOX_MAX_ATTEMPTS: int = 3
+    # Кэш аутентификации по API key: сколько живет найденный пользователь и ненайденный ключ (сек),
+    # и сколько ключей держать
+    AUTH_CACHE_TTL: float = 60.0
+    AUTH_CACHE_NEGATIVE_TTL: float = 5.0
+    AUTH_CACHE_SIZE: int = 100_000
+    # Кэш балансов для GET /balance без ENGINE_BALANCE_LEDGER: сколько живет запись (сек)
+    # и сколько пользователей держать (0 - выключен)
+    BALANCE_CACHE_TTL: float = 30.0
+    BALANCE_CACHE_SIZE: int = 100_000
+
     model_config = SettingsConfigDict(
         extra='ignore', 
         env_file=".env",
@@ -1,6 +1,8 @@
-from sqlalchemy import select
+from sqlalchemy import column, insert, inspect, select, update, values
 from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm.util import identity_key
+from sqlalchemy.orm.attributes import set_committed_value
 from pydantic import BaseModel
 from typing import Generic, TypeVar
 from dao.database import Base
@@ -19,6 +21,46 @@ class BaseDAO(Generic[T]):
         await session.flush() 
         return new_instance
     
+    @classmethod
+    async def add_many(cls, session: AsyncSession, rows: list[dict]):
+        """Вставляет строки одним INSERT (executemany, на asyncpg - многострочные VALUES пачками).
+        В отличие от `add`, объекты в сессию не попадают."""
+        if not rows:
+            return
+        await session.execute(insert(cls.model), rows)
+
+
+    @classmethod
+    async def update_many(cls, session: AsyncSession, rows: list[dict]):
+        """Записывает готовые значения в строки по первичному ключу одним UPDATE ... FROM (VALUES ...)
+        на Postgres (executemany на остальных БД). Загруженные в сессию объекты синхронизируются."""
+        if not rows:
+            return
+        table = cls.model.__table__
+        keys = [key.name for key in inspect(cls.model).primary_key]
+        names = list(rows[0])
+        if session.get_bind().dialect.name == "postgresql":
+            # По 1000 строк: число параметров одного запроса asyncpg ограничено 32767
+            for start in range(0, len(rows), 1000):
+                data = values(*[column(name, table.c[name].type) for name in names], name="data").data(
+                    [tuple(row[name] for name in names) for row in rows[start:start + 1000]])
+                stmt = (
+                    update(cls.model)
+                    .where(*[table.c[key] == data.c[key] for key in keys])
+                    .values({name: data.c[name] for name in names if name not in keys})
+                    .execution_options(synchronize_session=False))
+                await session.execute(stmt)
+        else:
+            await session.execute(update(cls.model), rows)
+
+        for row in rows:
+            instance = session.identity_map.get(identity_key(cls.model, tuple(row[key] for key in keys)))
+            if instance is not None:
+                for name in names:
+                    if name not in keys:
+                        set_committed_value(instance, name, row[name])
+
+
     @classmethod
     async def find_existed(cls, session: AsyncSession, filters: BaseModel):
         """Ищет даже удаленные записи у которых `visibility = DELETED`"""
@@ -1,9 +1,12 @@
+from datetime import datetime
+from typing import Iterable
 from uuid import UUID
-from sqlalchemy import select, update
+from sqlalchemy import case, delete, func, literal, select, tuple_, update
 from sqlalchemy.dialects.postgresql import insert
 from dao.base import BaseDAO
 from misc.enums import OrderEnum, StatusEnum
-from misc.db_models import User, Transaction, Balance, Instrument, Order
+from misc.db_models import User, Transaction, Balance, Instrument, Order, SettlementOutbox, Candle
+from misc.internal_classes import InternalOrder, TradeExecution
 from sqlalchemy.ext.asyncio import AsyncSession
 
 
@@ -11,6 +14,17 @@ class UserDAO(BaseDAO[User]):
     model = User
 
 
+    @classmethod
+    async def get_existing_ids(cls, session: AsyncSession, user_ids: list[UUID]) -> set[UUID]:
+        """Какие из `user_ids` еще есть в БД. Пачками по 10000 id."""
+        existing = set()
+        for start in range(0, len(user_ids), 10000):
+            existing.update((await session.execute(
+                select(cls.model.id).where(cls.model.id.in_(user_ids[start:start + 10000]))
+            )).scalars().all())
+        return existing
+
+
 class InstrumentDAO(BaseDAO[Instrument]):
     model = Instrument
     
@@ -40,6 +54,48 @@ class BalanceDAO(BaseDAO[Balance]):
             for balance in balances
         }
     
+    @classmethod
+    async def get_balances_with_lock(cls, session: AsyncSession, keys: list[tuple[UUID, str]]) -> list[Balance]:
+        """Лочит все строки (user_id, ticker) одним запросом, в порядке ключа, чтобы разные
+        транзакции брали блокировки в одном и том же порядке."""
+        if not keys:
+            return []
+        balances = (await session.execute(
+            select(Balance)
+            .where(tuple_(Balance.user_id, Balance.ticker).in_(keys))
+            .order_by(Balance.user_id, Balance.ticker)
+            .with_for_update()
+            # Строки могли быть прочитаны раньше без блокировки: берем значения, которые видим под ней
+            .execution_options(populate_existing=True)
+        )).scalars().all()
+        return balances
+
+
+    @classmethod
+    async def credit_many(cls, session: AsyncSession, rows: list[dict]):
+        """Зачисляет `amount` по (user_id, ticker) одним upsert, создавая недостающие строки."""
+        if not rows:
+            return
+        stmt = insert(cls.model).values(rows)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=["user_id", "ticker"],
+            set_={"amount": cls.model.amount + stmt.excluded.amount}
+        )
+        await session.execute(stmt)
+
+
+    @classmethod
+    async def store_many(cls, session: AsyncSession, rows: list[dict]):
+        """Записывает готовые amount и blocked_amount по (user_id, ticker) upsert-ом, пачками по 1000 строк."""
+        for start in range(0, len(rows), 1000):
+            stmt = insert(cls.model).values(rows[start:start + 1000])
+            stmt = stmt.on_conflict_do_update(
+                index_elements=["user_id", "ticker"],
+                set_={"amount": stmt.excluded.amount, "blocked_amount": stmt.excluded.blocked_amount}
+            )
+            await session.execute(stmt)
+
+    
     @classmethod
     async def get_balance_with_lock(cls, session: AsyncSession, user_id: UUID, ticker: str) -> Balance:
         balance = (await session.execute(
@@ -136,20 +192,45 @@ class OrderDAO(BaseDAO[Order]):
         ))    
         result = await session.execute(query)
         return result.scalars().all()
-    
+
 
     @classmethod
-    async def update_after_trade(cls, session: AsyncSession, order_id: UUID, new_filled: int, new_status: StatusEnum):
-        await session.execute(
-            update(Order)
-            .where(Order.id == order_id)
-            .values(
-                filled=new_filled,
-                status=new_status 
-            )
-        )
-        await session.flush()
+    async def get_order_fills(cls, session: AsyncSession, order_ids: list[UUID]) -> list[tuple[UUID, int, StatusEnum]]:
+        """Только (id, filled, status) ордеров `order_ids`, без загрузки ORM-объектов. Пачками по 10000 id."""
+        rows = []
+        for start in range(0, len(order_ids), 10000):
+            rows.extend((await session.execute(
+                select(cls.model.id, cls.model.filled, cls.model.status)
+                .where(cls.model.id.in_(order_ids[start:start + 10000]))
+            )).all())
+        return rows
+
+
+    @classmethod
+    async def get_limit_orders_changed_since(cls, session: AsyncSession, since: datetime) -> list[Order]:
+        query = (select(cls.model).where(
+            cls.model.order_type == OrderEnum.LIMIT,
+            cls.model.updated_at >= since
+        ))
+        result = await session.execute(query)
+        return result.scalars().all()
+
+
+    @classmethod
+    async def update_after_trades(cls, session: AsyncSession, orders: Iterable[InternalOrder]):
+        """Записывает итоговые filled и status ордеров одним UPDATE."""
+        await cls.update_many(session, [
+            {"id": order.id, "filled": order.filled, "status": order.status}
+            for order in orders
+        ])
+
 
+    @classmethod
+    async def get_order_states(cls, session: AsyncSession, order_ids: Iterable[UUID]) -> dict[UUID, tuple[int, StatusEnum]]:
+        """(filled, status) ордеров по id, без загрузки ORM-объектов."""
+        result = await session.execute(
+            select(cls.model.id, cls.model.filled, cls.model.status).where(cls.model.id.in_(list(order_ids))))
+        return {order_id: (filled or 0, status) for order_id, filled, status in result.all()}
 
 
     @classmethod
@@ -164,4 +245,184 @@ class OrderDAO(BaseDAO[Order]):
 
 
 class TransactionDAO(BaseDAO[Transaction]):
-    model = Transaction
\ No newline at end of file
+    model = Transaction
+
+    @classmethod
+    async def get_history(
+            cls,
+            session: AsyncSession,
+            ticker: str,
+            limit: int,
+            before: tuple[datetime, UUID] | None = None,
+            after: tuple[datetime, UUID] | None = None) -> list[Transaction]:
+        """Сделки по тикеру, новые первыми, постранично по ключу (timestamp, id): `before` - только
+        старше ключа, `after` - только новее. Любая страница - один проход по индексу
+        ix_transactions_ticker_timestamp от ключа, без OFFSET."""
+        key = tuple_(cls.model.timestamp, cls.model.id)
+        query = select(cls.model).where(cls.model.ticker == ticker)
+        if before:
+            query = query.where(key < cls._key(before))
+        if after:
+            query = query.where(key > cls._key(after))
+        if after and not before:
+            # Страница сразу за курсором: идем от него вперед и разворачиваем
+            result = await session.execute(
+                query.order_by(cls.model.timestamp.asc(), cls.model.id.asc()).limit(limit))
+            return result.scalars().all()[::-1]
+        result = await session.execute(
+            query.order_by(cls.model.timestamp.desc(), cls.model.id.desc()).limit(limit))
+        return result.scalars().all()
+
+
+    @classmethod
+    def _key(cls, key: tuple[datetime, UUID]):
+        return tuple_(literal(key[0], cls.model.timestamp.type), literal(key[1], cls.model.id.type))
+
+
+class CandleDAO(BaseDAO[Candle]):
+    model = Candle
+
+    @classmethod
+    async def merge_many(cls, session: AsyncSession, rows: list[dict]):
+        """Вливает свечи новых сделок в сохраненные upsert-ом, пачками по 1000 строк:
+        high и low расширяются, объем суммируется, open и close меняются, только если первая сделка
+        пачки раньше сохраненной первой, а последняя - позже сохраненной последней. Параллельные
+        транзакции коммитятся не в порядке времени сделок, и опоздавшая не перетирает close."""
+        for start in range(0, len(rows), 1000):
+            stmt = insert(cls.model).values(rows[start:start + 1000])
+            earlier = stmt.excluded.open_at < cls.model.open_at
+            later = stmt.excluded.close_at > cls.model.close_at
+            stmt = stmt.on_conflict_do_update(
+                index_elements=["ticker", "resolution", "start"],
+                set_={
+                    "high": case((stmt.excluded.high > cls.model.high, stmt.excluded.high), else_=cls.model.high),
+                    "low": case((stmt.excluded.low < cls.model.low, stmt.excluded.low), else_=cls.model.low),
+                    "open": case((earlier, stmt.excluded.open), else_=cls.model.open),
+                    "open_at": case((earlier, stmt.excluded.open_at), else_=cls.model.open_at),
+                    "close": case((later, stmt.excluded.close), else_=cls.model.close),
+                    "close_at": case((later, stmt.excluded.close_at), else_=cls.model.close_at),
+                    "volume": cls.model.volume + stmt.excluded.volume,
+                }
+            )
+            await session.execute(stmt)
+
+
+    @classmethod
+    async def get_range(
+            cls,
+            session: AsyncSession,
+            ticker: str,
+            resolution: int,
+            start: datetime | None = None,
+            end: datetime | None = None,
+            limit: int = 500) -> list[Candle]:
+        """Свечи по возрастанию времени начала в [start, end). Без `start` - последние `limit` до `end`.
+        Любой диапазон - один проход по первичному ключу (ticker, resolution, start)."""
+        query = select(cls.model).where(cls.model.ticker == ticker, cls.model.resolution == resolution)
+        if start:
+            query = query.where(cls.model.start >= start)
+        if end:
+            query = query.where(cls.model.start < end)
+        if start:
+            result = await session.execute(query.order_by(cls.model.start.asc()).limit(limit))
+            return result.scalars().all()
+        result = await session.execute(query.order_by(cls.model.start.desc()).limit(limit))
+        return result.scalars().all()[::-1]
+
+
+class SettlementOutboxDAO(BaseDAO[SettlementOutbox]):
+    model = SettlementOutbox
+
+    @classmethod
+    async def add_executions(cls, session: AsyncSession, executions: list[TradeExecution]) -> list[int]:
+        """Пишет сделки цикла одним INSERT, вместе с состоянием ордеров после цикла.
+        Возвращает id записей в порядке сделок."""
+        if not executions:
+            return []
+        result = await session.execute(insert(cls.model).returning(cls.model.id, sort_by_parameter_order=True), [
+            {
+                "ticker": execution.bid_order.ticker,
+                "buyer_id": execution.bid_order.user_id,
+                "seller_id": execution.ask_order.user_id,
+                "bid_order_id": execution.bid_order.id,
+                "ask_order_id": execution.ask_order.id,
+                "qty": execution.executed_qty,
+                "price": execution.execution_price,
+                "bid_change": execution.bid_order_change,
+                "bid_filled": execution.bid_order.filled,
+                "bid_status": execution.bid_order.status,
+                "ask_filled": execution.ask_order.filled,
+                "ask_status": execution.ask_order.status,
+            }
+            for execution in executions
+        ])
+        return list(result.scalars())
+
+
+    @classmethod
+    async def get_head(cls, session: AsyncSession, limit: int) -> list[tuple[int, UUID, UUID, int]]:
+        """Первые `limit` записей очереди без блокировки: (id, buyer_id, seller_id, attempts).
+        Видны и записи, которые сейчас проводит другой воркер."""
+        result = await session.execute(
+            select(cls.model.id, cls.model.buyer_id, cls.model.seller_id, cls.model.attempts)
+            .order_by(cls.model.id)
+            .limit(limit))
+        return result.all()
+
+
+    @classmethod
+    async def claim(cls, session: AsyncSession, ids: list[int]) -> list[SettlementOutbox]:
+        """Лочит записи, которые еще никто не взял. Занятые другими воркерами пропускаются."""
+        if not ids:
+            return []
+        result = await session.execute(
+            select(cls.model)
+            .where(cls.model.id.in_(ids))
+            .order_by(cls.model.id)
+            .with_for_update(skip_locked=True))
+        return result.scalars().all()
+
+
+    @classmethod
+    async def get_last_id(cls, session: AsyncSession) -> int:
+        result = await session.execute(select(func.max(cls.model.id)))
+        return result.scalar() or 0
+
+
+    @classmethod
+    async def get_until(cls, session: AsyncSession, last_id: int) -> list[SettlementOutbox]:
+        """Лочит и отдает по порядку записи с id не больше `last_id`."""
+        result = await session.execute(
+            select(cls.model)
+            .where(cls.model.id <= last_id)
+            .order_by(cls.model.id)
+            .with_for_update())
+        return result.scalars().all()
+
+
+    @classmethod
+    async def delete_by_ids(cls, session: AsyncSession, ids: list[int]):
+        if ids:
+            await session.execute(delete(cls.model).where(cls.model.id.in_(ids)))
+
+
+    @classmethod
+    async def record_failure(cls, session: AsyncSession, id: int, error: str):
+        await session.execute(
+            update(cls.model)
+            .where(cls.model.id == id)
+            .values(attempts=cls.model.attempts + 1, last_error=error[:1000]))
+
+
+    @classmethod
+    async def get_pending_orders(cls, session: AsyncSession) -> dict[UUID, tuple[int, StatusEnum]]:
+        """Итоговые (filled, status) ордеров по еще не проведенным сделкам."""
+        result = await session.execute(select(
+            cls.model.bid_order_id, cls.model.bid_filled, cls.model.bid_status,
+            cls.model.ask_order_id, cls.model.ask_filled, cls.model.ask_status))
+        orders: dict[UUID, tuple[int, StatusEnum]] = {}
+        for bid_id, bid_filled, bid_status, ask_id, ask_filled, ask_status in result.all():
+            for order_id, filled, status in ((bid_id, bid_filled, bid_status), (ask_id, ask_filled, ask_status)):
+                if order_id not in orders or orders[order_id][0] < filled:
+                    orders[order_id] = (filled, status)
+        return orders
\ No newline at end of file
@@ -1,5 +1,7 @@
-from sqlalchemy.orm import DeclarativeBase, class_mapper
-from sqlalchemy.ext.asyncio import AsyncAttrs, async_sessionmaker, create_async_engine
+from typing import Callable
+from sqlalchemy import event
+from sqlalchemy.orm import DeclarativeBase, Session, class_mapper
+from sqlalchemy.ext.asyncio import AsyncAttrs, AsyncSession, async_sessionmaker, create_async_engine
 from config import settings
 
 
@@ -27,3 +29,52 @@ class Base(AsyncAttrs, DeclarativeBase):
         """Возвращает словарь всех полей модели"""
         columns = class_mapper(self.__class__).columns
         return {column.key: getattr(self, column.key) for column in columns}
+
+
+
+# Действия, отложенные до конца транзакции сессии. Привязываются к самой внутренней открытой
+# транзакции (savepoint или корневой): при release savepoint-а переходят к внешней, при его откате
+# откатные действия выполняются сразу, а действия после commit выполняются только после commit корневой.
+TRANSACTION_ACTIONS = "transaction_actions"
+COMMITTED = "transaction_committed"
+
+
+def _actions(session: AsyncSession) -> tuple[list[Callable[[], None]], list[Callable[[], None]]]:
+    sync_session = session.sync_session
+    transaction = sync_session.get_nested_transaction() or sync_session.get_transaction()
+    if transaction is None:
+        raise RuntimeError("Transaction actions require an open transaction")
+    return sync_session.info.setdefault(TRANSACTION_ACTIONS, {}).setdefault(transaction, ([], []))
+
+
+def on_commit(session: AsyncSession, action: Callable[[], None]):
+    _actions(session)[0].append(action)
+
+
+def on_rollback(session: AsyncSession, action: Callable[[], None]):
+    _actions(session)[1].append(action)
+
+
+@event.listens_for(Session, "after_commit")
+def _after_commit(session: Session):
+    # Срабатывает и на release savepoint-а; сразу за ним та же транзакция закрывается (after_transaction_end)
+    session.info[COMMITTED] = True
+
+
+@event.listens_for(Session, "after_transaction_end")
+def _after_transaction_end(session: Session, transaction):
+    committed = session.info.pop(COMMITTED, False)
+    actions = session.info.get(TRANSACTION_ACTIONS, {}).pop(transaction, None)
+    if actions is None:
+        return
+    commit_actions, rollback_actions = actions
+    if not committed:
+        for action in reversed(rollback_actions):
+            action()
+    elif transaction.nested:
+        parent = session.info[TRANSACTION_ACTIONS].setdefault(transaction.parent, ([], []))
+        parent[0].extend(commit_actions)
+        parent[1].extend(rollback_actions)
+    else:
+        for action in commit_actions:
+            action()
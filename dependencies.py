@@ -5,14 +5,17 @@ from dao.database import async_session_maker, engine
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.security.utils import get_authorization_scheme_param
 from misc.db_models import User
-from dao.dao import UserDAO
 from misc.enums import RoleEnum
-from schemas.request import UserAPIRequest
+from services.auth import api_key_cache
 
 
 token = "token"
 
 async def get_db() -> AsyncGenerator[AsyncSession, None]:
+    """Сессия на запрос, одна на все зависимости запроса (FastAPI кэширует get_db в пределах запроса).
+    Соединение из пула сессия берет только на первом запросе к БД и отдает на commit или закрытии:
+    ответ из кэша или памяти движка слот пула не занимает. Эндпоинтам, которые вообще не ходят
+    в БД, DbDep не нужен."""
     async with async_session_maker() as session:
         yield session
 
@@ -50,7 +53,7 @@ async def get_current_user(
 ) -> User:
     """Зависимость для аутентификации по API key"""
     api_key = credentials.credentials
-    user = await UserDAO.find_one_or_none(session, filters=UserAPIRequest(api_key=api_key))
+    user = await api_key_cache.get(session, api_key)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
@@ -65,8 +68,8 @@ async def get_current_admin(
     session: AsyncSession = Depends(get_db)
 ) -> User:
     api_key = credentials.credentials
-    admin = await UserDAO.find_one_or_none(session, filters=UserAPIRequest(api_key=api_key, role=RoleEnum.ADMIN))
-    if not admin:
+    admin = await api_key_cache.get(session, api_key)
+    if not admin or admin.role != RoleEnum.ADMIN:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail=f"Admin with {api_key} not found.")
     await session.close()
     return admin
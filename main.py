@@ -9,6 +9,9 @@ import asyncio
 from dao.database import async_session_maker
 from services.engine import matching_engine
 from services.matching import run_matching_engine
+from services.snapshot import run_snapshotter, write_snapshot
+from services.trade_execution import trade_executor
+from config import settings
 from logging_config import setup_logging
 
 @asynccontextmanager
@@ -17,6 +20,13 @@ async def lifespan(app: FastAPI):
         await matching_engine.startup(session)
 
     task = asyncio.create_task(run_matching_engine(matching_engine, async_session_maker))
+    journal_task = asyncio.create_task(matching_engine.journal.run()) if matching_engine.journal else None
+    ledger = trade_executor.ledger
+    ledger_task = asyncio.create_task(ledger.run(async_session_maker)) if ledger else None
+    snapshot_task = None
+    if settings.ENGINE_SNAPSHOT_PATH:
+        snapshot_task = asyncio.create_task(run_snapshotter(
+            matching_engine, settings.ENGINE_SNAPSHOT_PATH, settings.ENGINE_SNAPSHOT_INTERVAL))
 
     yield
 
@@ -26,6 +36,32 @@ async def lifespan(app: FastAPI):
     except asyncio.CancelledError:
         pass
 
+    if snapshot_task:
+        snapshot_task.cancel()
+        try:
+            await snapshot_task
+        except asyncio.CancelledError:
+            pass
+        # Свежий снапшот при штатной остановке: после рестарта почти нечего досчитывать
+        await write_snapshot(matching_engine, settings.ENGINE_SNAPSHOT_PATH)
+
+    if ledger_task:
+        ledger_task.cancel()
+        try:
+            await ledger_task
+        except asyncio.CancelledError:
+            pass
+        # Все, что еще не ушло в БД
+        await ledger.flush(async_session_maker)
+
+    if journal_task:
+        journal_task.cancel()
+        try:
+            await journal_task
+        except asyncio.CancelledError:
+            pass
+        await matching_engine.journal.aclose()
+
 
 app = FastAPI(lifespan=lifespan)
 
@@ -0,0 +1,28 @@
+"""Order updated_at for snapshot reconciliation
+
+Revision ID: 4b7e2f9c1a03
+Revises: d5252cbdeb4b
+Create Date: 2026-10-18 12:04:31.512207
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '4b7e2f9c1a03'
+down_revision: Union[str, None] = 'd5252cbdeb4b'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('orders', sa.Column('updated_at', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=False))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_column('orders', 'updated_at')
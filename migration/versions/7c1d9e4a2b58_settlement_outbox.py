@@ -0,0 +1,48 @@
+"""Settlement outbox for matched executions
+
+Revision ID: 7c1d9e4a2b58
+Revises: 4b7e2f9c1a03
+Create Date: 2026-10-18 15:22:47.903114
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision: str = '7c1d9e4a2b58'
+down_revision: Union[str, None] = '4b7e2f9c1a03'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    status = postgresql.ENUM('NEW', 'EXECUTED', 'PARTIALLY_EXECUTED', 'CANCELLED', name='statusenum', create_type=False)
+    op.create_table('settlement_outbox',
+    sa.Column('id', sa.BigInteger(), autoincrement=True, nullable=False),
+    sa.Column('ticker', sa.String(length=10), nullable=False),
+    sa.Column('buyer_id', sa.UUID(), nullable=False),
+    sa.Column('seller_id', sa.UUID(), nullable=False),
+    sa.Column('bid_order_id', sa.UUID(), nullable=False),
+    sa.Column('ask_order_id', sa.UUID(), nullable=False),
+    sa.Column('qty', sa.Integer(), nullable=False),
+    sa.Column('price', sa.Integer(), nullable=False),
+    sa.Column('bid_change', sa.Integer(), nullable=True),
+    sa.Column('bid_filled', sa.Integer(), nullable=False),
+    sa.Column('bid_status', status, nullable=False),
+    sa.Column('ask_filled', sa.Integer(), nullable=False),
+    sa.Column('ask_status', status, nullable=False),
+    sa.Column('attempts', sa.Integer(), server_default=sa.text('0'), nullable=False),
+    sa.Column('last_error', sa.String(), nullable=True),
+    sa.Column('created_at', sa.DateTime(timezone=True), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_table('settlement_outbox')
@@ -0,0 +1,67 @@
+"""Indexes for engine and API hot queries
+
+Revision ID: 9e4f2a7b3c61
+Revises: 7c1d9e4a2b58
+Create Date: 2026-10-18 17:41:09.275530
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '9e4f2a7b3c61'
+down_revision: Union[str, None] = '7c1d9e4a2b58'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+# CONCURRENTLY не блокирует запись в таблицы на время построения, но не работает внутри транзакции.
+# Прерванное построение оставляет невалидный индекс: его надо удалить (downgrade) и запустить заново.
+# У каждого индекса - запрос, которому он нужен. Без индекса каждый из них - Seq Scan по всей таблице,
+# а orders и transactions растут без ограничения. Планы до и после на засеянных данных:
+# python -m tests.bench_indexes (EXPLAIN (ANALYZE, BUFFERS) тех же запросов, что строят DAO),
+# записанный прогон на PostgreSQL 16.2 - tests/bench_indexes_plans.txt: каждый индекс заменяет
+# Parallel Seq Scan (100-215 мс на 1M строк) на Index/Bitmap Index Scan (0.03-2 мс).
+INDEXES = [
+    # OrderDAO.get_open_orders: ticker = ? AND order_type = 'LIMIT' AND status IN (NEW, PARTIALLY_EXECUTED) -
+    # загрузка книги при старте, по запросу на инструмент. Условие индекса совпадает с условием запроса,
+    # поэтому планировщик может его применить. В индексе только открытые лимитные ордера, малая доля таблицы.
+    ('ix_orders_open_limit', 'orders', ['ticker'],
+     "order_type = 'LIMIT' AND status IN ('NEW', 'PARTIALLY_EXECUTED')"),
+    # GET /api/v1/order: OrderDAO.find_all(user_id = ?), и загрузка User.order при удалении пользователя
+    # (каскад ORM). Обоим нужен префикс user_id. timestamp в ключе держит ордера пользователя в порядке
+    # времени, чтобы список по времени шел из индекса без сортировки.
+    ('ix_orders_user_id_timestamp', 'orders', ['user_id', 'timestamp'], None),
+    # OrderDAO.get_limit_orders_changed_since: order_type = 'LIMIT' AND updated_at >= ? - досчет книг
+    # после снапшота или журнала. Диапазон по updated_at - короткий хвост индекса: ордера за последние секунды.
+    ('ix_orders_limit_updated_at', 'orders', ['updated_at'], "order_type = 'LIMIT'"),
+    # TransactionDAO.get_history: ticker = ? [AND (timestamp, id) < / > курсор] ORDER BY timestamp DESC, id DESC
+    # LIMIT n - история и ее страницы. Index Scan в порядке ключа читает ровно n строк, без Sort по всем
+    # сделкам тикера. Порядок колонок и направление совпадают с ORDER BY.
+    ('ix_transactions_ticker_timestamp', 'transactions', ['ticker', sa.text('timestamp DESC'), sa.text('id DESC')], None),
+    # Удаление пользователя: каскад ORM загружает User.buyer_transaction (buyer_id = ?)
+    # и User.seller_transaction (seller_id = ?). Условия разные, поэтому два индекса, а не один составной.
+    ('ix_transactions_buyer_id', 'transactions', ['buyer_id'], None),
+    ('ix_transactions_seller_id', 'transactions', ['seller_id'], None),
+]
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    with op.get_context().autocommit_block():
+        for name, table, columns, where in INDEXES:
+            op.create_index(
+                name, table, columns,
+                postgresql_where=sa.text(where) if where else None,
+                postgresql_concurrently=True,
+                if_not_exists=True)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    with op.get_context().autocommit_block():
+        for name, table, _, _ in reversed(INDEXES):
+            op.drop_index(name, table_name=table, postgresql_concurrently=True, if_exists=True)
@@ -0,0 +1,62 @@
+"""OHLCV candles rollup
+
+Revision ID: b3d8e1f4a2c7
+Revises: 9e4f2a7b3c61
+Create Date: 2026-10-18 19:05:32.614208
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'b3d8e1f4a2c7'
+down_revision: Union[str, None] = '9e4f2a7b3c61'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+# Разрешения свечей в секундах (services.candles.RESOLUTIONS)
+RESOLUTIONS = [1, 60, 300, 3600, 86400]
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table('candles',
+    sa.Column('ticker', sa.String(length=10), nullable=False),
+    sa.Column('resolution', sa.Integer(), nullable=False),
+    sa.Column('start', sa.DateTime(timezone=True), nullable=False),
+    sa.Column('open', sa.Integer(), nullable=False),
+    sa.Column('high', sa.Integer(), nullable=False),
+    sa.Column('low', sa.Integer(), nullable=False),
+    sa.Column('close', sa.Integer(), nullable=False),
+    sa.Column('volume', sa.BigInteger(), nullable=False),
+    sa.Column('open_at', sa.DateTime(timezone=True), nullable=False),
+    sa.Column('close_at', sa.DateTime(timezone=True), nullable=False),
+    sa.ForeignKeyConstraint(['ticker'], ['instruments.ticker'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('ticker', 'resolution', 'start')
+    )
+    # Свечи по уже накопленным сделкам, дальше их ведет проведение сделок
+    for resolution in RESOLUTIONS:
+        op.execute(f"""
+            INSERT INTO candles (ticker, resolution, start, open, high, low, close, volume, open_at, close_at)
+            SELECT ticker, {resolution},
+                   to_timestamp(floor(extract(epoch FROM timestamp) / {resolution}) * {resolution}) AS start,
+                   (array_agg(price ORDER BY timestamp, id))[1],
+                   max(price),
+                   min(price),
+                   (array_agg(price ORDER BY timestamp DESC, id DESC))[1],
+                   sum(amount),
+                   min(timestamp),
+                   max(timestamp)
+            FROM transactions
+            WHERE timestamp IS NOT NULL
+            GROUP BY ticker, start
+        """)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_table('candles')
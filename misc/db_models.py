@@ -1,5 +1,5 @@
 from datetime import datetime, timezone
-from sqlalchemy import UUID, DateTime, ForeignKey, Integer, text, String
+from sqlalchemy import UUID, BigInteger, DateTime, ForeignKey, Index, Integer, func, text, String
 from sqlalchemy.orm import Mapped, mapped_column, relationship, validates
 from dao.database import Base
 from misc.enums import RoleEnum, DirectionEnum, StatusEnum, OrderEnum, VisibilityEnum
@@ -96,9 +96,27 @@ class Instrument(Base):
         cascade="all, delete-orphan"
     )
 
+    # Свечей много: удаляет их внешний ключ в БД, без загрузки в сессию
+    candle: Mapped[list["Candle"]] = relationship(
+        "Candle",
+        back_populates="instrument",
+        cascade="all, delete-orphan",
+        passive_deletes=True
+    )
+
 
 class Order(Base):
     __tablename__ = "orders"
+    __table_args__ = (
+        # Загрузка книги при старте: только открытые лимитные ордера, их малая доля таблицы
+        Index(
+            "ix_orders_open_limit", "ticker",
+            postgresql_where=text("order_type = 'LIMIT' AND status IN ('NEW', 'PARTIALLY_EXECUTED')")),
+        # Список ордеров пользователя
+        Index("ix_orders_user_id_timestamp", "user_id", "timestamp"),
+        # Досчет книг после снапшота: лимитные ордера, измененные после отметки
+        Index("ix_orders_limit_updated_at", "updated_at", postgresql_where=text("order_type = 'LIMIT'")),
+    )
 
     id: Mapped[uuid.UUID] = mapped_column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4, unique=True)
     user_id: Mapped[uuid.UUID] = mapped_column(ForeignKey('users.id'))
@@ -116,6 +134,13 @@ class Order(Base):
     DateTime(timezone=True),
     default=lambda: datetime.now(timezone.utc)
     )
+    # Время последнего изменения: по нему при старте досчитываем книги после снапшота
+    updated_at: Mapped[datetime] = mapped_column(
+    DateTime(timezone=True),
+    default=lambda: datetime.now(timezone.utc),
+    onupdate=lambda: datetime.now(timezone.utc),
+    server_default=func.now()
+    )
 
     user: Mapped["User"] = relationship(
         "User",
@@ -130,6 +155,13 @@ class Order(Base):
 
 class Transaction(Base):
     __tablename__ = "transactions"
+    __table_args__ = (
+        # История сделок по тикеру, новые первыми
+        Index("ix_transactions_ticker_timestamp", "ticker", text("timestamp DESC"), text("id DESC")),
+        # Каскадное удаление пользователя ищет его сделки с обеих сторон
+        Index("ix_transactions_buyer_id", "buyer_id"),
+        Index("ix_transactions_seller_id", "seller_id"),
+    )
 
     id: Mapped[uuid.UUID] = mapped_column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4, unique=True)
     buyer_id: Mapped[uuid.UUID] = mapped_column(ForeignKey("users.id"))
@@ -157,4 +189,54 @@ class Transaction(Base):
     instrument: Mapped["Instrument"] = relationship(
         "Instrument",
         back_populates="transaction"
+    )
+
+
+class Candle(Base):
+    """OHLCV-свеча по сделкам тикера. Обновляется upsert-ом в той же транзакции, что пишет сделки."""
+    __tablename__ = "candles"
+
+    ticker: Mapped[str] = mapped_column(ForeignKey("instruments.ticker", ondelete="CASCADE"), primary_key=True)
+    resolution: Mapped[int] = mapped_column(Integer, primary_key=True) # Длина свечи в секундах
+    start: Mapped[datetime] = mapped_column(DateTime(timezone=True), primary_key=True)
+    open: Mapped[int] = mapped_column(Integer, nullable=False)
+    high: Mapped[int] = mapped_column(Integer, nullable=False)
+    low: Mapped[int] = mapped_column(Integer, nullable=False)
+    close: Mapped[int] = mapped_column(Integer, nullable=False)
+    volume: Mapped[int] = mapped_column(BigInteger, nullable=False)
+    # Время первой и последней сделки свечи: пачки коммитятся не в порядке времени сделок
+    open_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), nullable=False)
+    close_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), nullable=False)
+
+    instrument: Mapped["Instrument"] = relationship(
+        "Instrument",
+        back_populates="candle"
+    )
+
+
+class SettlementOutbox(Base):
+    """Сведенная, но еще не проведенная сделка. Пишется вместе с циклом сопоставления,
+    проводится и удаляется воркерами settlement."""
+    __tablename__ = "settlement_outbox"
+
+    # Порядок записи: сделки одного пользователя проводятся строго по нему
+    id: Mapped[int] = mapped_column(BigInteger().with_variant(Integer, "sqlite"), primary_key=True, autoincrement=True)
+    ticker: Mapped[str] = mapped_column(String(10))
+    buyer_id: Mapped[uuid.UUID] = mapped_column(UUID(as_uuid=True))
+    seller_id: Mapped[uuid.UUID] = mapped_column(UUID(as_uuid=True))
+    bid_order_id: Mapped[uuid.UUID] = mapped_column(UUID(as_uuid=True))
+    ask_order_id: Mapped[uuid.UUID] = mapped_column(UUID(as_uuid=True))
+    qty: Mapped[int] = mapped_column(Integer, nullable=False)
+    price: Mapped[int] = mapped_column(Integer, nullable=False)
+    bid_change: Mapped[int] = mapped_column(Integer, nullable=True)
+    # Состояние ордеров после цикла, в котором сведена сделка
+    bid_filled: Mapped[int] = mapped_column(Integer, nullable=False)
+    bid_status: Mapped[StatusEnum]
+    ask_filled: Mapped[int] = mapped_column(Integer, nullable=False)
+    ask_status: Mapped[StatusEnum]
+    attempts: Mapped[int] = mapped_column(Integer, nullable=False, default=0, server_default=text("0"))
+    last_error: Mapped[str] = mapped_column(String, nullable=True)
+    created_at: Mapped[datetime] = mapped_column(
+    DateTime(timezone=True),
+    default=lambda: datetime.now(timezone.utc)
     )
\ No newline at end of file
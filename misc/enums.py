@@ -25,4 +25,11 @@ class OrderEnum(str, enum.Enum):
 
 class VisibilityEnum(str, enum.Enum):
     ACTIVE = "ACTIVE"
-    DELETED = "DELETED"
\ No newline at end of file
+    DELETED = "DELETED"
+
+class ResolutionEnum(str, enum.Enum):
+    S1 = "1s"
+    M1 = "1m"
+    M5 = "5m"
+    H1 = "1h"
+    D1 = "1d"
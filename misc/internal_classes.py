@@ -2,26 +2,97 @@ from dataclasses import dataclass
 from uuid import UUID, uuid4
 from misc.enums import DirectionEnum, OrderEnum, StatusEnum
 from misc.db_models import Order
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
+import sys
+import time
+
+
+# Enum-ы в книге хранятся как маленькие int, индексы в этих кортежах
+DIRECTIONS = (DirectionEnum.BUY, DirectionEnum.SELL)
+ORDER_TYPES = (OrderEnum.LIMIT, OrderEnum.MARKET)
+STATUSES = (StatusEnum.NEW, StatusEnum.PARTIALLY_EXECUTED, StatusEnum.EXECUTED, StatusEnum.CANCELLED)
+DIRECTION_CODES = {value: code for code, value in enumerate(DIRECTIONS)}
+ORDER_TYPE_CODES = {value: code for code, value in enumerate(ORDER_TYPES)}
+STATUS_CODES = {value: code for code, value in enumerate(STATUSES)}
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def datetime_to_ns(value: datetime) -> int:
+    if not value.tzinfo:
+        value = value.replace(tzinfo=timezone.utc)
+    return (value - EPOCH) // timedelta(microseconds=1) * 1000
+
+
+def ns_to_datetime(value: int) -> datetime:
+    return EPOCH + timedelta(microseconds=value // 1000)
 
 
-@dataclass
 class InternalOrder:
-    user_id: UUID
-    direction: DirectionEnum
-    ticker: str
-    qty: int
-    order_type: OrderEnum
-    price: int | None
-    id: UUID = uuid4
-    timestamp: datetime = datetime.now(timezone.utc)
-    filled: int = 0
-    status: StatusEnum = StatusEnum.NEW
+    """Ордер в книге. Хранится компактно: __slots__, UUID как 128-битный int,
+    интернированный тикер, enum-ы как маленькие int и время в наносекундах от эпохи.
+    Свойства `id`, `user_id`, `direction`, `status`, `timestamp` собирают привычные объекты по запросу."""
+    __slots__ = ("id_int", "user_id_int", "ticker", "qty", "price", "filled", "ts_ns", "direction_code", "order_type_code", "status_code")
+
+    def __init__(
+            self,
+            user_id: UUID,
+            direction: DirectionEnum,
+            ticker: str,
+            qty: int,
+            order_type: OrderEnum,
+            price: int | None,
+            id: UUID | None = None,
+            timestamp: datetime | None = None,
+            filled: int = 0,
+            status: StatusEnum = StatusEnum.NEW):
+        self.id_int: int = (id or uuid4()).int
+        self.user_id_int: int = user_id.int
+        self.ticker: str = sys.intern(ticker)
+        self.qty = qty
+        self.price = price
+        self.filled = filled
+        self.ts_ns: int = datetime_to_ns(timestamp) if timestamp else time.time_ns()
+        self.direction_code = DIRECTION_CODES[direction]
+        self.order_type_code = ORDER_TYPE_CODES[order_type]
+        self.status_code = STATUS_CODES[status]
+
+    @property
+    def id(self) -> UUID:
+        return UUID(int=self.id_int)
+
+    @property
+    def user_id(self) -> UUID:
+        return UUID(int=self.user_id_int)
+
+    @property
+    def direction(self) -> DirectionEnum:
+        return DIRECTIONS[self.direction_code]
+
+    @property
+    def order_type(self) -> OrderEnum:
+        return ORDER_TYPES[self.order_type_code]
+
+    @property
+    def status(self) -> StatusEnum:
+        return STATUSES[self.status_code]
+
+    @status.setter
+    def status(self, value: StatusEnum):
+        self.status_code = STATUS_CODES[value]
+
+    @property
+    def timestamp(self) -> datetime:
+        return ns_to_datetime(self.ts_ns)
 
     @property
     def remaining(self) -> int:
         return self.qty - self.filled
-    
+
+    def __repr__(self) -> str:
+        return (f"InternalOrder(id={self.id}, user_id={self.user_id}, {self.direction.value} {self.ticker} "
+                f"qty={self.qty}, price={self.price}, filled={self.filled}, status={self.status.value})")
+
     @staticmethod
     def from_db(order: Order) -> "InternalOrder":
         return InternalOrder(
@@ -34,14 +105,39 @@ class InternalOrder:
             filled=order.filled,
             order_type=order.order_type,
             status=order.status,
-            timestamp=order.timestamp if order.timestamp.tzinfo else order.timestamp.replace(tzinfo=timezone.utc),
+            timestamp=order.timestamp,
         )
 
+    @staticmethod
+    def from_record(
+            ticker: str,
+            id_bytes: bytes,
+            user_id_bytes: bytes,
+            qty: int,
+            price: int,
+            filled: int,
+            ts_ns: int,
+            direction_code: int,
+            status_code: int) -> "InternalOrder":
+        """Собирает лимитный ордер из записи снапшота книги в обход __init__."""
+        order = InternalOrder.__new__(InternalOrder)
+        order.id_int = int.from_bytes(id_bytes, "big")
+        order.user_id_int = int.from_bytes(user_id_bytes, "big")
+        order.ticker = sys.intern(ticker)
+        order.qty = qty
+        order.price = price
+        order.filled = filled
+        order.ts_ns = ts_ns
+        order.direction_code = direction_code
+        order.order_type_code = ORDER_TYPE_CODES[OrderEnum.LIMIT]
+        order.status_code = status_code
+        return order
+
 
-@dataclass
+@dataclass(slots=True)
 class TradeExecution:
     bid_order: InternalOrder  # Ордер на покупку
     ask_order: InternalOrder  # Ордер на продажу
     executed_qty: int         # Количество исполненных активов
     execution_price: int      # Цена исполнения (берется от ask ордера)
-    bid_order_change: int | None = None  # Сдача для bid ордера (если есть)
\ No newline at end of file
+    bid_order_change: int | None = None  # Сдача для bid ордера (если есть)
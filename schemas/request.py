@@ -1,7 +1,8 @@
 import re
 from pydantic import BaseModel, ConfigDict, field_validator, UUID4, Field
-from misc.enums import DirectionEnum, RoleEnum, StatusEnum
+from misc.enums import DirectionEnum, ResolutionEnum, RoleEnum, StatusEnum
 from uuid import UUID
+from datetime import datetime, timezone
 
 
 class IdRequest(BaseModel):
@@ -55,6 +56,26 @@ class TransactionRequest(BaseModel):
         if not re.match(r"^[A-Z]{2,10}$", value):
             raise ValueError("Ticker validationError")
         return value
+
+
+class CandleRequest(BaseModel):
+    ticker: str
+    resolution: ResolutionEnum = ResolutionEnum.M1
+    start: datetime | None = None
+    end: datetime | None = None
+
+    @field_validator('ticker')
+    def validate_ticker(cls, value):
+        if not re.match(r"^[A-Z]{2,10}$", value):
+            raise ValueError("Ticker validationError")
+        return value
+
+    @field_validator('start', 'end')
+    def validate_timezone(cls, value):
+        # Время без зоны считаем UTC, как и границы свечей
+        if value and not value.tzinfo:
+            return value.replace(tzinfo=timezone.utc)
+        return value
     
 
 class OrderRequest(BaseModel):
@@ -57,6 +57,17 @@ class TransactionResponse(BaseModel):
     model_config = ConfigDict(from_attributes=True)
 
 
+class CandleResponse(BaseModel):
+    start: datetime
+    open: int
+    high: int
+    low: int
+    close: int
+    volume: int
+
+    model_config = ConfigDict(from_attributes=True)
+
+
 class BalanceResponse(RootModel):
     root: Dict[str, int]
 
@@ -5,6 +5,8 @@ from dao.dao import UserDAO, InstrumentDAO, BalanceDAO
 from uuid import UUID
 from misc.enums import VisibilityEnum
 from services.engine import matching_engine
+from services.trade_execution import trade_executor
+from services.auth import api_key_cache
 import logging
 from fastapi.exceptions import HTTPException
 
@@ -16,6 +18,13 @@ async def delete_user(session: AsyncSession, user_id: UUID) -> UserResponse:
             logging.info("Delete user failed: User not found.")
             raise HTTPException(400, f"User {user_id} not found")
         await session.delete(user)
+        api_key_cache.invalidate(session, user.api_key)
+        if trade_executor.balance_cache:
+            trade_executor.balance_cache.invalidate(session, [user.id])
+        if trade_executor.ledger:
+            trade_executor.ledger.drop_user(session, user.id)
+        if trade_executor.tape:
+            trade_executor.tape.drop_user(session, user.id)
         logging.info(f"Delete user {user.name} {user.id}")
         return UserResponse.model_validate(user)
 
@@ -42,6 +51,12 @@ async def delete_instrument(session: AsyncSession, ticker: str) -> OkResponse:
         instrument_in_db = await check_existed(session, ticker=ticker)
         if instrument_in_db and instrument_in_db.visibility == VisibilityEnum.ACTIVE:
             await session.delete(instrument_in_db)
+            if trade_executor.ledger:
+                trade_executor.ledger.drop_ticker(session, instrument_in_db.ticker)
+            if trade_executor.tape:
+                trade_executor.tape.drop_ticker(session, instrument_in_db.ticker)
+            if trade_executor.balance_cache:
+                trade_executor.balance_cache.clear(session)
             matching_engine.remove_orderbook(ticker=instrument_in_db.ticker)
 
         elif instrument_in_db and instrument_in_db.visibility == VisibilityEnum.DELETED:
@@ -64,6 +79,12 @@ async def check_existed(session: AsyncSession, ticker: str):
 async def update_balance(session: AsyncSession, body: DepositRequest | WithdrawRequest) -> OkResponse:
     async with session.begin():
         amount = -body.amount if isinstance(body, WithdrawRequest) else body.amount
-        await BalanceDAO.upsert_balance(session, user_id=body.user_id, ticker=body.ticker, amount=amount)
+        if trade_executor.ledger:
+            # Как и upsert в БД: без проверки на минус
+            trade_executor.ledger.apply(session, {(body.user_id, body.ticker): [amount, 0]}, check=False)
+        else:
+            await BalanceDAO.upsert_balance(session, user_id=body.user_id, ticker=body.ticker, amount=amount)
+            if trade_executor.balance_cache:
+                trade_executor.balance_cache.invalidate(session, [body.user_id])
         logging.info(f"Updated user {body.user_id} balance {body.ticker} to {amount} by admin.")
         return OkResponse()
\ No newline at end of file
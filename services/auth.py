@@ -0,0 +1,70 @@
+import time
+from collections import OrderedDict
+from sqlalchemy.ext.asyncio import AsyncSession
+from config import settings
+from dao.dao import UserDAO
+from dao.database import on_commit
+from misc.db_models import User
+from schemas.request import UserAPIRequest
+
+
+class ApiKeyCache:
+    """API key -> пользователь в памяти процесса: аутентификация не ходит в БД на каждый запрос.
+    Найденный пользователь живет `ttl` секунд, ненайденный ключ - `negative_ttl`, всего ключей
+    не больше `max_size` (вытесняются давно не спрошенные). Удаление пользователя сбрасывает
+    его ключ после commit; в других процессах запись доживет до конца ttl."""
+
+    def __init__(self, ttl: float = 60.0, negative_ttl: float = 5.0, max_size: int = 100_000):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_size = max_size
+        self.entries: OrderedDict[str, tuple[User | None, float]] = OrderedDict() # api_key -> (user, истекает)
+        self.invalidations = 0
+        # Статистика
+        self.hits = 0
+        self.misses = 0
+
+
+    async def get(self, session: AsyncSession, api_key: str) -> User | None:
+        entry = self.entries.get(api_key)
+        if entry and entry[1] > time.monotonic():
+            self.entries.move_to_end(api_key)
+            self.hits += 1
+            return entry[0]
+        self.misses += 1
+        invalidations = self.invalidations
+        user = await UserDAO.find_one_or_none(session, filters=UserAPIRequest(api_key=api_key))
+        if user:
+            # Копия вне сессии: объект сессии запроса протухнет после ее commit
+            user = User(**user.to_dict())
+        # Пока шел запрос, ключ могли сбросить: тогда прочитанное уже может быть устаревшим
+        if invalidations == self.invalidations:
+            self.entries[api_key] = (user, time.monotonic() + (self.ttl if user else self.negative_ttl))
+            self.entries.move_to_end(api_key)
+            if len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+        return user
+
+
+    def invalidate(self, session: AsyncSession, api_key: str):
+        on_commit(session, lambda: self._invalidate(api_key))
+
+
+    def _invalidate(self, api_key: str):
+        self.invalidations += 1
+        self.entries.pop(api_key, None)
+
+
+    def clear(self):
+        self.invalidations += 1
+        self.entries.clear()
+
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "size": len(self.entries)}
+
+
+api_key_cache = ApiKeyCache(
+    ttl=settings.AUTH_CACHE_TTL,
+    negative_ttl=settings.AUTH_CACHE_NEGATIVE_TTL,
+    max_size=settings.AUTH_CACHE_SIZE)
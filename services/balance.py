@@ -3,10 +3,16 @@ from typing import List
 from dao.dao import BalanceDAO
 from sqlalchemy.ext.asyncio import AsyncSession
 from uuid import UUID
+from services.trade_execution import trade_executor
 import logging
 
 
 async def get_balances(session: AsyncSession, user_id: UUID) -> List[BalanceResponse]:
-    balances = await BalanceDAO.get_user_balances(session, user_id)
+    if trade_executor.ledger:
+        balances = trade_executor.ledger.user_balances(user_id)
+    elif trade_executor.balance_cache:
+        balances = await trade_executor.balance_cache.get(session, user_id)
+    else:
+        balances = await BalanceDAO.get_user_balances(session, user_id)
     logging.info(f"Requested user {user_id} balance: {balances}")
     return BalanceResponse(balances)
\ No newline at end of file
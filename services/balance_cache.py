@@ -0,0 +1,77 @@
+import time
+from collections import OrderedDict
+from typing import Iterable
+from uuid import UUID
+from sqlalchemy.ext.asyncio import AsyncSession
+from dao.dao import BalanceDAO
+from dao.database import on_commit
+
+
+class BalanceCache:
+    """Итоговые балансы пользователей (как их отдает GET /balance) в памяти процесса.
+    Изменение балансов сбрасывает запись пользователя после commit своей транзакции, поэтому
+    следующий запрос того же пользователя видит свою запись. Чтение из БД запоминает номер версии
+    и кладет результат, только если за время чтения запись пользователя никто не сбросил.
+    `ttl` страхует от изменений в обход процесса, всего записей не больше `max_size`."""
+
+    def __init__(self, ttl: float = 30.0, max_size: int = 100_000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries: OrderedDict[UUID, tuple[dict[str, int], float]] = OrderedDict() # user_id -> (балансы, истекает)
+        self.version = 0
+        self.loading: dict[UUID, int] = {} # user_id -> версия начатого чтения из БД
+        # Статистика
+        self.hits = 0
+        self.misses = 0
+
+
+    async def get(self, session: AsyncSession, user_id: UUID) -> dict[str, int]:
+        entry = self.entries.get(user_id)
+        if entry and entry[1] > time.monotonic():
+            self.entries.move_to_end(user_id)
+            self.hits += 1
+            return dict(entry[0])
+        self.misses += 1
+        self.version += 1
+        version = self.loading[user_id] = self.version
+        try:
+            balances = await BalanceDAO.get_user_balances(session, user_id)
+        finally:
+            stale = self.loading.get(user_id) != version
+            if not stale:
+                del self.loading[user_id]
+        if not stale:
+            self.entries[user_id] = (dict(balances), time.monotonic() + self.ttl)
+            self.entries.move_to_end(user_id)
+            if len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+        return balances
+
+
+    def invalidate(self, session: AsyncSession, user_ids: Iterable[UUID]):
+        user_ids = set(user_ids)
+        on_commit(session, lambda: self._invalidate(user_ids))
+
+
+    def _invalidate(self, user_ids: set[UUID]):
+        for user_id in user_ids:
+            self.entries.pop(user_id, None)
+            # Начатое чтение могло увидеть БД до commit: его результат не кладем
+            self.loading.pop(user_id, None)
+
+
+    def clear(self, session: AsyncSession):
+        on_commit(session, self._clear)
+
+
+    def _clear(self):
+        self.entries.clear()
+        self.loading.clear()
+
+
+    def stats(self) -> dict:
+        return {
+            "balance_cache_hits": self.hits,
+            "balance_cache_misses": self.misses,
+            "balance_cache_size": len(self.entries),
+        }
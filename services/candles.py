@@ -0,0 +1,51 @@
+from datetime import datetime, timedelta
+from misc.enums import ResolutionEnum
+from misc.internal_classes import EPOCH
+
+
+# Длина свечи в секундах, так она и хранится в candles.resolution
+RESOLUTIONS = {
+    ResolutionEnum.S1: 1,
+    ResolutionEnum.M1: 60,
+    ResolutionEnum.M5: 300,
+    ResolutionEnum.H1: 3600,
+    ResolutionEnum.D1: 86400,
+}
+
+
+def candle_start(timestamp: datetime, resolution: int) -> datetime:
+    # Свечи выровнены от эпохи по UTC, дневная начинается в 00:00 UTC
+    seconds = int((timestamp - EPOCH).total_seconds())
+    return EPOCH + timedelta(seconds=seconds - seconds % resolution)
+
+
+def aggregate(trades: list[dict]) -> list[dict]:
+    """Сводит сделки пачки в свечи всех разрешений: по строке на (ticker, resolution, start),
+    в порядке ключа, чтобы параллельные upsert-ы брали блокировки строк в одном порядке.
+    Сделки идут в порядке исполнения (время строго растет); open_at и close_at - время первой
+    и последней сделки свечи, по ним upsert решает, менять ли open и close."""
+    candles: dict[tuple[str, int, datetime], dict] = {}
+    for trade in trades:
+        for resolution in RESOLUTIONS.values():
+            key = (trade["ticker"], resolution, candle_start(trade["timestamp"], resolution))
+            candle = candles.get(key)
+            if candle is None:
+                candles[key] = {
+                    "ticker": key[0],
+                    "resolution": key[1],
+                    "start": key[2],
+                    "open": trade["price"],
+                    "high": trade["price"],
+                    "low": trade["price"],
+                    "close": trade["price"],
+                    "volume": trade["amount"],
+                    "open_at": trade["timestamp"],
+                    "close_at": trade["timestamp"],
+                }
+            else:
+                candle["high"] = max(candle["high"], trade["price"])
+                candle["low"] = min(candle["low"], trade["price"])
+                candle["close"] = trade["price"]
+                candle["close_at"] = trade["timestamp"]
+                candle["volume"] += trade["amount"]
+    return [candles[key] for key in sorted(candles)]
@@ -1,3 +1,23 @@
+from config import settings
+from services.journal import Journal
 from services.matching import MatchingEngine
+from services.orderbook import ORDERBOOK_TYPES
+from services.settlement import OutboxWorkerPool, SettlementBatcher
 
-matching_engine = MatchingEngine(interval=0.1)
\ No newline at end of file
+matching_engine = MatchingEngine(
+    interval=settings.ENGINE_MAX_BATCH_DELAY,
+    book_class=ORDERBOOK_TYPES[settings.ENGINE_BOOK_TYPE],
+    book_classes={ticker: ORDERBOOK_TYPES[book_type] for ticker, book_type in settings.ENGINE_BOOK_TYPES.items()},
+    inline_matching=settings.ENGINE_INLINE_MATCHING,
+    max_concurrent_settlements=settings.ENGINE_MAX_CONCURRENT_SETTLEMENTS,
+    snapshot_path=settings.ENGINE_SNAPSHOT_PATH,
+    snapshot_margin=settings.ENGINE_SNAPSHOT_MARGIN,
+    journal=Journal(settings.ENGINE_JOURNAL_PATH, settings.ENGINE_JOURNAL_FLUSH_INTERVAL) if settings.ENGINE_JOURNAL_PATH else None,
+    settlement=SettlementBatcher(
+        max_delay=settings.SETTLEMENT_MAX_DELAY,
+        max_executions=settings.SETTLEMENT_MAX_EXECUTIONS) if settings.SETTLEMENT_MODE == "group" else None,
+    outbox=OutboxWorkerPool(
+        workers=settings.SETTLEMENT_OUTBOX_WORKERS,
+        batch_size=settings.SETTLEMENT_OUTBOX_BATCH,
+        poll_interval=settings.SETTLEMENT_OUTBOX_POLL_INTERVAL,
+        max_attempts=settings.SETTLEMENT_OUTBOX_MAX_ATTEMPTS) if settings.SETTLEMENT_MODE == "outbox" else None)
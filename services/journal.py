@@ -0,0 +1,302 @@
+import asyncio
+import logging
+import os
+import struct
+import time
+import zlib
+from typing import TYPE_CHECKING
+from misc.enums import DirectionEnum, OrderEnum
+from misc.internal_classes import InternalOrder, ORDER_TYPE_CODES
+from services.snapshot import ORDER_RECORD, dump_book, read_book
+
+if TYPE_CHECKING:
+    from services.matching import MatchingEngine
+    from services.orderbook import BaseOrderBook
+
+
+# Журнал входов движка: append-only, записи с номером и CRC.
+#   рамка: длина данных, crc32 остального
+#   запись: seq, время (нс от эпохи), вид записи, данные
+# Книги меняются только этими входами, поэтому проигрывание журнала воспроизводит их точно.
+FRAME = struct.Struct("<II")
+RECORD = struct.Struct("<QqB")
+TICKER = struct.Struct("<B10s")
+ORDER_ID = struct.Struct("<16s")
+MATCH_FLAG = struct.Struct("<?")
+BALANCE = struct.Struct("<q")
+
+RESET = 0 # Все книги очищены, дальше идет их состояние записями LOAD
+LOAD = 1 # Книга целиком (в формате снапшота), без сопоставления
+ADD_INSTRUMENT = 2
+REMOVE_INSTRUMENT = 3
+LIMIT = 4
+MARKET = 5
+CANCEL = 6
+MATCH = 7
+UNDO_MARKET = 8 # Проведение последнего рыночного ордера книги не удалось, его сделки откатываются
+
+
+def _pack_ticker(ticker: str) -> bytes:
+    encoded = ticker.encode()
+    return TICKER.pack(len(encoded), encoded)
+
+
+def _unpack_ticker(view: memoryview, offset: int = 0) -> str:
+    ticker_len, ticker = TICKER.unpack_from(view, offset)
+    return ticker[:ticker_len].decode()
+
+
+def _pack_order(order: InternalOrder) -> bytes:
+    return _pack_ticker(order.ticker) + ORDER_RECORD.pack(
+        order.id_int.to_bytes(16, "big"),
+        order.user_id_int.to_bytes(16, "big"),
+        order.qty, order.price or 0, order.filled, order.ts_ns,
+        order.direction_code, order.status_code)
+
+
+def _unpack_order(view: memoryview) -> InternalOrder:
+    return InternalOrder.from_record(_unpack_ticker(view), *ORDER_RECORD.unpack_from(view, TICKER.size))
+
+
+class Journal:
+    """Журнал входов движка. `append` только кладет запись в буфер,
+    фоновый `run` раз в `flush_interval` пишет накопленное одним write и одним fsync.
+    При падении теряются входы за последний интервал, их досчитывает сверка с БД при старте.
+    Записанный снапшот книг отрезает от журнала все записи до своего номера (`cut` и `checkpoint`):
+    журнал хранит только входы после последнего снапшота."""
+
+    def __init__(self, path: str, flush_interval: float = 0.01):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.seq = 0
+        self.buffer: list[bytes] = []
+        self.file = None
+        self.size = 0 # Байт в текущем файле вместе с буфером
+        self.lock = asyncio.Lock() # Запись в файл и его подмена при checkpoint не пересекаются
+        self.pending: asyncio.Future | None = None # Запись, которую сейчас делает поток
+
+
+    def append(self, kind: int, payload: bytes = b""):
+        self.seq += 1
+        body = RECORD.pack(self.seq, time.time_ns(), kind) + payload
+        frame = FRAME.pack(len(payload), zlib.crc32(body)) + body
+        self.buffer.append(frame)
+        self.size += len(frame)
+
+
+    def limit(self, order: InternalOrder, match: bool):
+        self.append(LIMIT, _pack_order(order) + MATCH_FLAG.pack(match))
+
+
+    def market(self, order: InternalOrder, balance: int):
+        self.append(MARKET, _pack_order(order) + BALANCE.pack(balance))
+
+
+    def cancel(self, ticker: str, order_id_int: int):
+        self.append(CANCEL, _pack_ticker(ticker) + ORDER_ID.pack(order_id_int.to_bytes(16, "big")))
+
+
+    def match(self, ticker: str):
+        self.append(MATCH, _pack_ticker(ticker))
+
+
+    def undo_market(self, ticker: str):
+        self.append(UNDO_MARKET, _pack_ticker(ticker))
+
+
+    def add_instrument(self, ticker: str):
+        self.append(ADD_INSTRUMENT, _pack_ticker(ticker))
+
+
+    def remove_instrument(self, ticker: str):
+        self.append(REMOVE_INSTRUMENT, _pack_ticker(ticker))
+
+
+    def rotate(self, books: dict[str, "BaseOrderBook"]):
+        """Начинает журнал заново с текущего состояния книг: RESET и по записи LOAD на книгу.
+        Новый файл пишется рядом и атомарно подменяет старый."""
+        self.close()
+        self.buffer.clear() # Записи без открытого файла (до первого старта) покрывает состояние книг
+        self.append(RESET)
+        for book in books.values():
+            self.append(LOAD, dump_book(book))
+        data = b"".join(self.buffer)
+        self.buffer.clear()
+        self._replace(data)
+        self.size = len(data)
+
+
+    def cut(self) -> tuple[int, object, int]:
+        """Место в журнале на текущий момент: номер последней записи, файл и смещение за ней.
+        Снапшот снимает книги в тот же момент, без await между ними."""
+        return self.seq, self.file, self.size
+
+
+    async def checkpoint(self, cut: tuple[int, object, int]):
+        """Отрезает записи до `cut` включительно: их покрывает записанный снапшот.
+        Записи после `cut` переносятся в новый файл, который атомарно подменяет старый."""
+        _, file, offset = cut
+        async with self.lock:
+            if file is None or self.file is not file:
+                return # Журнал с тех пор начат заново
+            data = b"".join(self.buffer)
+            self.buffer.clear()
+            self.pending = asyncio.ensure_future(asyncio.to_thread(self._truncate, data, offset))
+            await asyncio.shield(self.pending)
+            self.size -= offset
+
+
+    def _truncate(self, data: bytes, offset: int):
+        self._write(self.file, data)
+        with open(self.path, "rb") as f:
+            f.seek(offset)
+            tail = f.read()
+        self.file.close()
+        self._replace(tail)
+
+
+    def _replace(self, data: bytes):
+        # Новый файл пишется рядом и атомарно подменяет старый
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "wb") as f:
+            self._write(f, data)
+        os.replace(tmp_path, self.path)
+        self.file = open(self.path, "ab")
+
+
+    @staticmethod
+    def _write(f, data: bytes):
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+    def flush(self):
+        if not self.buffer or self.file is None:
+            return
+        data = b"".join(self.buffer)
+        self.buffer.clear()
+        self._write(self.file, data)
+
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            async with self.lock:
+                if not self.buffer or self.file is None:
+                    continue
+                data = b"".join(self.buffer)
+                self.buffer.clear()
+                # shield: отмена задачи не должна оборвать запись на середине, ее дождется aclose
+                self.pending = asyncio.ensure_future(asyncio.to_thread(self._write, self.file, data))
+                try:
+                    await asyncio.shield(self.pending)
+                except Exception as e:
+                    logging.exception(f"Error writing engine journal {self.path}: {e}")
+
+
+    def close(self):
+        if self.file is not None:
+            self.flush()
+            self.file.close()
+            self.file = None
+
+
+    async def aclose(self):
+        if self.pending is not None:
+            await asyncio.gather(self.pending, return_exceptions=True)
+            self.pending = None
+        self.close()
+
+
+def read_journal(path: str):
+    """Отдает записи журнала по порядку: (seq, время, вид, данные).
+    Недописанный или битый хвост (падение посреди записи) отбрасывается."""
+    with open(path, "rb") as f:
+        view = memoryview(f.read())
+    offset = 0
+    expected_seq = None
+    while offset + FRAME.size + RECORD.size <= len(view):
+        length, crc = FRAME.unpack_from(view, offset)
+        start = offset + FRAME.size
+        end = start + RECORD.size + length
+        if end > len(view) or zlib.crc32(view[start:end]) != crc:
+            logging.warning(f"Journal {path}: torn record at offset {offset}, ignoring the tail")
+            return
+        seq, ts_ns, kind = RECORD.unpack_from(view, start)
+        if expected_seq is not None and seq != expected_seq:
+            raise ValueError(f"Journal {path}: expected seq {expected_seq}, got {seq}")
+        expected_seq = seq + 1
+        yield seq, ts_ns, kind, view[start + RECORD.size:end]
+        offset = end
+
+
+def replay(path: str, engine: "MatchingEngine", after: int = 0, book_after: dict[str, int] | None = None) -> tuple[int, int]:
+    """Проигрывает журнал в книги `engine` напрямую, минуя журнал и логи движка.
+    `after` - номер, по который книги уже восстановлены (из снапшота): более ранние записи пропускаются.
+    `book_after` - номера отдельных книг, снятых снапшотом позже `after`: их записи до своего номера тоже.
+    Возвращает номер и время последней записи (`after` и 0, если новых записей нет)."""
+    last_seq, last_ts = after, 0
+    books = engine.books
+    book_after = dict(book_after or {})
+    last_market: dict[str, list] = {} # Сделки последнего рыночного ордера книги, для UNDO_MARKET
+    for seq, ts_ns, kind, payload in read_journal(path):
+        if seq <= after:
+            continue
+        if seq != last_seq + 1 and kind != RESET:
+            # Журнал начинается позже снапшота: входы между ними потеряны
+            raise ValueError(f"Journal {path}: starts at seq {seq}, books are restored up to seq {after}")
+        if kind == RESET:
+            books.clear()
+            book_after.clear()
+        elif seq <= book_after.get(_unpack_ticker(payload), after):
+            pass # Запись уже учтена в книге снапшота: все записи, кроме RESET, начинаются с тикера
+        elif kind == LOAD:
+            ticker, orders, _, _ = read_book(payload, 0)
+            book = books[ticker] = engine._create_book(ticker)
+            book.restore(orders)
+        elif kind == ADD_INSTRUMENT:
+            ticker = _unpack_ticker(payload)
+            books[ticker] = engine._create_book(ticker)
+        elif kind == REMOVE_INSTRUMENT:
+            books.pop(_unpack_ticker(payload), None)
+        elif kind == LIMIT:
+            order = _unpack_order(payload)
+            (match,) = MATCH_FLAG.unpack_from(payload, TICKER.size + ORDER_RECORD.size)
+            books[order.ticker].add_limit_order(order, match=match)
+        elif kind == MARKET:
+            order = _unpack_order(payload)
+            order.order_type_code = ORDER_TYPE_CODES[OrderEnum.MARKET]
+            order.price = None
+            (balance,) = BALANCE.unpack_from(payload, TICKER.size + ORDER_RECORD.size)
+            last_market[order.ticker] = books[order.ticker].add_market_order(order, balance)
+        elif kind == CANCEL:
+            (order_id,) = ORDER_ID.unpack_from(payload, TICKER.size)
+            book = books[_unpack_ticker(payload)]
+            order = book.orders.get(int.from_bytes(order_id, "big"))
+            if order is not None:
+                book.cancel_order(order)
+        elif kind == MATCH:
+            books[_unpack_ticker(payload)].matching_orders()
+        elif kind == UNDO_MARKET:
+            ticker = _unpack_ticker(payload)
+            books[ticker].undo_market_order(last_market.pop(ticker, []))
+        else:
+            raise ValueError(f"Journal {path}: unknown record kind {kind} at seq {seq}")
+        last_seq, last_ts = seq, ts_ns
+
+    engine.crossed = {ticker for ticker, book in books.items() if book.is_crossed()}
+    return last_seq, last_ts
+
+
+if __name__ == "__main__":
+    # Разбор инцидента без БД: python -m services.journal <путь к журналу>
+    import sys
+    from services.matching import MatchingEngine
+
+    engine = MatchingEngine()
+    seq, ts_ns = replay(sys.argv[1], engine)
+    print(f"Replayed up to seq {seq}, last record at {ts_ns} ns")
+    for ticker, book in engine.books.items():
+        print(f"{ticker}: {len(book.orders)} orders, "
+              f"bids {book.get_depth(DirectionEnum.BUY, 5)}, asks {book.get_depth(DirectionEnum.SELL, 5)}")
@@ -0,0 +1,141 @@
+import asyncio
+import logging
+from typing import Callable
+from uuid import UUID
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from dao.dao import BalanceDAO
+from dao.database import on_commit, on_rollback
+from misc.db_models import Balance
+
+
+class BalanceLedger:
+    """Балансы и резервы в памяти процесса движка: блокировка средств под ордер, разблокировка
+    и проведение сделок не ходят в БД. Изменение применяется сразу и откатывается, если откатилась
+    транзакция сессии, в которой его сделали. В Postgres измененные строки уходят фоном (write-behind):
+    раз в `flush_interval` одним upsert в порядке (user_id, ticker).
+    При падении процесса теряются изменения балансов за последний интервал."""
+
+    def __init__(self, flush_interval: float = 0.05):
+        self.flush_interval = flush_interval
+        self.balances: dict[UUID, dict[str, list[int]]] = {} # user_id -> ticker -> [amount, blocked_amount]
+        self.dirty: set[tuple[UUID, str]] = set()
+        # Статистика для /health/settlement
+        self.flushes = 0
+        self.flushed_rows = 0
+        self.last_flush_rows = 0
+        self.flush_errors = 0
+
+
+    async def load(self, session: AsyncSession):
+        rows = (await session.execute(select(Balance.user_id, Balance.ticker, Balance.amount, Balance.blocked_amount))).all()
+        self.balances.clear()
+        self.dirty.clear()
+        for user_id, ticker, amount, blocked_amount in rows:
+            self.balances.setdefault(user_id, {})[ticker] = [amount, blocked_amount]
+        logging.info(f"Balance ledger loaded: {len(rows)} balances of {len(self.balances)} users")
+
+
+    def get(self, user_id: UUID, ticker: str) -> tuple[int, int] | None:
+        balance = self.balances.get(user_id, {}).get(ticker)
+        return (balance[0], balance[1]) if balance else None
+
+
+    def user_balances(self, user_id: UUID) -> dict[str, int]:
+        return {ticker: amount + blocked_amount for ticker, (amount, blocked_amount) in self.balances.get(user_id, {}).items()}
+
+
+    def apply(self, session: AsyncSession, deltas: dict[tuple[UUID, str], list[int]], check: bool = True) -> bool:
+        """Применяет изменения [amount, blocked_amount] по (user_id, ticker) все или ни одного.
+        С `check` отказывает (False), если что-то уйдет в минус. Откат транзакции `session` их отменяет."""
+        if check:
+            for (user_id, ticker), (amount, blocked_amount) in deltas.items():
+                balance = self.balances.get(user_id, {}).get(ticker, (0, 0))
+                if balance[0] + amount < 0 or balance[1] + blocked_amount < 0:
+                    return False
+        self._apply(deltas, 1)
+        on_rollback(session, lambda: self._apply(deltas, -1))
+        return True
+
+
+    def _apply(self, deltas: dict[tuple[UUID, str], list[int]], sign: int):
+        for (user_id, ticker), (amount, blocked_amount) in deltas.items():
+            balance = self.balances.setdefault(user_id, {}).setdefault(ticker, [0, 0])
+            balance[0] += sign * amount
+            balance[1] += sign * blocked_amount
+            self.dirty.add((user_id, ticker))
+
+
+    def block(self, session: AsyncSession, user_id: UUID, ticker: str, amount: int) -> bool:
+        if amount <= 0:
+            return False
+        return self.apply(session, {(user_id, ticker): [-amount, amount]})
+
+
+    def unblock(self, session: AsyncSession, user_id: UUID, ticker: str, amount: int) -> bool:
+        if amount <= 0:
+            return False
+        return self.apply(session, {(user_id, ticker): [amount, -amount]})
+
+
+    def drop_user(self, session: AsyncSession, user_id: UUID):
+        # Строки удаляет каскад в БД, забываем их после commit, чтобы flusher не вставил их обратно
+        on_commit(session, lambda: self._drop(lambda key: key[0] == user_id))
+
+
+    def drop_ticker(self, session: AsyncSession, ticker: str):
+        on_commit(session, lambda: self._drop(lambda key: key[1] == ticker))
+
+
+    def _drop(self, match: Callable[[tuple[UUID, str]], bool]):
+        for user_id, balances in list(self.balances.items()):
+            for ticker in [ticker for ticker in balances if match((user_id, ticker))]:
+                del balances[ticker]
+                self.dirty.discard((user_id, ticker))
+            if not balances:
+                del self.balances[user_id]
+
+
+    async def flush(self, session_factory: Callable[[], AsyncSession]) -> int:
+        """Пишет измененные строки одним upsert. Значения снимаются без await между ними,
+        так что пачка согласована; изменения во время записи уйдут следующей."""
+        if not self.dirty:
+            return 0
+        keys = sorted(self.dirty)
+        self.dirty.clear()
+        rows = []
+        for user_id, ticker in keys:
+            balance = self.balances.get(user_id, {}).get(ticker)
+            if balance is not None:
+                rows.append({"user_id": user_id, "ticker": ticker, "amount": balance[0], "blocked_amount": balance[1]})
+        try:
+            async with session_factory() as session:
+                async with session.begin():
+                    await BalanceDAO.store_many(session, rows)
+        except Exception:
+            self.dirty.update(keys)
+            self.flush_errors += 1
+            raise
+        self.flushes += 1
+        self.flushed_rows += len(rows)
+        self.last_flush_rows = len(rows)
+        return len(rows)
+
+
+    async def run(self, session_factory: Callable[[], AsyncSession]):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush(session_factory)
+            except Exception as e:
+                logging.exception(f"Error flushing balance ledger: {e}")
+
+
+    def stats(self) -> dict:
+        return {
+            "ledger_flushes": self.flushes,
+            "ledger_flushed_rows": self.flushed_rows,
+            "ledger_last_flush_rows": self.last_flush_rows,
+            "ledger_flush_errors": self.flush_errors,
+            "ledger_dirty_rows": len(self.dirty),
+        }
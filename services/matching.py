@@ -1,20 +1,102 @@
 import asyncio
+import contextlib
+import gc
 from typing import Callable
-from services.orderbook import OrderBook
+from services.orderbook import BaseOrderBook, OrderBook
 from sqlalchemy.ext.asyncio import AsyncSession
-from dao.dao import InstrumentDAO, OrderDAO
-from misc.internal_classes import TradeExecution
+from dao.dao import InstrumentDAO, OrderDAO, SettlementOutboxDAO, UserDAO
+from misc.internal_classes import InternalOrder, TradeExecution, ns_to_datetime
+from misc.enums import DirectionEnum, StatusEnum
 from schemas.response import L2OrderBook, Level
 from misc.db_models import Order, Instrument
-from collections import defaultdict
 import logging
+import os
+from uuid import UUID
+from services.journal import Journal, replay
+from services.settlement import OutboxWorkerPool, SettlementBatcher
+from services.snapshot import read_snapshot
 from services.trade_execution import trade_executor
 
+class BookActor:
+    """Сопоставление одной книги: свой inbox, своя задача и своя сессия (соединение) БД.
+    Медленная или упавшая сделка по одному тикеру не задерживает остальные."""
+
+    def __init__(self, engine: "MatchingEngine", ticker: str, session_factory: Callable[[], AsyncSession]):
+        self.engine = engine
+        self.ticker = ticker
+        self.session_factory = session_factory
+        # Сообщения "книга пересечена" схлопываются: одного непрочитанного достаточно
+        self.inbox: asyncio.Queue[None] = asyncio.Queue(maxsize=1)
+        self.task: asyncio.Task | None = None
+
+
+    def start(self):
+        self.task = asyncio.create_task(self.run(), name=f"book-actor-{self.ticker}")
+
+
+    def stop(self):
+        if self.task:
+            self.task.cancel()
+
+
+    def notify(self):
+        try:
+            self.inbox.put_nowait(None)
+        except asyncio.QueueFull:
+            pass
+
+
+    async def run(self):
+        while True:
+            await self.inbox.get()
+            # Даем набежать еще ордерам, чтобы свести их одним циклом
+            if self.engine.interval:
+                await asyncio.sleep(self.engine.interval)
+            try:
+                if self.engine.settlement:
+                    # Соединение держит только групповой commit, актор его не берет
+                    await self.engine.match_book_grouped(self.ticker)
+                    continue
+                async with self.engine.settlement_slots:
+                    async with self.session_factory() as session:
+                        async with session.begin():
+                            await self.engine.match_book(session, self.ticker)
+            except Exception as e:
+                logging.exception(f"Error during order matching for {self.ticker}: {e}")
+
+
 class MatchingEngine: 
-    def  __init__(self, interval: float = 1.0):
-        self.books: dict[str, OrderBook] = {}
-        self.interval = interval
-        self.lock = asyncio.Lock()
+    def  __init__(
+            self,
+            interval: float = 0.0,
+            book_class: type[BaseOrderBook] = OrderBook,
+            book_classes: dict[str, type[BaseOrderBook]] | None = None,
+            inline_matching: bool = False,
+            max_concurrent_settlements: int = 20,
+            snapshot_path: str | None = None,
+            snapshot_margin: float = 60.0,
+            journal: Journal | None = None,
+            settlement: SettlementBatcher | None = None,
+            outbox: OutboxWorkerPool | None = None):
+        self.books: dict[str, BaseOrderBook] = {}
+        self.interval = interval # Сколько ждать после пробуждения, чтобы собрать несколько ордеров в один цикл
+        self.crossed: set[str] = set() # Тикеры книг, где лучший bid >= лучшего ask
+        self.actors: dict[str, BookActor] = {}
+        self.session_factory: Callable[[], AsyncSession] | None = None # Есть, если акторы запущены
+        # Сколько акторов одновременно держат соединение, остальной пул остается API
+        self.settlement_slots = asyncio.Semaphore(max_concurrent_settlements)
+        self.book_class = book_class # Реализация книги по умолчанию
+        self.book_classes = book_classes or {} # Реализация книги для отдельных тикеров
+        self.inline_matching = inline_matching # Сводить лимитный ордер сразу при добавлении, а не в match_all
+        self.snapshot_path = snapshot_path # Бинарный снапшот книг для быстрого старта
+        self.snapshot_margin = snapshot_margin # Запас (сек) назад от отметки снапшота при досчете из БД
+        self.journal = journal # Журнал входов книг для восстановления и разбора инцидентов
+        self.settlement = settlement # Групповой commit сделок; None - каждый цикл своей транзакцией
+        self.outbox = outbox # Цикл только пишет сделки в settlement_outbox, проводят их воркеры
+
+
+    def _create_book(self, ticker: str) -> BaseOrderBook:
+        return self.book_classes.get(ticker, self.book_class)(ticker)
     
 
     def get_bids_from_book(self, ticker: str):
@@ -27,47 +109,73 @@ class MatchingEngine:
         return book.get_asks() if book else []
 
 
+    def get_order(self, ticker: str, order_id: UUID) -> InternalOrder | None:
+        book = self.books.get(ticker)
+        return book.orders.get(order_id.int) if book else None
+
+
     def get_orderbook(self, ticker, limit: int) -> L2OrderBook:
         book = self.books.get(ticker)
         if not book: 
             return []
-        bid_map = defaultdict(int)
-        for order in book.bids:
-            if len(bid_map) >= limit: 
-                break
-            bid_map[order.price] += order.remaining
-
-        ask_map = defaultdict(int)
-        for order in book.asks:
-            if len(ask_map) >= limit: 
-                break
-            ask_map[order.price] += order.remaining
 
         book = L2OrderBook(
-            bid_levels=[Level(price=price, qty=qty) for price, qty in bid_map.items()],
-            ask_levels=[Level(price=price, qty=qty) for price, qty in ask_map.items()]
+            bid_levels=[Level(price=price, qty=qty) for price, qty in book.get_depth(DirectionEnum.BUY, limit)],
+            ask_levels=[Level(price=price, qty=qty) for price, qty in book.get_depth(DirectionEnum.SELL, limit)]
         )
         logging.info(f"Orderbook requested for {ticker}: {book}")
         return book
 
 
-    def add_limit_order(self, order: Order):
+    def add_limit_order(self, order: Order) -> list[TradeExecution]:
         book = self.books.get(order.ticker)
         if not book:
             raise ValueError(f"Order book for ticker '{order.ticker}' not found. Did you forget to call add_instrument or startup?") 
+        if self.journal:
+            order = InternalOrder.from_db(order)
+            self.journal.limit(order, self.inline_matching)
+        executions: list[TradeExecution] = book.add_limit_order(order, match=self.inline_matching)
+        self._notify(book)
         logging.info(msg=f"Added new order {order.id, order.ticker, order.direction, order.price, order.qty, order.order_type} by {order.user_id}")
-        return book.add_limit_order(order)
+        if executions:
+            logging.info(f"Executions: {len(executions)}")
+        return executions
 
 
     def add_market_order(self, order: Order, balance: int):
         book = self.books.get(order.ticker)
         if not book:
             raise ValueError(f"Order book for ticker '{order.ticker}' not found. Did you forget to call add_instrument or startup?") 
+        if self.journal:
+            order = InternalOrder.from_db(order)
+            self.journal.market(order, balance)
         executions: list[TradeExecution] = book.add_market_order(order, balance)
+        self._notify(book)
         logging.info(msg=f"Added new order {order.id, order.ticker, order.direction, order.price, order.qty, order.order_type} by {order.user_id}")
         logging.info(f"Executions: {len(executions)}")
         return executions
 
+
+    def undo_market_order(self, order: Order, executions: list[TradeExecution]):
+        """Возвращает книге объем, который забрал рыночный ордер, если его сделки не удалось провести.
+        Вызывается под `book_lock`, пока книгу не трогал никто другой."""
+        if not executions:
+            return
+        book = self.books.get(order.ticker)
+        if not book:
+            return
+        if self.journal:
+            self.journal.undo_market(book.ticker)
+        book.undo_market_order(executions)
+        logging.warning(f"Market order {order.id} rolled back in book {order.ticker}: {len(executions)} executions")
+
+
+    def book_lock(self, ticker: str) -> asyncio.Lock | contextlib.nullcontext:
+        """Замок книги: под ним сопоставление и проведение сделок, у книги один писатель.
+        Берется до блокировок строк БД, как и в цикле актора."""
+        book = self.books.get(ticker)
+        return book.lock if book else contextlib.nullcontext()
+
     
     def cancel_order(self, cancel_order: Order) -> bool:
         book = self.books.get(cancel_order.ticker)
@@ -75,6 +183,9 @@ class MatchingEngine:
             logging.info(f"Order cancel error: book {cancel_order.ticker} not exist.")
             return False
         if book.cancel_order(cancel_order):
+            if self.journal:
+                self.journal.cancel(book.ticker, cancel_order.id.int)
+            self._notify(book)
             logging.info(f"Order canceled {cancel_order.id, cancel_order.ticker, cancel_order.direction, cancel_order.price, cancel_order.qty, cancel_order.order_type}")
             return True
         logging.info(f"Order cancel error: order {cancel_order.id, cancel_order.ticker, cancel_order.direction, cancel_order.price, cancel_order.qty, cancel_order.order_type} not found in orderbook.")
@@ -82,59 +193,266 @@ class MatchingEngine:
 
 
     def add_instrument(self, instrument: Instrument):
-        self.books[instrument.ticker] = OrderBook(instrument.ticker)
+        self.books[instrument.ticker] = self._create_book(instrument.ticker)
+        self.crossed.discard(instrument.ticker)
+        if self.journal:
+            self.journal.add_instrument(instrument.ticker)
+        if self.session_factory and instrument.ticker not in self.actors:
+            self._start_actor(instrument.ticker)
         logging.info(f"Added new instrument {instrument.ticker}")
 
 
     def remove_orderbook(self, ticker: str):
         if ticker in self.books: 
             del self.books[ticker]
+            self.crossed.discard(ticker)
+            if self.journal:
+                self.journal.remove_instrument(ticker)
+            actor = self.actors.pop(ticker, None)
+            if actor:
+                actor.stop()
             logging.info(f"Deleted instrument {ticker}")
             logging.info(f"Deleted orderbook {ticker}")
 
 
     async def startup(self, session: AsyncSession):
-        async with self.lock:
-            async with session.begin_nested():
-                instruments = await InstrumentDAO.find_all(session)
-                for instrument in instruments:
-                    book = OrderBook(instrument.ticker)
+        self.crossed.clear()
+        if trade_executor.ledger:
+            await trade_executor.ledger.load(session)
+        if trade_executor.tape:
+            # Сделки до старта есть только в БД
+            trade_executor.tape.clear()
+        high_water_mark, snapshot = self._read_journal(*self._read_snapshot())
+        async with session.begin_nested():
+            instruments = await InstrumentDAO.find_all(session)
+            restored: list[BaseOrderBook] = []
+            for instrument in instruments:
+                book = self._create_book(instrument.ticker)
+                if instrument.ticker in snapshot:
+                    book.restore(snapshot[instrument.ticker])
+                    restored.append(book)
+                else:
                     orders = await OrderDAO.get_open_orders(session, instrument.ticker)
                     book.load_orderbook(orders)
-                    self.books[instrument.ticker] = book
-            logging.info(msg=f"Startup complete. Orderbooks: {self.books.keys()}")
+                self.books[instrument.ticker] = book
+            if restored:
+                await self._reconcile(session, high_water_mark, restored)
+            if self.outbox or self.settlement:
+                await self._apply_outbox(session)
+            if self.settlement:
+                # В режиме группового commit в outbox остаются только сделки, не проведенные до остановки
+                self.settlement.recover_until = await SettlementOutboxDAO.get_last_id(session)
+            for book in self.books.values():
+                self._notify(book)
+        if self.journal:
+            # Журнал начинаем с состояния после сверки с БД
+            self.journal.rotate(self.books)
+        logging.info(msg=f"Startup complete. Orderbooks: {self.books.keys()}, from snapshot: {len(restored)}")
 
 
-    async def match_all(self, session: AsyncSession):
-        async with self.lock: # TODO проблемка.
-            books = dict((t, b) for t,b in self.books.items() if b.has_activity)
+    def _read_journal(
+            self,
+            high_water_mark: int,
+            journal_seq: int,
+            snapshot: dict[str, list[InternalOrder]],
+            book_seqs: dict[str, int]) -> tuple[int, dict[str, list[InternalOrder]]]:
+        """Доигрывает поверх снапшота записи журнала после его номера `journal_seq`
+        (для каждой книги - после номера, на котором она снята)."""
+        if not self.journal:
+            return high_water_mark, snapshot
+        # Номера журнала не идут назад, даже если файла нет: иначе новые записи совпали бы с отметкой снапшота
+        self.journal.seq = max([journal_seq, *book_seqs.values()])
+        if not os.path.exists(self.journal.path):
+            return high_water_mark, snapshot
+        engine = MatchingEngine(book_class=self.book_class, book_classes=self.book_classes)
+        for ticker, orders in snapshot.items():
+            engine.books[ticker] = engine._create_book(ticker)
+            engine.books[ticker].restore(orders)
+        gc.disable()
+        try:
+            seq, last_ts = replay(self.journal.path, engine, after=journal_seq, book_after=book_seqs)
+        except Exception as e:
+            logging.exception(f"Failed to replay engine journal {self.journal.path}: {e}")
+            # Проигрывание могло успеть поменять ордера снапшота: берем его заново, остальное досчитает БД
+            high_water_mark, _, snapshot, _ = self._read_snapshot()
+            return high_water_mark, snapshot
+        finally:
+            gc.enable()
+        self.journal.seq = max([seq, *book_seqs.values()])
+        logging.info(f"Replayed engine journal {self.journal.path} from seq {journal_seq} up to seq {seq}")
+        return max(high_water_mark, last_ts), {ticker: [*book.get_bids(), *book.get_asks()] for ticker, book in engine.books.items()}
+
 
-        for ticker, book in books.items():
+    def _read_snapshot(self) -> tuple[int, int, dict[str, list[InternalOrder]], dict[str, int]]:
+        if not self.snapshot_path or not os.path.exists(self.snapshot_path):
+            return 0, 0, {}, {}
+        # Загрузка создает миллионы объектов без циклов, сборщик мусора тут только тратит время
+        gc.disable()
+        try:
+            return read_snapshot(self.snapshot_path)
+        except Exception as e:
+            # Битый снапшот не повод не стартовать: читаем книги из БД целиком
+            logging.exception(f"Failed to read orderbook snapshot {self.snapshot_path}: {e}")
+            return 0, 0, {}, {}
+        finally:
+            gc.enable()
+
+
+    async def _reconcile(self, session: AsyncSession, high_water_mark: int, books: list[BaseOrderBook]):
+        """Досчитывает восстановленные из снапшота или журнала книги по БД, не читая все открытые ордера:
+        ордера, измененные после отметки, приводятся к БД на своем месте в очереди; частично исполненные
+        в книге сверяются по filled; ордера удаленных пользователей убираются."""
+        by_ticker = {book.ticker: book for book in books}
+        since = ns_to_datetime(high_water_mark - int(self.snapshot_margin * 1_000_000_000))
+        changed = await OrderDAO.get_limit_orders_changed_since(session, since)
+        for order in changed:
+            book = by_ticker.get(order.ticker)
+            if book is None:
+                continue
+            if not book.sync_order(order.id.int, order.filled or 0, order.status) and \
+                    order.status in (StatusEnum.NEW, StatusEnum.PARTIALLY_EXECUTED):
+                book.add_limit_order(order)
+
+        # Книга могла уйти вперед БД: сведено в памяти, но сделка не проведена и updated_at не сдвинут.
+        # Такой ордер в книге исполнен частично, поэтому сверяем только их
+        synced = {order.id.int for order in changed}
+        ahead = [order for book in books for order in book.orders.values() if order.filled and order.id_int not in synced]
+        fills = {order_id.int: (filled or 0, status) for order_id, filled, status in
+                 await OrderDAO.get_order_fills(session, [order.id for order in ahead])}
+        for order in ahead:
+            book = by_ticker[order.ticker]
+            if order.id_int in fills:
+                book.sync_order(order.id_int, *fills[order.id_int])
+            else:
+                book.cancel_order(order)
+
+        # Каскадное удаление пользователя убирает его ордера, не сдвигая updated_at
+        owners = {order.user_id_int for book in books for order in book.orders.values()}
+        existing = {user_id.int for user_id in await UserDAO.get_existing_ids(session, [UUID(int=user_id) for user_id in owners])}
+        orphans = [order for book in books for order in book.orders.values() if order.user_id_int not in existing]
+        for order in orphans:
+            by_ticker[order.ticker].cancel_order(order)
+        logging.info(f"Reconciled orderbooks: {len(changed)} changed, {len(ahead)} partially filled checked, {len(orphans)} orphaned orders")
+
+
+    async def _apply_outbox(self, session: AsyncSession):
+        """Сделки из outbox уже сведены, но в БД ордера еще в старом состоянии: приводим книги
+        к состоянию после них, иначе те же объемы свелись бы повторно."""
+        pending = await SettlementOutboxDAO.get_pending_orders(session)
+        applied = 0
+        for book in self.books.values():
+            for order in [order for order in book.orders.values() if order.id in pending]:
+                filled, status = pending[order.id]
+                if filled <= order.filled:
+                    continue
+                book.cancel_order(order)
+                if status == StatusEnum.EXECUTED:
+                    continue
+                order.filled = filled
+                order.status = status
+                book.restore([order])
+                applied += 1
+        logging.info(f"Applied pending outbox executions: {len(pending)} orders, {applied} partially filled")
+
+
+    def _notify(self, book: BaseOrderBook):
+        """Обновляет множество пересеченных книг после добавления, исполнения или отмены
+        и будит актор пересеченной книги."""
+        if book.is_crossed():
+            self.crossed.add(book.ticker)
+            actor = self.actors.get(book.ticker)
+            if actor:
+                actor.notify()
+        else:
+            self.crossed.discard(book.ticker)
+
+
+    def _start_actor(self, ticker: str):
+        actor = BookActor(self, ticker, self.session_factory)
+        self.actors[ticker] = actor
+        actor.start()
+        if ticker in self.crossed:
+            actor.notify()
+
+
+    def start_actors(self, session_factory: Callable[[], AsyncSession]):
+        self.session_factory = session_factory
+        for ticker in self.books:
+            if ticker not in self.actors:
+                self._start_actor(ticker)
+
+
+    def stop_actors(self):
+        for actor in self.actors.values():
+            actor.stop()
+        self.actors.clear()
+        self.session_factory = None
+
+
+    async def match_book(self, session: AsyncSession, ticker: str):
+        """Сводит одну книгу и проводит сделки в `session`. Под замком книги,
+        чтобы циклы по одному тикеру не пересекались, другие тикеры не ждут."""
+        book = self.books.get(ticker)
+        if not book:
+            return
+        async with book.lock:
+            executions = self._match(book)
+            if executions and self.outbox:
+                await self.outbox.enqueue(session, executions)
+                logging.info(msg=f"Queued executions for settlement in orderbook {ticker}: {len(executions)}")
+            elif executions:
+                # Сделки проводятся в порядке исполнения: от него зависят время сделок и open/close свечей.
+                # От deadlock защищает lock_balances, который лочит строки в порядке (user_id, ticker)
+                await trade_executor.execute_trade(session, executions)
+                logging.info(msg=f"Executed orders in orderbook {ticker}: {len(executions)}")
+
+
+    def _match(self, book: BaseOrderBook) -> list[TradeExecution]:
+        if self.journal:
+            self.journal.match(book.ticker)
+        executions: list[TradeExecution] = book.matching_orders()
+        self._notify(book)
+        return executions
+
+
+    async def match_book_grouped(self, ticker: str):
+        """Сводит книгу и отдает сделки в групповой commit. Замок книги держим только до постановки
+        в очередь: очередь FIFO, так что следующий цикл этого тикера не обгонит предыдущий."""
+        book = self.books.get(ticker)
+        if not book:
+            return
+        async with book.lock:
+            executions = self._match(book)
+            if not executions:
+                return
+            committed = self.settlement.submit(executions)
+        await committed
+        logging.info(msg=f"Executed orders in orderbook {ticker}: {len(executions)}")
+
+
+    async def match_all(self, session: AsyncSession):
+        # Только книги, где действительно есть что сводить: O(пересеченных книг), а не всех инструментов
+        for ticker in list(self.crossed):
             try:
-                executions: list[TradeExecution] = book.matching_orders()
-                # Сортируем по buyer_id и seller_id для минимизации deadlocks
-                sorted_executions = sorted(
-                    executions,
-                    key=lambda x: (x.bid_order.user_id, x.ask_order.user_id)
-                )
-                if executions: 
-                    await trade_executor.execute_trade(session, sorted_executions)
-                    logging.info(msg=f"Executed orders in orderbook {ticker}: {len(executions)}")
+                await self.match_book(session, ticker)
             except Exception as e:
                 logging.info(f"Matching error for {ticker}: {e}")
                 continue
 
 
 async def run_matching_engine(engine: MatchingEngine, session_factory: Callable[[], AsyncSession]):
-    while True:
-        try:
-            async with session_factory() as session:
-                try:
-                    async with session.begin():
-                        await engine.match_all(session)
-                except Exception as match_err:
-                    logging.exception(f"Error during order matching: {match_err}")
-        except Exception as session_err:
-            logging.exception(f"Error creating session: {session_err}")
-
-        # await asyncio.sleep(engine.interval)
\ No newline at end of file
+    """Запускает акторы книг и живет, пока его не отменят. Каждый актор спит до пересечения
+    своей книги и берет соединение из пула только когда есть что сводить."""
+    if engine.settlement:
+        engine.settlement.start(session_factory)
+    if engine.outbox:
+        engine.outbox.start(session_factory)
+    engine.start_actors(session_factory)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        engine.stop_actors()
+        if engine.settlement:
+            await engine.settlement.stop()
+        if engine.outbox:
+            engine.outbox.stop()
\ No newline at end of file
@@ -1,82 +1,135 @@
 import asyncio
+import contextlib
 import logging
 import time
 from uuid import UUID
 from schemas.response import OkResponse, CreateOrderResponse, MarketOrderResponse, LimitOrderResponse, convert_order
-from schemas.request import OrderRequest, LimitOrderRequest, MarketOrderRequest
+from schemas.request import BalanceRequest, OrderRequest, LimitOrderRequest, MarketOrderRequest
 from schemas.create import LimitOrderCreate, MarketOrderCreate
 from typing import List
 from misc.enums import DirectionEnum, OrderEnum, StatusEnum
-from dao.dao import OrderDAO, BalanceDAO
+from dao.dao import OrderDAO, BalanceDAO, SettlementOutboxDAO
 from sqlalchemy.ext.asyncio import AsyncSession
 from fastapi import HTTPException
 from services.engine import matching_engine
-from services.trade_execution import trade_executor
+from misc.internal_classes import TradeExecution
+from services.trade_execution import NotEnoughFunds, trade_executor
 
 
 async def create_market_order(session: AsyncSession, user_id: UUID, order_data: MarketOrderRequest) -> CreateOrderResponse:
-    async with session.begin():
-        ticker = order_data.ticker if order_data.direction == DirectionEnum.SELL else "RUB"
-        
-        user_balance = await BalanceDAO.get_balance_with_lock(session, user_id, ticker)
-        if not user_balance:
-            raise HTTPException(400, f"Balance {ticker} not found")
-        
-        market_order = await OrderDAO.add(
-            session,
-            MarketOrderCreate(
-                user_id=user_id,
-                direction=order_data.direction,
-                ticker=order_data.ticker,
-                qty=order_data.qty,
-                order_type=OrderEnum.MARKET
-            ))
-
-        executions = matching_engine.add_market_order(order=market_order, balance=user_balance.amount)
-        
-        # Сортируем по buyer_id и seller_id для минимизации deadlocks
-        sorted_executions = sorted(
-            executions,
-            key=lambda x: (x.bid_order.user_id, x.ask_order.user_id)
-        )
-
-        if not executions:
-            logging.info("Order execution failed. Not enough offers")
-            raise HTTPException(400, "Order execution failed. Not enough offers") 
-        
-        # Блокируем средства
-        if not (await block_funds(session, user_id, market_order, executions)):
+    ticker = order_data.ticker if order_data.direction == DirectionEnum.SELL else "RUB"
+    market_order = None
+    executions: list[TradeExecution] = []
+
+    # Книгу держим от сопоставления до commit, как цикл актора: если проведение не удалось,
+    # сделки откатываются в книге, пока ее никто больше не трогал. Замок берем до блокировок строк БД
+    async with matching_engine.book_lock(order_data.ticker):
+        try:
+            async with session.begin():
+                ledger = trade_executor.ledger
+                if ledger:
+                    # Резервируем весь доступный остаток сразу, без await между чтением и резервом; лишнее вернем после сопоставления
+                    user_balance = ledger.get(user_id, ticker)
+                    available = user_balance[0] if user_balance else None
+                    if available and not ledger.block(session, user_id, ticker, available):
+                        available = None
+                else:
+                    # Остаток читаем без блокировки: он только ограничивает сопоставление. Средства проверяются
+                    # и блокируются под одной блокировкой со строками встречных сторон
+                    user_balance = await BalanceDAO.find_one_or_none(session, BalanceRequest(user_id=user_id, ticker=ticker))
+                    available = user_balance.amount if user_balance else None
+                if available is None:
+                    raise HTTPException(400, f"Balance {ticker} not found")
+
+                market_order = await OrderDAO.add(
+                    session,
+                    MarketOrderCreate(
+                        user_id=user_id,
+                        direction=order_data.direction,
+                        ticker=order_data.ticker,
+                        qty=order_data.qty,
+                        order_type=OrderEnum.MARKET
+                    ))
+
+                executions = matching_engine.add_market_order(order=market_order, balance=available)
+
+                if not executions:
+                    logging.info("Order execution failed. Not enough offers")
+                    raise HTTPException(400, "Order execution failed. Not enough offers") 
+
+                required = required_funds(market_order, executions)
+                if ledger:
+                    # Остаток сверх нужного сделкам возвращаем
+                    if available > required:
+                        ledger.unblock(session, user_id, ticker, available - required)
+                elif matching_engine.outbox or matching_engine.settlement:
+                    # Сделки проводятся позже: здесь блокируется только строка пользователя, одним UPDATE
+                    if not (await block_funds(session, user_id, market_order, executions)):
+                        raise NotEnoughFunds(f"Not enough {ticker}")
+
+                if matching_engine.outbox:
+                    # Сделки фиксируются в outbox той же транзакцией, что ордер и блокировка средств
+                    await matching_engine.outbox.enqueue(session, executions)
+                elif not matching_engine.settlement:
+                    # Строка пользователя блокируется вместе со строками встречных сторон, в одном порядке
+                    # и под savepoint с повтором при deadlock
+                    await trade_executor.execute_trade(
+                        session, executions, reserve=None if ledger else (user_id, ticker, required))
+
+                    if market_order.status != StatusEnum.EXECUTED or market_order.filled != market_order.qty:
+                        logging.error(f"Ошибка в маркет ордере. {market_order.filled, market_order.status}") 
+                        raise HTTPException(500, "Desync error") 
+                else:
+                    # Сделки пишутся в outbox вместе с ордером и блокировкой средств: если процесс упадет
+                    # до commit пачки, их проведет следующий старт
+                    outbox_ids = await SettlementOutboxDAO.add_executions(session, executions)
+        except NotEnoughFunds:
+            matching_engine.undo_market_order(market_order, executions)
             logging.info(f"Order execution failed. Not enough {ticker}")
             raise HTTPException(400, f"Order execution failed. Not enough {ticker}")
+        except BaseException:
+            matching_engine.undo_market_order(market_order, executions)
+            raise
 
-        
-        await trade_executor.execute_trade(session, sorted_executions)
-        
-        if market_order.status != StatusEnum.EXECUTED or market_order.filled != market_order.qty:
-            logging.error(f"Ошибка в маркет ордере. {market_order.filled, market_order.status}") 
-            raise HTTPException(500, "Desync error") 
-            
-        return CreateOrderResponse(success=True, order_id=market_order.id)
+        if matching_engine.settlement:
+            # Групповой commit: ордер, блокировка и сделки в outbox уже зафиксированы, ответ от пачки не зависит.
+            # Не проведенное пачкой batcher проводит из outbox. В очередь - пока держим книгу:
+            # очередь FIFO, цикл актора этого тикера не обгонит ордер
+            matching_engine.settlement.submit(executions, outbox_ids)
+    return CreateOrderResponse(success=True, order_id=market_order.id)
 
 
 async def block_funds(session, user_id, market_order, executions) -> bool:
+    ticker = "RUB" if market_order.direction == DirectionEnum.BUY else market_order.ticker
+    return await block_balance(session, user_id=user_id, ticker=ticker, amount=required_funds(market_order, executions))
+
+
+def required_funds(market_order, executions) -> int:
+    # Рубли на покупку или токены на продажу
     if market_order.direction == DirectionEnum.BUY:
-        required_rub = sum(
-                execution.executed_qty * execution.execution_price
-                for execution in executions
-            )
-        return await BalanceDAO.block_balance(session, user_id=user_id, ticker="RUB", amount=required_rub)
-    else:
-        required_tockens = sum(
-                execution.executed_qty
-                for execution in executions
-            )
-        return await BalanceDAO.block_balance(session, user_id=user_id, ticker=market_order.ticker, amount=required_tockens)
+        return sum(execution.executed_qty * execution.execution_price for execution in executions)
+    return sum(execution.executed_qty for execution in executions)
+
+
+async def block_balance(session: AsyncSession, user_id: UUID, ticker: str, amount: int) -> bool:
+    # С балансами в памяти резерв ставится без запроса и блокировки строки в БД.
+    # Кэш балансов не сбрасываем: резерв переносит средства внутри строки, а GET /balance отдает их сумму
+    if trade_executor.ledger:
+        return trade_executor.ledger.block(session, user_id, ticker, amount)
+    return await BalanceDAO.block_balance(session, user_id, ticker, amount)
+
+
+async def unblock_balance(session: AsyncSession, user_id: UUID, ticker: str, amount: int) -> bool:
+    if trade_executor.ledger:
+        return trade_executor.ledger.unblock(session, user_id, ticker, amount)
+    return await BalanceDAO.unblock_balance(session, user_id, ticker, amount)
 
 
 async def create_limit_order(session: AsyncSession, user_id: UUID, order_data: LimitOrderRequest) -> CreateOrderResponse:
-    async with session.begin():
-        # TODO Возможно стоит запускать match_all тут, но не будет ли это очень затратно? Нет это не нужно: вызывваает дедлоки.
+    # Сводя книгу при добавлении, запрос пишет в нее так же, как цикл актора: держим замок книги до commit,
+    # взяв его раньше блокировок строк. Простое добавление в книгу не меняет ордера, которые сейчас проводятся
+    lock = matching_engine.book_lock(order_data.ticker) if matching_engine.inline_matching else contextlib.nullcontext()
+    async with lock, session.begin():
         # Определяем что и скольк тратим
         if order_data.direction == DirectionEnum.SELL:
             ticker = order_data.ticker
@@ -85,7 +138,7 @@ async def create_limit_order(session: AsyncSession, user_id: UUID, order_data: L
             ticker = "RUB"
             amount = order_data.qty * order_data.price
 
-        if not await BalanceDAO.block_balance(session, user_id, ticker, amount):
+        if not await block_balance(session, user_id, ticker, amount):
             raise HTTPException(400, f"Not enough {ticker}. {amount} required.")
         
         limit_order = await OrderDAO.add(session, 
@@ -96,7 +149,12 @@ async def create_limit_order(session: AsyncSession, user_id: UUID, order_data: L
                                         qty=order_data.qty,
                                         price=order_data.price
                                     ))
-        matching_engine.add_limit_order(limit_order)
+        # В режиме inline_matching пересекающий книгу ордер исполняется сразу, в этой же транзакции
+        executions = matching_engine.add_limit_order(limit_order)
+        if executions and matching_engine.outbox:
+            await matching_engine.outbox.enqueue(session, executions)
+        elif executions:
+            await trade_executor.execute_trade(session, executions)
         return CreateOrderResponse(success=True, order_id=limit_order.id)
 
 
@@ -133,8 +191,11 @@ async def cancel_order(session: AsyncSession, user_id: UUID, order_id: UUID) ->
             await session.refresh(order)
             if order.status not in (StatusEnum.NEW, StatusEnum.PARTIALLY_EXECUTED):
                 break
+            book_order = matching_engine.get_order(order.ticker, order.id)
             if matching_engine.cancel_order(order):
                 order_cancelled = True
+                # Книга может опережать БД (сделки ждут в outbox): уже сведенный объем не разблокируем
+                order.filled = max(order.filled or 0, book_order.filled)
                 break
             await asyncio.sleep(0.1) # Даем время TradeExecutor для обновления
 
@@ -152,7 +213,7 @@ async def cancel_order(session: AsyncSession, user_id: UUID, order_id: UUID) ->
             ticker = order.ticker
             amount = order.qty - order.filled
             
-        if not await BalanceDAO.unblock_balance(session, user_id, ticker, amount):
+        if not await unblock_balance(session, user_id, ticker, amount):
             raise HTTPException(400, f"Not enough blocked {ticker}.")
         order.status = StatusEnum.CANCELLED
 
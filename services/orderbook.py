@@ -1,66 +1,96 @@
-from sortedcontainers import SortedList
+import asyncio
+from collections import OrderedDict
+from itertools import islice
+from bisect import bisect_left
+from operator import attrgetter, neg, pos
+from typing import Callable, Iterable, Iterator
+from sortedcontainers import SortedDict, SortedList
 from misc.enums import DirectionEnum, StatusEnum
 from misc.internal_classes import InternalOrder, TradeExecution
 from misc.db_models import Order
 import logging
 
 
-class OrderBook():
+def _to_internal(order: Order | InternalOrder) -> InternalOrder:
+    # Движок с журналом конвертирует ордер сам, чтобы записать ровно то, что попало в книгу
+    return order if isinstance(order, InternalOrder) else InternalOrder.from_db(order)
+
+
+class BaseOrderBook():
+    """Общая логика сопоставления. Хранилище ордеров определяют наследники через
+    `_add`, `_remove`, `_best` и `_iter_side`."""
+
     def __init__(self, ticker: str):
         self.ticker = ticker
-        self.bids: SortedList[InternalOrder] = SortedList(key=lambda order: (-order.price, order.timestamp)) # Покупание
-        self.asks: SortedList[InternalOrder] = SortedList(key=lambda order: (order.price, order.timestamp)) # Продавание
-        self.has_activity = False
-    
+        self.orders: dict[int, InternalOrder] = {} # Индекс id (UUID.int) -> ордер, сторону берем из order.direction
+        self.lock = asyncio.Lock() # Держит актор книги на время сопоставления и проведения сделок
+        self.cumulative: dict[DirectionEnum, CumulativeDepth] = {
+            direction: CumulativeDepth(
+                items=lambda direction=direction: self._depth_items(direction),
+                key=neg if direction == DirectionEnum.BUY else pos)
+            for direction in (DirectionEnum.BUY, DirectionEnum.SELL)
+        }
+
 
     def cancel_order(self, cancel_order: Order) -> bool:
-        self.has_activity = True
-        for order in self.asks:
-            if cancel_order.id == order.id:
-                self.asks.discard(order)
-                return True
-        
-        for order in self.bids:
-            if cancel_order.id == order.id:
-                self.bids.discard(order)
-                return True
-            
-        return False
-
-
-    def add_limit_order(self, new_order: Order):
-        self.has_activity = True
-        if new_order.direction == DirectionEnum.BUY:
-            self.bids.add(InternalOrder.from_db(new_order))
-        else:
-            self.asks.add(InternalOrder.from_db(new_order))
+        order = self.orders.get(cancel_order.id.int)
+        if order is None:
+            return False
+
+        self._remove(order)
+        return True
 
+
+    def add_limit_order(self, new_order: Order | InternalOrder, match: bool = False) -> list[TradeExecution]:
+        """Кладет ордер в книгу. При `match=True` сразу сводит книгу, если ордер ее пересек."""
+        self._add(_to_internal(new_order))
+        if match:
+            return self.matching_orders()
         return []
 
 
-    def add_market_order(self, new_order: Order, balance: int) -> list[TradeExecution]:
-        self.has_activity = True
-        order = InternalOrder.from_db(new_order)
+    def add_market_order(self, new_order: Order | InternalOrder, balance: int) -> list[TradeExecution]:
+        order = _to_internal(new_order)
         if self._can_execute_market_order(order, balance):
             return self._execute_market_order(order)
 
         return []
 
 
-    def _can_execute_market_order(self, new_order: InternalOrder, balance: int):
-        book: SortedList[InternalOrder] = self.asks if new_order.direction == DirectionEnum.BUY else self.bids
-        total_cost = 0 # сколько РУБЛЕЙ потратим или получим
-        available_qty = 0 # сколько токенов доступно в стакане
-        remaining_qty = new_order.qty
+    def sync_order(self, order_id_int: int, filled: int, status: StatusEnum) -> bool:
+        """Приводит лежащий в книге ордер к `filled` и `status` (из БД) на его месте в очереди.
+        Закрытый ордер убирается. False - такого ордера в книге нет."""
+        order = self.orders.get(order_id_int)
+        if order is None:
+            return False
+        if status not in (StatusEnum.NEW, StatusEnum.PARTIALLY_EXECUTED):
+            self._remove(order)
+            return True
+        delta = filled - order.filled
+        order.filled = filled
+        order.status = status
+        if delta:
+            self._on_fill(order, delta)
+        return True
+
+
+    def undo_market_order(self, executions: list[TradeExecution]):
+        """Откатывает в книге сделки рыночного ордера, проведение которых не удалось: встречные ордера
+        возвращают исполненный объем, снятые с книги встают обратно в голову своей очереди."""
+        for execution in reversed(executions):
+            # У рыночного ордера нет цены, встречный - второй участник сделки
+            order = execution.ask_order if execution.bid_order.price is None else execution.bid_order
+            order.filled -= execution.executed_qty
+            order.status = StatusEnum.PARTIALLY_EXECUTED if order.filled else StatusEnum.NEW
+            if order.id_int in self.orders:
+                self._on_fill(order, -execution.executed_qty)
+            else:
+                self._add_front(order)
 
-        for order in book:
-            if remaining_qty <= 0:
-                break
 
-            trade_qty = min(order.remaining, remaining_qty)
-            available_qty += trade_qty
-            total_cost += trade_qty * order.price
-            remaining_qty -= trade_qty
+    def _can_execute_market_order(self, new_order: InternalOrder, balance: int):
+        # сколько токенов доступно в стакане и сколько РУБЛЕЙ потратим или получим
+        available_qty, total_cost = self.fill_cost(new_order.direction, new_order.qty)
 
         # Недостаточно ордеров на нужное кол-во
         if available_qty < new_order.qty:
@@ -72,7 +102,7 @@ class OrderBook():
             if balance < total_cost:
                 logging.info("Not enough balance. Market order denied")
                 return False
-        else: 
+        else:
             # Нужно достаточно самих токенов
             if balance < new_order.qty:
                 logging.info("Not enough balance. Market order denied")
@@ -83,11 +113,10 @@ class OrderBook():
 
     def _execute_market_order(self, new_order: InternalOrder) -> list[TradeExecution]:
         trades = []
-        book = self.asks if new_order.direction == DirectionEnum.BUY else self.bids
-        i = 0
-        while i < len(book):
-            existed_order = book[i]
-            if new_order.status == StatusEnum.EXECUTED:
+        opposite = DirectionEnum.SELL if new_order.direction == DirectionEnum.BUY else DirectionEnum.BUY
+        while new_order.status != StatusEnum.EXECUTED:
+            existed_order = self._best(opposite)
+            if existed_order is None:
                 break
 
             # Определяем bid и ask в зависимости от направления ордера
@@ -98,11 +127,11 @@ class OrderBook():
 
             trade = self._execute_trade(bid=bid, ask=ask)
             trades.append(trade)
+            self._on_fill(existed_order, trade.executed_qty)
 
+            # Частично исполненный встречный ордер означает, что рыночный исполнен полностью
             if existed_order.status == StatusEnum.EXECUTED:
-                book.remove(existed_order)
-            else:
-                i+=1
+                self._remove(existed_order)
 
         return trades
 
@@ -110,21 +139,20 @@ class OrderBook():
     def matching_orders(self) -> list[TradeExecution]:
         trades: list[TradeExecution] = []
 
-        while self.bids and self.asks and self.bids[0].price >= self.asks[0].price:
-            bid: InternalOrder = self.bids[0] # Покупание
-            ask: InternalOrder = self.asks[0] # Продавание
+        while self.is_crossed():
+            bid = self._best(DirectionEnum.BUY) # Покупание
+            ask = self._best(DirectionEnum.SELL) # Продавание
 
             trade = self._execute_trade(bid=bid, ask=ask)
             trades.append(trade)
+            self._on_fill(bid, trade.executed_qty)
+            self._on_fill(ask, trade.executed_qty)
 
             if bid.status == StatusEnum.EXECUTED:
-                self.bids.pop(0) # Сначала удаляется, потом обновляется в БД.
+                self._remove(bid) # Сначала удаляется, потом обновляется в БД.
 
             if ask.status == StatusEnum.EXECUTED:
-                self.asks.pop(0)
-
-        if trades:
-            self.has_activity = False # Только если действительно что-то исполнилось
+                self._remove(ask)
 
         return trades
 
@@ -158,22 +186,359 @@ class OrderBook():
     def _update_status(self, order:InternalOrder):
         if order.filled == order.qty:
             order.status = StatusEnum.EXECUTED
-        else: 
+        else:
             order.status = StatusEnum.PARTIALLY_EXECUTED
 
 
+    def is_crossed(self) -> bool:
+        """Лучший bid >= лучшего ask, то есть в книге есть что сводить."""
+        bid = self._best(DirectionEnum.BUY)
+        ask = self._best(DirectionEnum.SELL)
+        return bid is not None and ask is not None and bid.price >= ask.price
+
+
+    def fill_cost(self, direction: DirectionEnum, qty: int) -> tuple[int, int]:
+        """Сколько можно исполнить (не больше `qty`) и за сколько рублей для ордера направления `direction`
+        по встречной стороне книги. Бинарный поиск по накопленной глубине, O(log n) уровней."""
+        opposite = DirectionEnum.SELL if direction == DirectionEnum.BUY else DirectionEnum.BUY
+        return self.cumulative[opposite].fill_cost(qty)
+
+
+    def get_depth(self, direction: DirectionEnum, limit: int) -> list[tuple[int, int]]:
+        """L2 срез стороны: до `limit` лучших уровней (цена, остаток). Стоит O(limit)."""
+        return list(islice(self._depth_items(direction), limit))
+
+
     def load_orderbook(self, orders: list[Order]):
+        self.restore(InternalOrder.from_db(order) for order in orders)
+
+
+    def restore(self, orders: Iterable[InternalOrder]):
+        """Кладет в книгу готовые ордера (из БД или снапшота) без сопоставления.
+        Порядок на входе произвольный, очередь на цене строим по времени."""
+        for order in sorted(orders, key=attrgetter("ts_ns")):
+            self._add(order)
+
+
+    def _add(self, order: InternalOrder):
+        raise NotImplementedError
+
+
+    def _remove(self, order: InternalOrder):
+        raise NotImplementedError
+
+
+    def _add_front(self, order: InternalOrder):
+        """Возвращает снятый ордер в голову очереди его цены."""
+        # Очередь упорядочена по времени, ордер и так встает перед более поздними
+        self._add(order)
+
+
+    def _best(self, direction: DirectionEnum) -> InternalOrder | None:
+        raise NotImplementedError
+
+
+    def _iter_side(self, direction: DirectionEnum) -> Iterator[InternalOrder]:
+        raise NotImplementedError
+
+
+    def _on_fill(self, order: InternalOrder, qty: int):
+        """Вызывается после частичного или полного исполнения лежащего в книге ордера."""
+        pass
+
+
+    def _depth_items(self, direction: DirectionEnum) -> Iterator[tuple[int, int]]:
+        raise NotImplementedError
+
+
+class CumulativeDepth():
+    """Накопленные количество и объем (цена * количество) по ценовым уровням одной стороны.
+    Дерево Фенвика по позиции цены среди цен, уже известных индексу. Исчезнувший уровень остается
+    в индексе с нулевым остатком, поэтому изменение остатка, исчезновение уровня и его повторное
+    появление стоят O(log n). Индекс перестраивается за O(n) лениво, при следующем запросе:
+    когда появилась цена, которой в нем нет (одна перестройка на все такие цены между запросами),
+    или когда пустых позиций стало больше, чем живых."""
+
+    def __init__(self, items: Callable[[], Iterator[tuple[int, int]]], key: Callable[[int], int]):
+        self._items = items # уровни стороны (цена, остаток) от лучшего
+        self._key = key # ключ цены, возрастающий от лучшего уровня
+        self.valid = False
+        self.keys: list[int] = []
+        self.prices: list[int] = []
+        self.qty: list[int] = [] # остаток по позиции, чтобы знать пустые
+        self.empty = 0
+        self.qty_tree: list[int] = [0]
+        self.notional_tree: list[int] = [0]
+
+
+    def invalidate(self):
+        self.valid = False
+
+
+    def update(self, price: int, qty: int):
+        if not self.valid:
+            return
+        key = self._key(price)
+        i = bisect_left(self.keys, key)
+        if i == len(self.keys) or self.keys[i] != key:
+            self.valid = False # Новая цена сдвигает позиции
+            return
+        before = self.qty[i]
+        self.qty[i] = before + qty
+        if not before:
+            self.empty -= 1
+        elif not self.qty[i]:
+            self.empty += 1
+            if self.empty > len(self.keys) - self.empty + 32:
+                self.valid = False # Сжимаем до живых уровней
+                return
+        i += 1
+        notional = qty * price
+        n = len(self.keys)
+        while i <= n:
+            self.qty_tree[i] += qty
+            self.notional_tree[i] += notional
+            i += i & -i
+
+
+    def _rebuild(self):
+        self.keys = []
+        self.prices = []
+        self.qty = []
+        self.empty = 0
+        self.qty_tree = [0]
+        self.notional_tree = [0]
+        for price, qty in self._items():
+            self.keys.append(self._key(price))
+            self.prices.append(price)
+            self.qty.append(qty)
+            self.qty_tree.append(qty)
+            self.notional_tree.append(qty * price)
+
+        n = len(self.prices)
+        for i in range(1, n + 1):
+            parent = i + (i & -i)
+            if parent <= n:
+                self.qty_tree[parent] += self.qty_tree[i]
+                self.notional_tree[parent] += self.notional_tree[i]
+        self.valid = True
+
+
+    def fill_cost(self, qty: int) -> tuple[int, int]:
+        """(количество, объем) для исполнения `qty` от лучшего уровня. Если глубины не хватает,
+        количество меньше `qty`."""
+        if not self.valid:
+            self._rebuild()
+
+        n = len(self.prices)
+        pos = 0 # сколько уровней забираем целиком
+        cum_qty = 0
+        cum_notional = 0
+        step = 1 << (n.bit_length() - 1) if n else 0
+        while step:
+            nxt = pos + step
+            if nxt <= n and cum_qty + self.qty_tree[nxt] < qty:
+                pos = nxt
+                cum_qty += self.qty_tree[nxt]
+                cum_notional += self.notional_tree[nxt]
+            step >>= 1
+
+        if pos == n:
+            return cum_qty, cum_notional
+        return qty, cum_notional + (qty - cum_qty) * self.prices[pos]
+
+
+class OrderBook(BaseOrderBook):
+    """Все ордера стороны в одном SortedList по ключу (цена, время)."""
+
+    def __init__(self, ticker: str):
+        super().__init__(ticker)
+        self.bids: SortedList[InternalOrder] = SortedList(key=lambda order: (-order.price, order.ts_ns)) # Покупание
+        self.asks: SortedList[InternalOrder] = SortedList(key=lambda order: (order.price, order.ts_ns)) # Продавание
+        # Агрегированный остаток по ценам, обновляется при добавлении, исполнении и отмене
+        self.bid_depth: SortedDict[int, int] = SortedDict(neg)
+        self.ask_depth: SortedDict[int, int] = SortedDict()
+
+
+    def _side(self, direction: DirectionEnum) -> SortedList[InternalOrder]:
+        return self.bids if direction == DirectionEnum.BUY else self.asks
+
+
+    def _depth(self, direction: DirectionEnum) -> SortedDict:
+        return self.bid_depth if direction == DirectionEnum.BUY else self.ask_depth
+
+
+    def _add(self, order: InternalOrder):
+        self._side(order.direction).add(order)
+        depth = self._depth(order.direction)
+        if order.price in depth:
+            depth[order.price] += order.remaining
+        else:
+            depth[order.price] = order.remaining
+        self.cumulative[order.direction].update(order.price, order.remaining)
+        self.orders[order.id_int] = order
+
+
+    def restore(self, orders: Iterable[InternalOrder]):
+        # Пачкой: одна сортировка стороны и глубины вместо вставки каждого ордера
+        by_side: dict[DirectionEnum, list[InternalOrder]] = {DirectionEnum.BUY: [], DirectionEnum.SELL: []}
         for order in orders:
-            internal = InternalOrder.from_db(order)
-            if internal.direction == DirectionEnum.BUY:
-                self.bids.add(internal)
-            else:
-                self.asks.add(internal)
+            by_side[order.direction].append(order)
+            self.orders[order.id_int] = order
+        for direction, side_orders in by_side.items():
+            if not side_orders:
+                continue
+            self._side(direction).update(side_orders)
+            levels: dict[int, int] = {}
+            for order in side_orders:
+                levels[order.price] = levels.get(order.price, 0) + order.remaining
+            depth = self._depth(direction)
+            depth.update({price: depth.get(price, 0) + qty for price, qty in levels.items()})
+            self.cumulative[direction].invalidate()
+
+
+    def _remove(self, order: InternalOrder):
+        side = self._side(order.direction)
+        if side[0] is order:
+            side.pop(0)
+        else:
+            side.remove(order)
+        self._reduce_depth(order, order.remaining)
+        del self.orders[order.id_int]
+
+
+    def _on_fill(self, order: InternalOrder, qty: int):
+        self._reduce_depth(order, qty)
+
+
+    def _reduce_depth(self, order: InternalOrder, qty: int):
+        if not qty:
+            return
+        depth = self._depth(order.direction)
+        left = depth[order.price] - qty
+        if left:
+            depth[order.price] = left
+        else:
+            del depth[order.price]
+        self.cumulative[order.direction].update(order.price, -qty)
+
+
+    def _depth_items(self, direction: DirectionEnum) -> Iterator[tuple[int, int]]:
+        return iter(self._depth(direction).items())
+
+
+    def _best(self, direction: DirectionEnum) -> InternalOrder | None:
+        side = self._side(direction)
+        return side[0] if side else None
+
+
+    def _iter_side(self, direction: DirectionEnum) -> Iterator[InternalOrder]:
+        return iter(self._side(direction))
+
 
-    
     def get_bids(self) -> SortedList[InternalOrder]:
         return self.bids
-    
+
 
     def get_asks(self) -> SortedList[InternalOrder]:
-        return self.asks
\ No newline at end of file
+        return self.asks
+
+
+class PriceLevel():
+    """Ценовой уровень: FIFO очередь ордеров и суммарный остаток по ним.
+    Очередь - OrderedDict по id: голова и удаление из середины (отмена) за O(1)."""
+    __slots__ = ("price", "orders", "qty")
+
+    def __init__(self, price: int):
+        self.price = price
+        self.orders: OrderedDict[int, InternalOrder] = OrderedDict()
+        self.qty = 0
+
+
+class PriceLevelOrderBook(BaseOrderBook):
+    """Книга из отсортированных ценовых уровней. Ключи сравниваются по цене,
+    а не по (цена, время) для каждого ордера, поэтому вставка и исполнение дешевле,
+    когда много ордеров стоят на немногих ценах."""
+
+    def __init__(self, ticker: str):
+        super().__init__(ticker)
+        self.bid_levels: SortedDict[int, PriceLevel] = SortedDict(neg) # Покупание, лучшая цена - максимальная
+        self.ask_levels: SortedDict[int, PriceLevel] = SortedDict() # Продавание
+
+
+    def _levels(self, direction: DirectionEnum) -> SortedDict:
+        return self.bid_levels if direction == DirectionEnum.BUY else self.ask_levels
+
+
+    def _add(self, order: InternalOrder):
+        levels = self._levels(order.direction)
+        level = levels.get(order.price)
+        if level is None:
+            level = levels[order.price] = PriceLevel(order.price)
+        self.cumulative[order.direction].update(order.price, order.remaining)
+        level.orders[order.id_int] = order
+        level.qty += order.remaining
+        self.orders[order.id_int] = order
+
+
+    def _add_front(self, order: InternalOrder):
+        # Уровень - FIFO по вставке, поэтому голову выставляем явно
+        self._add(order)
+        self._levels(order.direction)[order.price].orders.move_to_end(order.id_int, last=False)
+
+
+    def _remove(self, order: InternalOrder):
+        levels = self._levels(order.direction)
+        level: PriceLevel = levels[order.price]
+        del level.orders[order.id_int]
+        level.qty -= order.remaining
+        if not level.orders:
+            del levels[order.price]
+        if order.remaining:
+            self.cumulative[order.direction].update(order.price, -order.remaining)
+        del self.orders[order.id_int]
+
+
+    def _on_fill(self, order: InternalOrder, qty: int):
+        self._levels(order.direction)[order.price].qty -= qty
+        self.cumulative[order.direction].update(order.price, -qty)
+
+
+    def _best(self, direction: DirectionEnum) -> InternalOrder | None:
+        levels = self._levels(direction)
+        if not levels:
+            return None
+        return next(iter(levels.peekitem(0)[1].orders.values()))
+
+
+    def _iter_side(self, direction: DirectionEnum) -> Iterator[InternalOrder]:
+        for level in self._levels(direction).values():
+            yield from level.orders.values()
+
+
+    def _depth_items(self, direction: DirectionEnum) -> Iterator[tuple[int, int]]:
+        return ((price, level.qty) for price, level in self._levels(direction).items())
+
+
+    @property
+    def bids(self) -> list[InternalOrder]:
+        return list(self._iter_side(DirectionEnum.BUY))
+
+
+    @property
+    def asks(self) -> list[InternalOrder]:
+        return list(self._iter_side(DirectionEnum.SELL))
+
+
+    def get_bids(self) -> list[InternalOrder]:
+        return self.bids
+
+
+    def get_asks(self) -> list[InternalOrder]:
+        return self.asks
+
+
+ORDERBOOK_TYPES: dict[str, type[BaseOrderBook]] = {
+    "sorted": OrderBook,
+    "levels": PriceLevelOrderBook,
+}
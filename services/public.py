@@ -1,13 +1,20 @@
-from schemas.response import UserResponse, InstrumentResponse, TransactionResponse, L2OrderBook
-from schemas.request import NewUserRequest, TransactionRequest
+from schemas.response import UserResponse, InstrumentResponse, TransactionResponse, CandleResponse, L2OrderBook
+from schemas.request import NewUserRequest, TransactionRequest, CandleRequest
 from schemas.create import UserCreate, BalanceCreate
-from dao.dao import UserDAO, InstrumentDAO, TransactionDAO, BalanceDAO
-from uuid import uuid4
+from dao.dao import UserDAO, InstrumentDAO, TransactionDAO, BalanceDAO, CandleDAO
+from uuid import UUID, uuid4
+from datetime import datetime
 from misc.enums import RoleEnum
-from misc.db_models import Instrument
+from misc.db_models import Instrument, Transaction
 from sqlalchemy.ext.asyncio import AsyncSession
 from typing import List
 from services.engine import matching_engine
+from services.trade_execution import trade_executor
+from services.tape import TapeTrade
+from services.candles import RESOLUTIONS
+from dataclasses import dataclass
+from fastapi import HTTPException
+import base64
 import logging
 
 
@@ -20,6 +27,8 @@ async def register_user(new_user_model: NewUserRequest, session: AsyncSession) -
     async with session.begin():
         user = await UserDAO.add(session, user_model)
         await BalanceDAO.add(session, BalanceCreate(user_id=user.id, ticker='RUB'))
+        if trade_executor.ledger:
+            trade_executor.ledger.apply(session, {(user.id, "RUB"): [0, 0]})
         logging.info(f"Added new user {user.name} {user.id}")
         return UserResponse.model_validate(user)
 
@@ -36,8 +45,76 @@ async def get_orderbook(ticker: str, limit: int) -> L2OrderBook:
     
 
 async def get_transactions_history(session: AsyncSession, filter_model: TransactionRequest, limit: int = 10) -> List[TransactionResponse]:
-    transactions = await TransactionDAO.find_all(session, filter_model, limit)
+    page = await get_transactions_page(session, filter_model, limit)
+    return page.transactions
+
+
+@dataclass(slots=True)
+class TransactionPage:
+    transactions: List[TransactionResponse]
+    before: str | None = None # Курсор более старых сделок
+    after: str | None = None # Курсор более новых сделок
+    seq: int | None = None # Номер ленты, который поллер передаст как `since` в следующий раз
+    reset: bool = False # `since` старше ленты: отдана последняя страница из БД, пропуск дочитывать курсорами
+
+
+async def get_transactions_page(
+        session: AsyncSession,
+        filter_model: TransactionRequest,
+        limit: int = 10,
+        before: str | None = None,
+        after: str | None = None,
+        since: int | None = None) -> TransactionPage:
+    """Страница истории сделок, новые первыми, с курсорами соседних страниц: для более старых
+    сделок (передать как `before`) и для более новых (как `after`). С `since` - только сделки
+    новее этого номера ленты. Последняя страница и `since` отдаются из ленты движка, в БД идем
+    только за тем, что лента уже вытеснила или не видела."""
+    tape = trade_executor.tape
+    if since is not None and (before or after):
+        raise HTTPException(400, "since cannot be combined with before/after")
+    page = TransactionPage([])
+    transactions = None
+    if tape and not before and not after:
+        # Номер берем до чтения БД: сделка, закоммиченная во время запроса, придет еще раз, но не пропадет
+        page.seq = tape.seq
+        if since is None:
+            transactions = tape.latest(filter_model.ticker, limit)
+        else:
+            transactions = tape.since(filter_model.ticker, since, limit)
+            if transactions is None:
+                page.reset = True
+            elif len(transactions) == limit:
+                # Могли отдать не все новые сделки: продолжать с последней отданной
+                page.seq = max(trade.seq for trade in transactions)
+    if transactions is None:
+        transactions = await TransactionDAO.get_history(
+            session, filter_model.ticker, limit, before=decode_cursor(before), after=decode_cursor(after))
     logging.info("Transaction history requested")
-    if not transactions: 
-        return []
-    return [TransactionResponse.model_validate(t) for t in transactions]
\ No newline at end of file
+    if transactions:
+        page.transactions = [TransactionResponse.model_validate(t) for t in transactions]
+        page.before = encode_cursor(transactions[-1])
+        page.after = encode_cursor(transactions[0])
+    return page
+
+
+async def get_candles(session: AsyncSession, filter_model: CandleRequest, limit: int = 500) -> List[CandleResponse]:
+    """OHLCV-свечи по возрастанию времени из таблицы candles, сырые сделки не читаются."""
+    candles = await CandleDAO.get_range(
+        session, filter_model.ticker, RESOLUTIONS[filter_model.resolution], filter_model.start, filter_model.end, limit)
+    logging.info("Candles requested")
+    return [CandleResponse.model_validate(candle) for candle in candles]
+
+
+def encode_cursor(transaction: Transaction | TapeTrade) -> str:
+    raw = f"{transaction.timestamp.isoformat()}|{transaction.id}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str | None) -> tuple[datetime, UUID] | None:
+    if not cursor:
+        return None
+    try:
+        timestamp, id = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode().split("|")
+        return datetime.fromisoformat(timestamp), UUID(id)
+    except ValueError:
+        raise HTTPException(400, "Invalid cursor")
\ No newline at end of file
@@ -0,0 +1,340 @@
+import asyncio
+import logging
+from typing import Callable
+from uuid import UUID
+from sqlalchemy.ext.asyncio import AsyncSession
+from dao.dao import OrderDAO, SettlementOutboxDAO
+from dao.database import on_commit
+from misc.db_models import SettlementOutbox
+from misc.enums import DirectionEnum, OrderEnum, StatusEnum
+from misc.internal_classes import InternalOrder, TradeExecution
+from services.trade_execution import trade_executor
+
+
+class SettlementBatcher:
+    """Групповой commit: сделки нескольких циклов сопоставления, тикеров и рыночных ордеров
+    копятся до `max_delay` секунд или `max_executions` сделок и проводятся одной транзакцией.
+    `submit` возвращает future, который завершается после commit пачки.
+    Сделки рыночного ордера к этому моменту уже лежат в settlement_outbox (записаны вместе с ордером
+    и блокировкой средств), пачка удаляет их оттуда при проведении. Если отправка не провелась,
+    ее записи сразу проводятся еще раз по одной, как воркерами outbox; что не провелось и тогда
+    или осталось после падения, проводит `run` следующего старта перед очередью. Сделки циклов
+    не сохраняются: их ордера в БД остаются открытыми, и после рестарта книги сводят их заново."""
+
+    def __init__(self, max_delay: float = 0.002, max_executions: int = 500):
+        self.max_delay = max_delay
+        self.max_executions = max_executions
+        self.queue: asyncio.Queue[tuple[list[TradeExecution], list[int], asyncio.Future] | None] = asyncio.Queue()
+        self.session_factory: Callable[[], AsyncSession] | None = None
+        self.task: asyncio.Task | None = None
+        self.recover_until = 0 # Записи outbox до этого id (включительно) остались от прошлого процесса
+        # Статистика для /health/settlement
+        self.batches = 0
+        self.submissions = 0
+        self.executions = 0
+        self.max_batch = 0
+        self.last_batch = 0
+        self.fallbacks = 0 # Пачки, которые пришлось проводить по одной отправке из-за ошибки
+        self.recovered = 0 # Сделки из outbox, проведенные после рестарта
+        self.retried = 0 # Сделки отправок с ошибкой, проведенные повтором из outbox
+
+
+    def start(self, session_factory: Callable[[], AsyncSession]):
+        self.session_factory = session_factory
+        self.task = asyncio.create_task(self.run(), name="settlement-batcher")
+
+
+    async def stop(self):
+        """Перестает принимать сделки и проводит все, что уже в очереди."""
+        task, self.task = self.task, None
+        if task is None:
+            return
+        self.queue.put_nowait(None)
+        await task
+
+
+    def submit(self, executions: list[TradeExecution], outbox_ids: list[int] = ()) -> asyncio.Future:
+        """Ставит сделки в очередь. `outbox_ids` - их записи в settlement_outbox, если они там есть."""
+        if self.task is None:
+            raise RuntimeError("Settlement batcher is not started")
+        future = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait((executions, list(outbox_ids), future))
+        return future
+
+
+    async def _collect(self) -> tuple[list[tuple[list[TradeExecution], list[int], asyncio.Future]], bool]:
+        """Следующая пачка и признак, что очередь закрыта (`stop`) и после пачки пуста."""
+        item = await self.queue.get()
+        if item is None:
+            return [], True
+        batch = [item]
+        count = len(item[0])
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.max_delay
+        while count < self.max_executions:
+            if self.queue.empty():
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self.queue.get(), timeout)
+                except TimeoutError:
+                    break
+            else:
+                item = self.queue.get_nowait()
+            if item is None:
+                return batch, True
+            batch.append(item)
+            count += len(item[0])
+        return batch, False
+
+
+    async def run(self):
+        # Сделки из outbox старше всего, что придет в очередь: проводим их первыми
+        try:
+            await self._recover()
+        except Exception as e:
+            logging.exception(f"Error settling executions left in the outbox: {e}")
+        while True:
+            batch, closed = await self._collect()
+            if batch:
+                await self._commit(batch)
+            if closed:
+                return
+
+
+    async def _recover(self):
+        if not self.recover_until:
+            return
+        async with self.session_factory() as session:
+            async with session.begin():
+                rows = await SettlementOutboxDAO.get_until(session, self.recover_until)
+                if not rows:
+                    return
+                settled = await self._settle_outbox(session, rows)
+        self.recovered += settled
+        logging.info(f"Settled {settled} of {len(rows)} executions left in the outbox")
+
+
+    async def _retry_outbox(self, ids: list[int]) -> bool:
+        """Проводит записи outbox отправки, которая не провелась. True - проведены все."""
+        try:
+            async with self.session_factory() as session:
+                async with session.begin():
+                    rows = await SettlementOutboxDAO.claim(session, ids)
+                    settled = await self._settle_outbox(session, rows)
+        except Exception as e:
+            logging.exception(f"Error settling {len(ids)} outbox executions after a failed batch: {e}")
+            return False
+        self.retried += settled
+        if settled < len(ids):
+            logging.error(f"Settled {settled} of {len(ids)} outbox executions after a failed batch, the rest wait for the next startup")
+        return settled == len(ids)
+
+
+    @staticmethod
+    async def _settle_outbox(session: AsyncSession, rows: list[SettlementOutbox]) -> int:
+        # Как воркеры outbox: состояние ордеров сверяется с БД, ошибки записей копятся в attempts
+        settled = await OutboxWorkerPool()._settle(session, rows)
+        await SettlementOutboxDAO.delete_by_ids(session, [row.id for row in settled])
+        return len(settled)
+
+
+    async def _commit(self, batch: list[tuple[list[TradeExecution], list[int], asyncio.Future]]):
+        executions = [execution for item, _, _ in batch for execution in item]
+        try:
+            async with self.session_factory() as session:
+                async with session.begin():
+                    # В порядке отправки: сделки получают время в порядке исполнения
+                    await trade_executor.execute_trade(session, executions)
+                    await SettlementOutboxDAO.delete_by_ids(session, [id for _, ids, _ in batch for id in ids])
+        except Exception as e:
+            if len(batch) == 1:
+                _, ids, future = batch[0]
+                # Ордер и его записи outbox уже закоммичены: пробуем провести их так, как проводит outbox
+                if ids and await self._retry_outbox(ids):
+                    if not future.done():
+                        future.set_result(None)
+                elif not future.done():
+                    future.set_exception(e)
+                return
+            # Одна плохая отправка не должна ронять чужие сделки: проводим по одной, в прежнем порядке
+            logging.warning(f"Settlement batch of {len(executions)} executions failed, retrying one by one: {e}")
+            self.fallbacks += 1
+            for item in batch:
+                await self._commit([item])
+            return
+
+        self.batches += 1
+        self.submissions += len(batch)
+        self.executions += len(executions)
+        self.last_batch = len(executions)
+        self.max_batch = max(self.max_batch, len(executions))
+        for _, _, future in batch:
+            if not future.done():
+                future.set_result(None)
+
+
+    def stats(self) -> dict:
+        return {
+            "batches": self.batches,
+            "submissions": self.submissions,
+            "executions": self.executions,
+            "avg_batch_executions": round(self.executions / self.batches, 2) if self.batches else 0,
+            "avg_batch_submissions": round(self.submissions / self.batches, 2) if self.batches else 0,
+            "max_batch_executions": self.max_batch,
+            "last_batch_executions": self.last_batch,
+            "fallbacks": self.fallbacks,
+            "recovered": self.recovered,
+            "retried": self.retried,
+            "queued": self.queue.qsize(),
+        }
+
+
+def _to_execution(row: SettlementOutbox) -> TradeExecution:
+    # Для проведения нужны только владелец, id и итоговое состояние ордеров, объем и цену не храним
+    bid_order = InternalOrder(
+        id=row.bid_order_id, user_id=row.buyer_id, direction=DirectionEnum.BUY, ticker=row.ticker,
+        qty=row.bid_filled, order_type=OrderEnum.LIMIT, price=None, filled=row.bid_filled, status=row.bid_status)
+    ask_order = InternalOrder(
+        id=row.ask_order_id, user_id=row.seller_id, direction=DirectionEnum.SELL, ticker=row.ticker,
+        qty=row.ask_filled, order_type=OrderEnum.LIMIT, price=None, filled=row.ask_filled, status=row.ask_status)
+    return TradeExecution(bid_order, ask_order, row.qty, row.price, row.bid_change)
+
+
+class OutboxWorkerPool:
+    """Проведение сделок из таблицы settlement_outbox пулом воркеров, у каждого свое соединение.
+    Воркер берет голову очереди через FOR UPDATE SKIP LOCKED и проводит только записи, чьи
+    пользователи не встречаются в более ранних записях, взятых другими воркерами или отложенных:
+    так сделки одного пользователя проводятся по порядку, а воркеры не ждут блокировок друг друга."""
+
+    def __init__(self, workers: int = 4, batch_size: int = 500, poll_interval: float = 0.5, max_attempts: int = 3):
+        self.workers = workers
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval # Как часто проверять очередь без пробуждения (записи после рестарта, чужие процессы)
+        self.max_attempts = max_attempts # После стольких ошибок запись остается в очереди для разбора и держит своих пользователей
+        self.wakeup = asyncio.Event()
+        self.session_factory: Callable[[], AsyncSession] | None = None
+        self.tasks: list[asyncio.Task] = []
+        # Статистика для /health/settlement
+        self.batches = 0
+        self.executions = 0
+        self.max_batch = 0
+        self.deferred = 0 # Записи, отложенные до следующего прохода из-за пересечения пользователей
+        self.failures = 0
+
+
+    def start(self, session_factory: Callable[[], AsyncSession]):
+        self.session_factory = session_factory
+        self.tasks = [asyncio.create_task(self.run(), name=f"settlement-worker-{i}") for i in range(self.workers)]
+
+
+    def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        self.tasks = []
+
+
+    def wake(self):
+        self.wakeup.set()
+
+
+    async def enqueue(self, session: AsyncSession, executions: list[TradeExecution]):
+        """Пишет сделки в outbox в транзакции `session`, воркеры просыпаются после ее commit."""
+        await SettlementOutboxDAO.add_executions(session, executions)
+        on_commit(session, self.wake)
+
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), self.poll_interval)
+            except TimeoutError:
+                pass
+            self.wakeup.clear()
+            try:
+                while await self.drain_once():
+                    pass
+            except Exception as e:
+                logging.exception(f"Error during outbox settlement: {e}")
+
+
+    async def drain_once(self) -> bool:
+        """Один проход по голове очереди. Возвращает False, если брать было нечего."""
+        async with self.session_factory() as session:
+            async with session.begin():
+                head = await SettlementOutboxDAO.get_head(session, self.batch_size)
+                claimed = {row.id: row for row in await SettlementOutboxDAO.claim(
+                    session, [id for id, _, _, attempts in head if attempts < self.max_attempts])}
+
+                batch: list[SettlementOutbox] = []
+                blocked: set[UUID] = set()
+                for id, buyer_id, seller_id, _ in head:
+                    row = claimed.get(id)
+                    if row is None or buyer_id in blocked or seller_id in blocked:
+                        blocked.update((buyer_id, seller_id))
+                        continue
+                    batch.append(row)
+                self.deferred += len(head) - len(batch)
+                if not batch:
+                    return False
+
+                settled = await self._settle(session, batch)
+                await SettlementOutboxDAO.delete_by_ids(session, [row.id for row in settled])
+
+        self.batches += 1
+        self.executions += len(settled)
+        self.max_batch = max(self.max_batch, len(settled))
+        return True
+
+
+    async def _settle(self, session: AsyncSession, batch: list[SettlementOutbox]) -> list[SettlementOutbox]:
+        executions = [_to_execution(row) for row in batch]
+        # Ордер могли отменить, пока сделка ждала в очереди, а сделки другой транзакции (рыночный ордер)
+        # могли провестись раньше: отмену и более позднее исполнение не перетираем
+        states = await OrderDAO.get_order_states(
+            session, {execution.bid_order.id for execution in executions} | {execution.ask_order.id for execution in executions})
+        for execution in executions:
+            for order in (execution.bid_order, execution.ask_order):
+                filled, status = states.get(order.id, (0, None))
+                if filled > order.filled:
+                    order.filled, order.status = filled, status
+                if status == StatusEnum.CANCELLED:
+                    order.status = StatusEnum.CANCELLED
+        try:
+            async with session.begin_nested():
+                await trade_executor.execute_trade(session, executions)
+            return batch
+        except Exception as e:
+            logging.warning(f"Outbox batch of {len(batch)} executions failed, retrying one by one: {e}")
+
+        # По одной записи в порядке очереди; после ошибки остальные сделки ее пользователей ждут
+        settled = []
+        blocked: set[UUID] = set()
+        for row, execution in zip(batch, executions):
+            if row.buyer_id in blocked or row.seller_id in blocked:
+                blocked.update((row.buyer_id, row.seller_id))
+                continue
+            try:
+                async with session.begin_nested():
+                    await trade_executor.execute_trade(session, [execution])
+                settled.append(row)
+            except Exception as e:
+                blocked.update((row.buyer_id, row.seller_id))
+                self.failures += 1
+                await SettlementOutboxDAO.record_failure(session, row.id, str(e))
+                if row.attempts + 1 >= self.max_attempts:
+                    logging.error(f"Outbox execution {row.id} failed {row.attempts + 1} times and is parked: {e}")
+        return settled
+
+
+    def stats(self) -> dict:
+        return {
+            "workers": len(self.tasks),
+            "batches": self.batches,
+            "executions": self.executions,
+            "avg_batch_executions": round(self.executions / self.batches, 2) if self.batches else 0,
+            "max_batch_executions": self.max_batch,
+            "deferred": self.deferred,
+            "failures": self.failures,
+        }
@@ -0,0 +1,132 @@
+import asyncio
+import logging
+import mmap
+import os
+import struct
+import time
+from typing import TYPE_CHECKING
+from misc.internal_classes import InternalOrder
+
+if TYPE_CHECKING:
+    from services.matching import MatchingEngine
+
+
+# Формат файла (little-endian):
+#   заголовок: magic, версия, high-water mark (нс от эпохи), номер записи журнала, число книг
+#   книга: длина тикера, тикер, число ордеров, номер записи журнала, на котором снята книга,
+#   затем записи ордеров фиксированной длины
+# В книге лежат только лимитные ордера, поэтому тип ордера не пишем.
+# Книги снимаются по одной, номер в заголовке файла - место в журнале до первой из них.
+MAGIC = b"OBSN"
+VERSION = 3
+HEADER = struct.Struct("<4sHqQI")
+BOOK_HEADER = struct.Struct("<B10sIQ")
+# id, user_id, qty, price, filled, ts_ns, direction_code, status_code
+ORDER_RECORD = struct.Struct("<16s16sqqqqBB")
+
+
+def copy_book(book) -> tuple[str, list[tuple]]:
+    """Копия ордеров книги полями записи: упаковать ее можно в другом потоке, пока книга меняется.
+    Пишем в порядке приоритета (стороны от лучшей цены, внутри цены по времени):
+    при загрузке сортировка почти отсортированных данных проходит за линию."""
+    return book.ticker, [
+        (order.id_int, order.user_id_int, order.qty, order.price, order.filled, order.ts_ns,
+         order.direction_code, order.status_code)
+        for order in [*book.get_bids(), *book.get_asks()]]
+
+
+def pack_book(ticker: str, records: list[tuple], journal_seq: int = 0) -> bytes:
+    encoded = ticker.encode()
+    chunks = [BOOK_HEADER.pack(len(encoded), encoded, len(records), journal_seq)]
+    pack = ORDER_RECORD.pack
+    chunks.extend(
+        pack(id_int.to_bytes(16, "big"), user_id_int.to_bytes(16, "big"), qty, price, filled, ts_ns, direction_code, status_code)
+        for id_int, user_id_int, qty, price, filled, ts_ns, direction_code, status_code in records)
+    return b"".join(chunks)
+
+
+def dump_book(book) -> bytes:
+    return pack_book(*copy_book(book))
+
+
+def _write_file(path: str, header: bytes, books: list[bytes]):
+    # Пишем во временный файл и атомарно подменяем: читатель видит либо старый, либо новый снапшот
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(header)
+        for book in books:
+            f.write(book)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+async def write_snapshot(engine: "MatchingEngine", path: str) -> int:
+    """Сохраняет все книги в `path`. Возвращает high-water mark снапшота (нс от эпохи).
+    Отметку берем до первой книги: все, что изменилось позже, при старте перечитается из БД.
+    Книги снимаются по одной, каждая под своим замком (дожидаемся идущего цикла сопоставления
+    только этой книги) и со своим номером записи журнала: проигрывание пропускает записи книги
+    до ее номера. Упаковка снятой книги идет в потоке, пока ждем замок следующей."""
+    high_water_mark = time.time_ns()
+    journal = engine.journal
+    # Записи до первой снятой книги покрывают все книги снапшота, их отрежет checkpoint
+    cut = journal.cut() if journal else (0, None, 0)
+    packing: list[asyncio.Future] = []
+    for ticker in sorted(engine.books):
+        book = engine.books.get(ticker)
+        if book is None:
+            continue
+        async with book.lock:
+            if engine.books.get(ticker) is not book:
+                continue # Инструмент удален или пересоздан, пока ждали замок
+            # Копия и номер журнала - без await между ними
+            records = copy_book(book)
+            journal_seq = journal.seq if journal else 0
+        packing.append(asyncio.ensure_future(asyncio.to_thread(pack_book, *records, journal_seq)))
+    books = await asyncio.gather(*packing)
+    header = HEADER.pack(MAGIC, VERSION, high_water_mark, cut[0], len(books))
+    await asyncio.to_thread(_write_file, path, header, books)
+    if journal:
+        await journal.checkpoint(cut)
+    return high_water_mark
+
+
+def read_book(view: memoryview, offset: int) -> tuple[str, list[InternalOrder], int, int]:
+    """Разбирает одну книгу, начиная с `offset`. Возвращает тикер, ордера, номер журнала книги
+    и смещение за книгой."""
+    ticker_len, ticker, order_count, journal_seq = BOOK_HEADER.unpack_from(view, offset)
+    ticker = ticker[:ticker_len].decode()
+    offset += BOOK_HEADER.size
+    end = offset + order_count * ORDER_RECORD.size
+    orders = [
+        InternalOrder.from_record(ticker, *record)
+        for record in ORDER_RECORD.iter_unpack(view[offset:end])]
+    return ticker, orders, journal_seq, end
+
+
+def read_snapshot(path: str) -> tuple[int, int, dict[str, list[InternalOrder]], dict[str, int]]:
+    """Читает снапшот через mmap. Возвращает high-water mark, номер записи журнала до первой книги,
+    ордера по тикерам и номера журнала, на которых сняты книги."""
+    books: dict[str, list[InternalOrder]] = {}
+    book_seqs: dict[str, int] = {}
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        magic, version, high_water_mark, journal_seq, book_count = HEADER.unpack_from(data, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"Unsupported snapshot format in {path}")
+        offset = HEADER.size
+        with memoryview(data) as view:
+            for _ in range(book_count):
+                ticker, orders, book_seqs[ticker], offset = read_book(view, offset)
+                books[ticker] = orders
+    return high_water_mark, journal_seq, books, book_seqs
+
+
+async def run_snapshotter(engine: "MatchingEngine", path: str, interval: float):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            started = time.perf_counter()
+            await write_snapshot(engine, path)
+            logging.info(f"Orderbook snapshot written to {path} in {time.perf_counter() - started:.3f}s")
+        except Exception as e:
+            logging.exception(f"Error writing orderbook snapshot: {e}")
@@ -0,0 +1,111 @@
+import time
+from collections import deque
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Callable
+from uuid import UUID
+from sqlalchemy.ext.asyncio import AsyncSession
+from dao.database import on_commit
+
+
+@dataclass(slots=True)
+class TapeTrade:
+    seq: int
+    id: UUID
+    buyer_id: UUID
+    seller_id: UUID
+    ticker: str
+    amount: int
+    price: int
+    timestamp: datetime
+
+
+class TradeTape:
+    """Лента последних проведенных сделок в памяти движка: по тикеру не больше `capacity` штук,
+    в порядке ключа истории (timestamp, id), как их отдает БД. Сделки попадают в ленту после
+    commit и получают номер `seq` в порядке commit, сквозной по всем тикерам; поллер передает
+    последний увиденный номер и получает только новые сделки.
+    Номера начинаются с текущего времени в микросекундах, так что после рестарта они не идут
+    назад и старый номер клиента не путается с новыми сделками."""
+
+    def __init__(self, capacity: int = 1000):
+        self.capacity = capacity
+        self.trades: dict[str, deque[TapeTrade]] = {}
+        self.seq = 0
+        self.start = 0
+        # Номер, после которого лента тикера полна: сделки с номером не больше есть только в БД
+        self.floor: dict[str, int] = {}
+        self.clear()
+
+
+    def clear(self):
+        self.trades.clear()
+        self.floor.clear()
+        self.seq = self.start = max(self.seq, time.time_ns() // 1000)
+
+
+    def record(self, trades: list[dict]):
+        """Добавляет сделки после commit транзакции, в которой они записаны в БД."""
+        for trade in sorted(trades, key=lambda trade: (trade["timestamp"], trade["id"])):
+            self.seq += 1
+            trade = TapeTrade(seq=self.seq, **trade)
+            tape = self.trades.setdefault(trade.ticker, deque())
+            # Время сделке дают до commit, и параллельные транзакции по тикеру коммитятся не по порядку:
+            # опоздавшую ставим на место, обычно это конец ленты или несколько шагов от него
+            key = (trade.timestamp, trade.id)
+            position = len(tape)
+            while position and (tape[position - 1].timestamp, tape[position - 1].id) > key:
+                position -= 1
+            if len(tape) == self.capacity:
+                if not position:
+                    # Старше всей полной ленты: сразу считаем вытесненной
+                    self.floor[trade.ticker] = max(self.floor.get(trade.ticker, 0), trade.seq)
+                    continue
+                evicted = tape.popleft()
+                self.floor[trade.ticker] = max(self.floor.get(trade.ticker, 0), evicted.seq)
+                position -= 1
+            tape.insert(position, trade)
+
+
+    def latest(self, ticker: str, limit: int) -> list[TapeTrade] | None:
+        """Последние `limit` сделок, новые первыми. None - в ленте их меньше, нужна БД."""
+        tape = self.trades.get(ticker, ())
+        if len(tape) < limit:
+            return None
+        return [tape[-i] for i in range(1, limit + 1)]
+
+
+    def since(self, ticker: str, seq: int, limit: int) -> list[TapeTrade] | None:
+        """Первые по номеру `limit` сделок с номером больше `seq`, новые первыми. None - часть сделок
+        после `seq` уже вытеснена из ленты или была до старта процесса: лента ответить не может."""
+        if seq < max(self.floor.get(ticker, 0), self.start) or seq > self.seq:
+            return None
+        # Лента упорядочена по времени, а не по номеру, поэтому просматриваем ее целиком (не больше capacity)
+        newer = [trade for trade in self.trades.get(ticker, ()) if trade.seq > seq]
+        if len(newer) > limit:
+            newer = sorted(sorted(newer, key=lambda trade: trade.seq)[:limit], key=lambda trade: (trade.timestamp, trade.id))
+        return newer[::-1]
+
+
+    def drop_user(self, session: AsyncSession, user_id: UUID):
+        # Сделки пользователя удаляет каскад в БД, из ленты убираем после commit
+        on_commit(session, lambda: self._drop(lambda trade: user_id in (trade.buyer_id, trade.seller_id)))
+
+
+    def drop_ticker(self, session: AsyncSession, ticker: str):
+        on_commit(session, lambda: self._drop(lambda trade: trade.ticker == ticker))
+
+
+    def _drop(self, match: Callable[[TapeTrade], bool]):
+        for ticker, tape in list(self.trades.items()):
+            kept = [trade for trade in tape if not match(trade)]
+            if len(kept) != len(tape):
+                self.trades[ticker] = deque(kept)
+
+
+    def stats(self) -> dict:
+        return {
+            "tape_seq": self.seq,
+            "tape_tickers": len(self.trades),
+            "tape_trades": sum(len(tape) for tape in self.trades.values()),
+        }
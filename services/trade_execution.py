@@ -1,121 +1,209 @@
-from sqlalchemy import select
+import asyncio
+import random
+from datetime import datetime, timedelta, timezone
+from typing import Iterable
+from sqlalchemy.exc import DBAPIError
 from sqlalchemy.ext.asyncio import AsyncSession
 from misc.db_models import Balance
-from misc.internal_classes import TradeExecution, InternalOrder
-from uuid import UUID
-from dao.dao import OrderDAO, TransactionDAO
-from schemas.create import TransactionCreate
+from misc.internal_classes import EPOCH, TradeExecution, InternalOrder
+from uuid import UUID, uuid4
+from collections import defaultdict
+from config import settings
+from dao.dao import BalanceDAO, CandleDAO, OrderDAO, TransactionDAO
+from dao.database import on_commit
+from services.balance_cache import BalanceCache
+from services.candles import aggregate
+from services.ledger import BalanceLedger
+from services.tape import TradeTape
 import logging
 
 
+def net_balance_deltas(executions: list[TradeExecution]) -> dict[tuple[UUID, str], list[int]]:
+    """Сводит все переводы пачки сделок в изменения [amount, blocked_amount] по (user_id, ticker)."""
+    deltas: dict[tuple[UUID, str], list[int]] = defaultdict(lambda: [0, 0])
+    for execution in executions:
+        buyer_id = execution.bid_order.user_id
+        seller_id = execution.ask_order.user_id
+        ticker = execution.bid_order.ticker
+        cost = execution.execution_price * execution.executed_qty
+        change = execution.bid_order_change or 0
+
+        deltas[(seller_id, ticker)][1] -= execution.executed_qty # Списание заблокированных токенов у seller
+        deltas[(buyer_id, ticker)][0] += execution.executed_qty # Зачисление токенов buyer
+        deltas[(buyer_id, "RUB")][1] -= cost + change # Списание заблокированных рублей у buyer
+        deltas[(buyer_id, "RUB")][0] += change # Сдача buyer
+        deltas[(seller_id, "RUB")][0] += cost # Зачисление рублей seller
+    return deltas
+
+
+class NotEnoughFunds(ValueError):
+    """У инициатора не хватило средств на сделки, проверенные под блокировкой строк."""
+
+
+def _is_deadlock(error: DBAPIError) -> bool:
+    # deadlock_detected и serialization_failure: транзакцию можно безопасно повторить
+    code = getattr(error.orig, "pgcode", None) or getattr(error.orig, "sqlstate", None)
+    return code in ("40P01", "40001")
+
+
 class TradeExecutor:
-    def __init__(self):
-        pass
+    def __init__(
+            self,
+            netting: bool = False,
+            deadlock_retries: int = 3,
+            retry_delay: float = 0.005,
+            ledger: BalanceLedger | None = None,
+            tape: TradeTape | None = None,
+            balance_cache: BalanceCache | None = None):
+        self.netting = netting # Проводить балансы пачкой: одна блокировка и один UPDATE на все сделки
+        self.ledger = ledger # Балансы в памяти; None - балансы проводятся в БД
+        self.tape = tape # Лента последних сделок для истории; None - история только из БД
+        self.balance_cache = balance_cache # Кэш GET /balance; None - балансы читаются из БД
+        self.deadlock_retries = deadlock_retries # Сколько раз повторять проведение, выбранное жертвой deadlock
+        self.retry_delay = retry_delay # Верхняя граница случайной паузы перед повтором (сек)
+        self.last_timestamp = EPOCH # Время последней записанной сделки, следующие получают время строго больше
+        # Статистика для /health/settlement
+        self.deadlocks = 0
+        self.retries = 0
+        self.retry_failures = 0 # Повторы не помогли, ошибка ушла вызывающему
 
     
-    async def execute_trade(self, session: AsyncSession, executions: list[TradeExecution]):
+    async def execute_trade(
+            self,
+            session: AsyncSession,
+            executions: list[TradeExecution],
+            reserve: tuple[UUID, str, int] | None = None):
+        """Проводит сделки. `reserve` - (user_id, ticker, сумма): средства инициатора (рыночного ордера)
+        при балансах в БД, их строка лочится одним запросом со строками сделок; если средств не хватает -
+        NotEnoughFunds."""
         if not session.in_transaction():
             async with session.begin():
-                await self._execute_trade(session, executions)
+                await self._execute_with_retry(session, executions, reserve)
         else:
-            await self._execute_trade(session, executions)
+            await self._execute_with_retry(session, executions, reserve)
 
 
-    async def _execute_trade(self, session: AsyncSession, executions: list[TradeExecution]):
+    async def _execute_with_retry(
+            self,
+            session: AsyncSession,
+            executions: list[TradeExecution],
+            reserve: tuple[UUID, str, int] | None = None):
+        # Проведение идет под savepoint: при deadlock откатываем только его (и снятые после него блокировки),
+        # а не всю транзакцию с уже сведенными в памяти сделками
+        for attempt in range(self.deadlock_retries + 1):
+            try:
+                async with session.begin_nested():
+                    trades = await self._execute_trade(session, executions, reserve)
+                if self.tape:
+                    # В ленту - только сделки закоммиченной транзакции
+                    on_commit(session, lambda: self.tape.record(trades))
+                if self.balance_cache:
+                    self.balance_cache.invalidate(session, (
+                        user_id for execution in executions
+                        for user_id in (execution.bid_order.user_id, execution.ask_order.user_id)))
+                return
+            except DBAPIError as e:
+                if not _is_deadlock(e):
+                    raise
+                self.deadlocks += 1
+                if attempt == self.deadlock_retries:
+                    self.retry_failures += 1
+                    raise
+                self.retries += 1
+                logging.warning(f"Settlement of {len(executions)} executions hit a deadlock, retry {attempt + 1}: {e}")
+                await asyncio.sleep(random.uniform(0, self.retry_delay))
+
+
+    async def lock_balances(
+            self,
+            session: AsyncSession,
+            executions: list[TradeExecution],
+            extra: Iterable[tuple[UUID, str]] = ()) -> dict[tuple[UUID, str], Balance]:
+        """Лочит все строки балансов, которые тронут сделки (и `extra`), одним запросом в порядке
+        (user_id, ticker). Все пути проведения берут блокировки в этом порядке и не встают в deadlock
+        друг с другом; повторный FOR UPDATE уже своих строк новых блокировок не берет."""
+        keys = set(extra)
         for execution in executions:
-            await self._process_execution(
-                session=session,
-                buyer_id = execution.bid_order.user_id,
-                seller_id=execution.ask_order.user_id,
-                ticker=execution.bid_order.ticker,
-                executed_price=execution.execution_price,
-                executed_qty=execution.executed_qty,
-                bid_order_change=execution.bid_order_change)
-            
-            await self._update_orders(
-                session=session,
-                bid_order=execution.bid_order,
-                ask_order=execution.ask_order)
-            logging.info(f"Executed: bid:{execution.bid_order.id}, ask:{execution.ask_order.id}")
-            
-            
+            buyer_id = execution.bid_order.user_id
+            seller_id = execution.ask_order.user_id
+            ticker = execution.bid_order.ticker
+            keys.update(((seller_id, ticker), (seller_id, "RUB"), (buyer_id, ticker), (buyer_id, "RUB")))
+        balances = await BalanceDAO.get_balances_with_lock(session, sorted(keys))
+        return {(balance.user_id, balance.ticker): balance for balance in balances}
 
-    async def _process_execution(
+
+    async def _execute_trade(
             self,
-            session: AsyncSession, 
-            buyer_id: UUID, 
-            seller_id: UUID, 
-            ticker: str, 
-            executed_price: int, 
-            executed_qty: int,
-            bid_order_change: int):
-        await self._transfer_of_funds(session, buyer_id, seller_id, ticker, executed_price, executed_qty, bid_order_change)
-        await self._save_trade(session, buyer_id, seller_id, ticker, executed_price, executed_qty)
+            session: AsyncSession,
+            executions: list[TradeExecution],
+            reserve: tuple[UUID, str, int] | None = None) -> list[dict]:
+        if self.ledger:
+            # С балансами в памяти инициатор резервирует средства сам, до сопоставления
+            trades = await self._save_trades(session, executions)
+            await self._update_orders(session, executions)
+            # Балансы меняем в памяти последними: упавшие до этого запросы откатывает savepoint,
+            # а сделанное в памяти - нет; строки балансов в БД допишет flusher
+            if not self.ledger.apply(session, net_balance_deltas(executions)):
+                raise ValueError("Not enough blocked funds")
+        else:
+            locked = await self.lock_balances(session, executions, extra=[reserve[:2]] if reserve else ())
+            if reserve:
+                self._reserve(locked, *reserve)
+            if self.netting:
+                await self._transfer_of_funds_netted(session, executions, locked)
+            else:
+                for execution in executions:
+                    await self._transfer_of_funds(
+                        session=session,
+                        locked=locked,
+                        buyer_id=execution.bid_order.user_id,
+                        seller_id=execution.ask_order.user_id,
+                        ticker=execution.bid_order.ticker,
+                        executed_price=execution.execution_price,
+                        executed_qty=execution.executed_qty,
+                        bid_order_change=execution.bid_order_change)
+
+            trades = await self._save_trades(session, executions)
+
+            await self._update_orders(session, executions)
+        for execution in executions:
+            logging.info(f"Executed: bid:{execution.bid_order.id}, ask:{execution.ask_order.id}")
+        return trades
 
 
     async def _transfer_of_funds(
             self,
             session: AsyncSession, 
+            locked: dict[tuple[UUID, str], Balance],
             buyer_id: UUID, 
             seller_id: UUID, 
             ticker: str, 
             executed_price: int, 
             executed_qty: int,
             bid_order_change: int):
+        # Строки уже залочены в lock_balances, здесь только проверки и переводы
 
-        # 1. Лочим seller токены
-        seller_balance = (await session.execute(
-            select(Balance)
-            .where(
-                Balance.user_id == seller_id,
-                Balance.ticker == ticker)
-            .with_for_update()
-        )).scalar_one_or_none()
+        # 1. Токены seller
+        seller_balance = locked.get((seller_id, ticker))
         if not seller_balance or seller_balance.blocked_amount < executed_qty:
             raise ValueError(f"Not enough blocked {ticker}")
         
-        # 2. Лочим buyer рубли
-        buyer_rub_balance = (await session.execute(
-            select(Balance)
-            .where(Balance.user_id == buyer_id, Balance.ticker == "RUB")
-            .with_for_update()
-        )).scalar_one_or_none()
+        # 2. Рубли buyer
+        buyer_rub_balance = locked.get((buyer_id, "RUB"))
         if not buyer_rub_balance or buyer_rub_balance.blocked_amount < executed_price * executed_qty:
             raise ValueError("Not enough blocked RUB")
-        
-        # 3. Лочим buyer рубли
-        buyer_token_balance = (await session.execute(
-            select(Balance)
-            .where(Balance.user_id == buyer_id, Balance.ticker == ticker)
-            .with_for_update()
-        )).scalar_one_or_none()
-
-        # 4. Лочим seller рубли
-        seller_rub_balance = (await session.execute(
-            select(Balance)
-            .where(Balance.user_id == seller_id, Balance.ticker == "RUB")
-            .with_for_update()
-        )).scalar_one_or_none()
-
-        # 5. Списание токенов у seller 
+
+        # 3. Списание токенов у seller 
         seller_balance.blocked_amount -= executed_qty
 
-        # 6. Зачисление токенов buyer 
-        if buyer_token_balance:
-            buyer_token_balance.amount += executed_qty
-        else:
-            session.add(Balance(
-                user_id=buyer_id,
-                ticker=ticker,
-                amount=executed_qty,
-                blocked_amount=0
-            ))
-
-        # 7. Списание рубля у buyer
+        # 4. Зачисление токенов buyer 
+        self._credit(session, locked, buyer_id, ticker, executed_qty)
+
+        # 5. Списание рубля у buyer
         buyer_rub_balance.blocked_amount -= executed_price * executed_qty
 
-        # 8. Зачисление рубля seller
-        seller_rub_balance.amount += executed_price * executed_qty
+        # 6. Зачисление рубля seller
+        self._credit(session, locked, seller_id, "RUB", executed_price * executed_qty)
 
         if bid_order_change:
             if buyer_rub_balance.blocked_amount < bid_order_change:
@@ -126,48 +214,111 @@ class TradeExecutor:
         await session.flush()
 
 
+    @staticmethod
+    def _reserve(locked: dict[tuple[UUID, str], Balance], user_id: UUID, ticker: str, amount: int):
+        # Строка уже залочена вместе со строками встречных сторон, переводим средства в блок
+        balance = locked.get((user_id, ticker))
+        if not balance or balance.amount < amount:
+            raise NotEnoughFunds(f"Not enough {ticker}")
+        balance.amount -= amount
+        balance.blocked_amount += amount
 
-    async def _save_trade(
-            self,
-            session: AsyncSession, 
-            buyer_id: UUID, seller_id: 
-            UUID, ticker: str, 
-            executed_price: int, 
-            executed_qty: int):
-        
-        # 4. Фиксируем транзакцию перевода токенов
-        await TransactionDAO.add(
-            session=session,
-            values=TransactionCreate(
-                buyer_id=buyer_id,
-                seller_id=seller_id,
-                ticker=ticker,
-                amount=executed_qty,
-                price=executed_price
-            )
-        )
-
-
-    async def _update_orders(
+
+    @staticmethod
+    def _credit(session: AsyncSession, locked: dict[tuple[UUID, str], Balance], user_id: UUID, ticker: str, amount: int):
+        balance = locked.get((user_id, ticker))
+        if balance:
+            balance.amount += amount
+        else:
+            # Строки нет (обычно токены новому buyer): создаем, следующие сделки пачки найдут ее в locked
+            balance = locked[(user_id, ticker)] = Balance(user_id=user_id, ticker=ticker, amount=amount, blocked_amount=0)
+            session.add(balance)
+
+
+    async def _transfer_of_funds_netted(
             self,
             session: AsyncSession,
-            bid_order: InternalOrder,
-            ask_order: InternalOrder):
-        
-    # 6. Обновляем статусы ордеров
-        await OrderDAO.update_after_trade(
-            session,
-            bid_order.id,
-            bid_order.filled,
-            bid_order.status
-        )
-
-        await OrderDAO.update_after_trade(
-            session,
-            ask_order.id,
-            ask_order.filled,
-            ask_order.status
-        )
-
-
-trade_executor = TradeExecutor()
\ No newline at end of file
+            executions: list[TradeExecution],
+            locked: dict[tuple[UUID, str], Balance]):
+        deltas = net_balance_deltas(executions)
+
+        updates, missing = [], []
+        for (user_id, ticker), (amount, blocked_amount) in deltas.items():
+            balance = locked.get((user_id, ticker))
+            if balance is None:
+                # Нет строки - нечего и списывать, только зачисление (обычно токены новому buyer)
+                if blocked_amount:
+                    raise ValueError(f"Not enough blocked {ticker}")
+                missing.append({"user_id": user_id, "ticker": ticker, "amount": amount, "blocked_amount": 0})
+                continue
+            if balance.blocked_amount + blocked_amount < 0:
+                raise ValueError(f"Not enough blocked {ticker}")
+            updates.append({
+                "user_id": user_id,
+                "ticker": ticker,
+                "amount": balance.amount + amount,
+                "blocked_amount": balance.blocked_amount + blocked_amount})
+
+        await BalanceDAO.update_many(session, updates)
+        await BalanceDAO.credit_many(session, missing)
+
+
+    async def _save_trades(self, session: AsyncSession, executions: list[TradeExecution]) -> list[dict]:
+        # Фиксируем сделки пачкой: один многострочный INSERT вместо add и flush на каждую.
+        # id и время задаем здесь, чтобы лента сделок совпадала с БД (курсоры истории)
+        timestamps = self._next_timestamps(len(executions))
+        trades = [
+            {
+                "id": uuid4(),
+                "buyer_id": execution.bid_order.user_id,
+                "seller_id": execution.ask_order.user_id,
+                "ticker": execution.bid_order.ticker,
+                "amount": execution.executed_qty,
+                "price": execution.execution_price,
+                "timestamp": timestamp,
+            }
+            for execution, timestamp in zip(executions, timestamps)
+        ]
+        await TransactionDAO.add_many(session, trades)
+        # Свечи обновляем в той же транзакции: они всегда согласованы с таблицей сделок
+        await CandleDAO.merge_many(session, aggregate(trades))
+        return trades
+
+
+    def _next_timestamps(self, count: int) -> list[datetime]:
+        # Время строго растет в порядке исполнения, в том числе внутри пачки: по (timestamp, id)
+        # упорядочены история и лента, по нему же выбираются open и close свечей
+        start = max(datetime.now(timezone.utc), self.last_timestamp + timedelta(microseconds=1))
+        timestamps = [start + timedelta(microseconds=i) for i in range(count)]
+        if timestamps:
+            self.last_timestamp = timestamps[-1]
+        return timestamps
+
+
+    async def _update_orders(self, session: AsyncSession, executions: list[TradeExecution]):
+        # Обновляем статусы ордеров: по одной строке на ордер с итоговыми filled и status,
+        # сколько бы сделок его ни задело
+        orders: dict[int, InternalOrder] = {}
+        for execution in executions:
+            orders[execution.bid_order.id_int] = execution.bid_order
+            orders[execution.ask_order.id_int] = execution.ask_order
+        await OrderDAO.update_after_trades(session, orders.values())
+
+
+    def stats(self) -> dict:
+        return {
+            "deadlocks": self.deadlocks,
+            "deadlock_retries": self.retries,
+            "deadlock_retry_failures": self.retry_failures,
+            **(self.ledger.stats() if self.ledger else {}),
+            **(self.tape.stats() if self.tape else {}),
+            **(self.balance_cache.stats() if self.balance_cache else {}),
+        }
+
+
+trade_executor = TradeExecutor(
+    netting=settings.SETTLEMENT_NETTING,
+    deadlock_retries=settings.SETTLEMENT_DEADLOCK_RETRIES,
+    ledger=BalanceLedger(settings.ENGINE_BALANCE_LEDGER_FLUSH_INTERVAL) if settings.ENGINE_BALANCE_LEDGER else None,
+    tape=TradeTape(settings.ENGINE_TRADE_TAPE_SIZE) if settings.ENGINE_TRADE_TAPE_SIZE else None,
+    balance_cache=BalanceCache(settings.BALANCE_CACHE_TTL, settings.BALANCE_CACHE_SIZE) if settings.BALANCE_CACHE_SIZE else None)
\ No newline at end of file
@@ -0,0 +1,123 @@
+"""Планы горячих запросов до и после индексов миграции 9e4f2a7b3c61 на засеянных данных.
+Нужен Postgres из настроек (.env). Все создается в отдельной схеме и удаляется после прогона.
+Запуск: python -m tests.bench_indexes
+Вывод прогона на PostgreSQL 16.2 - tests/bench_indexes_plans.txt"""
+import asyncio
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import select, text
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.ext.asyncio import create_async_engine
+from config import settings
+from dao.database import Base
+from misc.db_models import Balance, Order, Transaction
+from misc.enums import OrderEnum, StatusEnum
+
+
+SCHEMA = "bench_indexes"
+USERS = 10_000
+TICKERS = 50
+ORDERS = 1_000_000
+OPEN_SHARE = 0.05 # Доля открытых ордеров: остальные исполнены или отменены
+TRANSACTIONS = 1_000_000
+
+INDEXES = {
+    "orders": ["ix_orders_open_limit", "ix_orders_user_id_timestamp", "ix_orders_limit_updated_at"],
+    "transactions": ["ix_transactions_ticker_timestamp", "ix_transactions_buyer_id", "ix_transactions_seller_id"],
+}
+
+SEED = [
+    f"""INSERT INTO users (id, name, role, api_key, visibility)
+        SELECT gen_random_uuid(), 'user ' || i, 'USER', 'key-' || gen_random_uuid(), 'ACTIVE'
+        FROM generate_series(1, {USERS}) AS i""",
+    f"""INSERT INTO instruments (ticker, name, visibility)
+        SELECT 'T' || chr(65 + i / 26) || chr(65 + i % 26), 'instrument ' || i, 'ACTIVE'
+        FROM generate_series(0, {TICKERS - 1}) AS i""",
+    """CREATE TEMP TABLE bench_users AS SELECT row_number() OVER () AS n, id FROM users""",
+    """CREATE TEMP TABLE bench_tickers AS SELECT row_number() OVER () AS n, ticker FROM instruments""",
+    f"""INSERT INTO balances (user_id, ticker, amount, blocked_amount)
+        SELECT u.id, t.ticker, 1000, 0 FROM bench_users u JOIN bench_tickers t ON (u.n + t.n) % 10 = 0""",
+    f"""INSERT INTO orders (id, user_id, ticker, direction, qty, price, status, filled, order_type, timestamp, updated_at)
+        SELECT gen_random_uuid(), u.id, t.ticker,
+               CASE WHEN (i / 3) % 2 = 0 THEN 'BUY' ELSE 'SELL' END::directionenum,
+               10, 100 + i % 50,
+               CASE WHEN random() < {OPEN_SHARE} THEN 'NEW'
+                    WHEN i % 3 = 0 THEN 'CANCELLED' ELSE 'EXECUTED' END::statusenum,
+               0,
+               -- i / 7, а не i: иначе тип ордера совпадает с тикером (i % 50) и у части тикеров одни рыночные
+               CASE WHEN (i / 7) % 10 = 0 THEN 'MARKET' ELSE 'LIMIT' END::orderenum,
+               now() - (i || ' seconds')::interval,
+               now() - (i || ' seconds')::interval
+        FROM generate_series(1, {ORDERS}) AS i
+        JOIN bench_users u ON u.n = 1 + i % {USERS}
+        JOIN bench_tickers t ON t.n = 1 + i % {TICKERS}""",
+    f"""INSERT INTO transactions (id, buyer_id, seller_id, ticker, amount, price, timestamp)
+        SELECT gen_random_uuid(), b.id, s.id, t.ticker, 1 + i % 10, 100 + i % 50, now() - (i || ' seconds')::interval
+        FROM generate_series(1, {TRANSACTIONS}) AS i
+        JOIN bench_users b ON b.n = 1 + i % {USERS}
+        JOIN bench_users s ON s.n = 1 + (i * 7) % {USERS}
+        JOIN bench_tickers t ON t.n = 1 + i % {TICKERS}""",
+]
+
+
+def queries(user_id, ticker: str) -> dict[str, object]:
+    # Те же запросы, что строят DAO
+    open_statuses = [StatusEnum.NEW, StatusEnum.PARTIALLY_EXECUTED]
+    return {
+        "OrderDAO.get_open_orders": select(Order).where(
+            Order.ticker == ticker, Order.order_type == OrderEnum.LIMIT, Order.status.in_(open_statuses)),
+        "OrderDAO.get_limit_orders_changed_since": select(Order).where(
+            Order.order_type == OrderEnum.LIMIT, Order.updated_at >= datetime.now(timezone.utc) - timedelta(seconds=60)),
+        "OrderDAO.find_all (user_id)": select(Order).filter_by(user_id=user_id),
+        "TransactionDAO.get_history": select(Transaction).where(Transaction.ticker == ticker)
+            .order_by(Transaction.timestamp.desc(), Transaction.id.desc()).limit(10),
+        "BalanceDAO.get_user_balances": select(Balance.ticker, Balance.amount, Balance.blocked_amount)
+            .where(Balance.user_id == user_id),
+        "delete user: transactions by buyer_id": select(Transaction).where(Transaction.buyer_id == user_id),
+        "delete user: transactions by seller_id": select(Transaction).where(Transaction.seller_id == user_id),
+    }
+
+
+async def explain_all(conn, user_id, ticker: str) -> dict[str, str]:
+    plans = {}
+    for name, query in queries(user_id, ticker).items():
+        sql = str(query.compile(dialect=postgresql.dialect(), compile_kwargs={"literal_binds": True}))
+        rows = (await conn.execute(text(f"EXPLAIN (ANALYZE, BUFFERS, COSTS OFF) {sql}"))).scalars().all()
+        plans[name] = "\n".join(rows)
+    return plans
+
+
+async def main():
+    engine = create_async_engine(settings.get_db_url())
+    try:
+        async with engine.begin() as conn:
+            await conn.execute(text(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE"))
+            await conn.execute(text(f"CREATE SCHEMA {SCHEMA}"))
+            await conn.execute(text(f"SET LOCAL search_path TO {SCHEMA}"))
+            await conn.run_sync(Base.metadata.create_all)
+            # Таблицы как в модели, но без новых индексов: это "до"
+            for names in INDEXES.values():
+                for name in names:
+                    await conn.execute(text(f"DROP INDEX {name}"))
+            for statement in SEED:
+                await conn.execute(text(statement))
+            await conn.execute(text("ANALYZE users, instruments, balances, orders, transactions"))
+            user_id = (await conn.execute(text("SELECT id FROM users ORDER BY id LIMIT 1"))).scalar()
+            ticker = (await conn.execute(text("SELECT ticker FROM instruments ORDER BY ticker LIMIT 1"))).scalar()
+            before = await explain_all(conn, user_id, ticker)
+
+            for table in INDEXES:
+                for index in Base.metadata.tables[table].indexes:
+                    await conn.run_sync(lambda sync_conn: index.create(sync_conn))
+            await conn.execute(text("ANALYZE users, instruments, balances, orders, transactions"))
+            after = await explain_all(conn, user_id, ticker)
+
+        for name in before:
+            print(f"=== {name}\n--- before\n{before[name]}\n--- after\n{after[name]}\n")
+    finally:
+        async with engine.begin() as conn:
+            await conn.execute(text(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE"))
+        await engine.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,82 @@
+"""Память на один лежащий в книге ордер до и после компактного InternalOrder.
+Запуск: python -m tests.bench_memory"""
+import gc
+import tracemalloc
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+from uuid import UUID, uuid4
+from misc.enums import DirectionEnum, OrderEnum, StatusEnum
+from misc.internal_classes import InternalOrder
+from services.orderbook import OrderBook
+
+
+ORDERS = 200_000
+
+
+@dataclass
+class LegacyInternalOrder:
+    # Прежнее представление: обычный dataclass с UUID, datetime и str-enum
+    user_id: UUID
+    direction: DirectionEnum
+    ticker: str
+    qty: int
+    order_type: OrderEnum
+    price: int | None
+    id: UUID
+    timestamp: datetime
+    filled: int = 0
+    status: StatusEnum = StatusEnum.NEW
+
+
+def db_row(i: int, start: datetime) -> SimpleNamespace:
+    # Как после загрузки из БД: у каждой строки свои объекты UUID, datetime и строка тикера
+    return SimpleNamespace(
+        id=uuid4(),
+        user_id=uuid4(),
+        ticker="".join(["BEN", "CH"]),
+        direction=DirectionEnum.BUY if i % 2 else DirectionEnum.SELL,
+        qty=10,
+        price=1000 + i % 100,
+        filled=0,
+        status=StatusEnum.NEW,
+        order_type=OrderEnum.LIMIT,
+        timestamp=start + timedelta(microseconds=i))
+
+
+def legacy_from_db(row) -> LegacyInternalOrder:
+    return LegacyInternalOrder(
+        id=row.id, user_id=row.user_id, direction=row.direction, ticker=row.ticker, qty=row.qty, price=row.price,
+        filled=row.filled, order_type=row.order_type, status=row.status, timestamp=row.timestamp)
+
+
+def retained_bytes(build) -> float:
+    gc.collect()
+    tracemalloc.start()
+    start = datetime.now(timezone.utc)
+    kept = [build(db_row(i, start)) for i in range(ORDERS)]
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del kept
+    return size / ORDERS
+
+
+def book_bytes() -> float:
+    gc.collect()
+    tracemalloc.start()
+    start = datetime.now(timezone.utc)
+    book = OrderBook("BENCH")
+    book.load_orderbook(db_row(i, start) for i in range(ORDERS))
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del book
+    return size / ORDERS
+
+
+if __name__ == "__main__":
+    print(f"bytes per resting order, {ORDERS} orders")
+    print(f"  dataclass InternalOrder:  {retained_bytes(legacy_from_db):7.1f}")
+    print(f"  compact InternalOrder:    {retained_bytes(InternalOrder.from_db):7.1f}")
+    print(f"  OrderBook incl. indexes:  {book_bytes():7.1f}")
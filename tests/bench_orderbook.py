@@ -0,0 +1,164 @@
+"""Микробенчмарки книги ордеров. Запуск: python -m tests.bench_orderbook"""
+import asyncio
+import gc
+import os
+import random
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+from uuid import uuid4
+from misc.enums import DirectionEnum, OrderEnum, StatusEnum
+from services.orderbook import OrderBook, PriceLevelOrderBook
+from services.snapshot import read_snapshot, write_snapshot
+
+
+RESTING_ORDERS = 500_000
+CANCELS = 1_000
+LEGACY_CANCELS = 20
+
+
+def fake_order(direction: DirectionEnum, price: int, timestamp: datetime) -> SimpleNamespace:
+    # InternalOrder.from_db читает только атрибуты, ORM тут не нужен
+    return SimpleNamespace(
+        id=uuid4(),
+        user_id=uuid4(),
+        ticker="BENCH",
+        direction=direction,
+        qty=10,
+        price=price,
+        filled=0,
+        status=StatusEnum.NEW,
+        order_type=OrderEnum.LIMIT,
+        timestamp=timestamp)
+
+
+def build_book(n: int) -> tuple[OrderBook, list[SimpleNamespace]]:
+    book = OrderBook("BENCH")
+    start = datetime.now(timezone.utc)
+    orders = []
+    for i in range(n):
+        if i % 2:
+            order = fake_order(DirectionEnum.BUY, random.randint(1, 1000), start + timedelta(microseconds=i))
+        else:
+            order = fake_order(DirectionEnum.SELL, random.randint(1001, 2000), start + timedelta(microseconds=i))
+        orders.append(order)
+    book.load_orderbook(orders)
+    return book, orders
+
+
+def legacy_cancel(book: OrderBook, cancel_order) -> bool:
+    # Старая реализация: полный проход по asks, затем по bids
+    for order in book.asks:
+        if cancel_order.id == order.id:
+            return True
+    for order in book.bids:
+        if cancel_order.id == order.id:
+            return True
+    return False
+
+
+def bench_cancel():
+    book, orders = build_book(RESTING_ORDERS)
+    victims = random.sample(orders, CANCELS)
+
+    start = time.perf_counter()
+    for order in victims[:LEGACY_CANCELS]:
+        legacy_cancel(book, order)
+    legacy = (time.perf_counter() - start) / LEGACY_CANCELS
+
+    start = time.perf_counter()
+    for order in victims:
+        assert book.cancel_order(order)
+    indexed = (time.perf_counter() - start) / CANCELS
+
+    print(f"cancel_order, {RESTING_ORDERS} resting orders")
+    print(f"  linear scan: {legacy * 1e6:10.1f} us/cancel")
+    print(f"  id index:    {indexed * 1e6:10.1f} us/cancel")
+
+
+def bench_levels(n: int = 200_000, prices: int = 20):
+    # Много ордеров на немногих ценах: insert, затем рыночные ордера съедают книгу
+    start_ts = datetime.now(timezone.utc)
+    orders = [fake_order(DirectionEnum.SELL, 1000 + random.randrange(prices), start_ts + timedelta(microseconds=i)) for i in range(n)]
+    takers = [SimpleNamespace(**{**vars(fake_order(DirectionEnum.BUY, None, start_ts)), "qty": 1000, "order_type": OrderEnum.MARKET}) for _ in range(n * 10 // 1000)]
+
+    print(f"insert {n} orders on {prices} prices, then match them with market orders")
+    for book_class in (OrderBook, PriceLevelOrderBook):
+        book = book_class("BENCH")
+        start = time.perf_counter()
+        for order in orders:
+            book.add_limit_order(order)
+        inserted = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for taker in takers:
+            book.add_market_order(taker, balance=10**12)
+        matched = time.perf_counter() - start
+        print(f"  {book_class.__name__:20} insert: {inserted / n * 1e6:6.2f} us/order, match: {matched / n * 1e6:6.2f} us/order")
+
+
+def bench_fill_cost_churn(levels: int = 2000, steps: int = 2000):
+    # Уровни постоянно исчезают и появляются (отмена всего уровня и новый ордер на той же цене),
+    # между изменениями - проверка рыночного ордера. "rebuild" - как раньше: перестройка индекса
+    # после каждого появления или исчезновения уровня
+    start_ts = datetime.now(timezone.utc)
+    print(f"fill_cost with level churn, {levels} ask levels, {steps} steps")
+    for mode in ("incremental", "rebuild"):
+        for book_class in (OrderBook, PriceLevelOrderBook):
+            random.seed(3)
+            book = book_class("BENCH")
+            by_price: dict[int, list[SimpleNamespace]] = {}
+            for i in range(levels * 5):
+                order = fake_order(DirectionEnum.SELL, 1000 + i % levels, start_ts + timedelta(microseconds=i))
+                by_price.setdefault(order.price, []).append(order)
+                book.add_limit_order(order)
+            book.fill_cost(DirectionEnum.BUY, 1)
+
+            start = time.perf_counter()
+            for step in range(steps):
+                price = 1000 + random.randrange(levels)
+                for order in by_price.pop(price, []):
+                    book.cancel_order(order)
+                order = fake_order(DirectionEnum.SELL, price, start_ts + timedelta(seconds=1, microseconds=step))
+                by_price[price] = [order]
+                book.add_limit_order(order)
+                if mode == "rebuild":
+                    book.cumulative[DirectionEnum.SELL].invalidate()
+                book.fill_cost(DirectionEnum.BUY, random.randint(1, levels * 25))
+            elapsed = time.perf_counter() - start
+            print(f"  {mode:12} {book_class.__name__:20} {elapsed / steps * 1e6:8.1f} us/step")
+
+
+def bench_snapshot():
+    # Старт движка: ордера из БД через from_db против чтения бинарного снапшота
+    book, orders = build_book(RESTING_ORDERS)
+    engine = SimpleNamespace(books={"BENCH": book}, journal=None)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "books.snapshot")
+        start = time.perf_counter()
+        asyncio.run(write_snapshot(engine, path))
+        written = time.perf_counter() - start
+
+        start = time.perf_counter()
+        OrderBook("BENCH").load_orderbook(orders)
+        from_db = time.perf_counter() - start
+
+        start = time.perf_counter()
+        gc.disable() # Как в MatchingEngine._read_snapshot
+        _, _, books, _ = read_snapshot(path)
+        gc.enable()
+        OrderBook("BENCH").restore(books["BENCH"])
+        from_snapshot = time.perf_counter() - start
+        size = os.path.getsize(path)
+
+    print(f"restore book with {RESTING_ORDERS} orders (snapshot {size / 2**20:.1f} MiB, written in {written:.2f}s)")
+    print(f"  from ORM rows: {from_db:6.2f} s (without the query itself)")
+    print(f"  from snapshot: {from_snapshot:6.2f} s")
+
+
+if __name__ == "__main__":
+    bench_cancel()
+    bench_levels()
+    bench_fill_cost_churn()
+    bench_snapshot()
@@ -3,10 +3,15 @@ from httpx import Client
 from pydantic import ValidationError
 import pytest
 from fastapi import Response, status
-from schemas.response import L2OrderBook, InstrumentResponse, UserResponse, TransactionResponse
-from dependencies import token
+from schemas.response import L2OrderBook, InstrumentResponse, UserResponse, TransactionResponse, CandleResponse
+from dependencies import get_db, token
+from main import app
 from services.engine import matching_engine
 from dao.database import async_session_maker
+from datetime import datetime, timedelta
+from uuid import uuid4
+from sqlalchemy import delete, event, insert
+from misc.db_models import Candle, Transaction
 
 @pytest.mark.asyncio
 async def test_register_user(client, auth_client, filled_test_db):
@@ -42,6 +47,17 @@ async def test_get_orderbook(auth_client, filled_test_db):
     assert len(L2OrderBook.model_validate(response.json()).bid_levels) == 2
 
 
+@pytest.mark.asyncio
+async def test_orderbook_does_not_use_db(client, filled_test_db):
+    # Стакан отдается из памяти движка: сессия БД (и слот пула) ему не нужна
+    def no_db():
+        raise AssertionError("orderbook endpoint must not request a DB session")
+    app.dependency_overrides[get_db] = no_db
+    response = client.get("/api/v1/public/orderbook/AAPL")
+    assert response.status_code == 200
+    assert len(L2OrderBook.model_validate(response.json()).bid_levels) == 2
+
+
 @pytest.mark.asyncio
 async def test_get_transactions_history(auth_client, filled_test_db):
     response = auth_client.get("/api/v1/public/transactions/AAPL")
@@ -54,6 +70,68 @@ async def test_get_transactions_history(auth_client, filled_test_db):
     assert len(response.json()) == 1
 
 
+@pytest.mark.asyncio
+async def test_transactions_history_keyset_pages(auth_client, test_session, filled_test_db, test_users):
+    start = datetime(2026, 1, 1)
+    # По три сделки на одну метку времени: порядок внутри метки решает id
+    rows = [{
+        "id": uuid4(),
+        "buyer_id": test_users[0]["id"],
+        "seller_id": test_users[1]["id"],
+        "ticker": "GOOG",
+        "amount": i,
+        "price": 100,
+        "timestamp": start + timedelta(seconds=i // 3)} for i in range(25)]
+    async with test_session.begin():
+        await test_session.execute(delete(Transaction))
+        await test_session.execute(insert(Transaction), rows)
+    newest_first = [row["amount"] for row in sorted(rows, key=lambda row: (row["timestamp"], row["id"]), reverse=True)]
+
+    pages, cursor = [], None
+    while True:
+        response = auth_client.get("/api/v1/public/transactions/GOOG", params={"limit": 10, "before": cursor})
+        assert response.status_code == 200
+        if not response.json():
+            assert "X-Cursor-Before" not in response.headers
+            break
+        pages.append([item["amount"] for item in response.json()])
+        cursor = response.headers["X-Cursor-Before"]
+    assert [len(page) for page in pages] == [10, 10, 5]
+    assert sum(pages, []) == newest_first
+
+    # Вперед от самой старой страницы: страница сразу за курсором, снова новые первыми
+    response = auth_client.get("/api/v1/public/transactions/GOOG", params={"limit": 10, "after": cursor})
+    assert [item["amount"] for item in response.json()] == newest_first[14:24]
+    after = response.headers["X-Cursor-After"]
+    response = auth_client.get("/api/v1/public/transactions/GOOG", params={"limit": 10, "after": after})
+    assert [item["amount"] for item in response.json()] == newest_first[4:14]
+
+    assert auth_client.get("/api/v1/public/transactions/GOOG", params={"before": "garbage"}).status_code == 400
+
+
+@pytest.mark.asyncio
+async def test_get_candles(auth_client, test_session, filled_test_db):
+    start = datetime(2026, 1, 1)
+    async with test_session.begin():
+        await test_session.execute(insert(Candle), [{
+            "ticker": "AAPL", "resolution": 60, "start": start + timedelta(minutes=i),
+            "open": 100, "high": 110 + i, "low": 90, "close": 105, "volume": i,
+            "open_at": start + timedelta(minutes=i), "close_at": start + timedelta(minutes=i)} for i in range(5)])
+    response = auth_client.get("/api/v1/public/candles/AAPL", params={
+        "resolution": "1m", "start": "2026-01-01T00:01:00", "end": "2026-01-01T00:04:00"})
+    assert response.status_code == 200
+    assert [candle["high"] for candle in response.json()] == [111, 112, 113]
+    try:
+        CandleResponse.model_validate(response.json()[0])
+    except ValidationError as e:
+        pytest.fail(f"Response doesn't match schema: {e}")
+    # Без start - последние limit свечей, по возрастанию времени
+    response = auth_client.get("/api/v1/public/candles/AAPL", params={"resolution": "1m", "limit": 2})
+    assert [candle["volume"] for candle in response.json()] == [3, 4]
+    assert auth_client.get("/api/v1/public/candles/AAPL", params={"resolution": "1h"}).json() == []
+    assert auth_client.get("/api/v1/public/candles/AAPL", params={"resolution": "2m"}).status_code == 422
+
+
 @pytest.mark.asyncio
 async def test_get_balances_unauthorized(client, filled_test_db):
     response = client.get("/api/v1/balance")
@@ -223,6 +301,33 @@ async def test_delete_user(admin_client, filled_test_db, test_instruments, test_
     assert response.json()["id"] == str(test_users[0]['id'])
 
 
+@pytest.mark.asyncio
+async def test_auth_cache(auth_client, admin_client, client, test_session, filled_test_db, test_users):
+    statements = []
+    def count_statement(conn, cursor, statement, parameters, context, executemany):
+        if statement.startswith("SELECT users"):
+            statements.append(statement)
+    event.listen(test_session.bind.sync_engine, "before_cursor_execute", count_statement)
+    try:
+        for _ in range(3):
+            assert auth_client.get("/api/v1/order").status_code == status.HTTP_200_OK
+        # Ключ пользователя не открывает админские методы, даже из кэша
+        response = auth_client.delete(f"/api/v1/admin/user/{test_users[1]['id']}")
+        assert response.status_code == status.HTTP_403_FORBIDDEN
+        unknown = {"Authorization": f"{token} key-{uuid4()}"}
+        for _ in range(3):
+            assert client.get("/api/v1/order", headers=unknown).status_code == status.HTTP_403_FORBIDDEN
+    finally:
+        event.remove(test_session.bind.sync_engine, "before_cursor_execute", count_statement)
+    # По одному запросу в БД на ключ, дальше - из кэша, в том числе ненайденный ключ
+    assert len(statements) == 2
+
+    # Удаление пользователя сбрасывает его ключ
+    response = admin_client.delete(f"/api/v1/admin/user/{test_users[0]['id']}")
+    assert response.status_code == status.HTTP_200_OK
+    assert auth_client.get("/api/v1/order").status_code == status.HTTP_403_FORBIDDEN
+
+
 @pytest.mark.asyncio
 async def test_create_instrument(admin_client, filled_test_db, test_instruments, test_orders, test_users):
     response = admin_client.post(
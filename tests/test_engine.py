@@ -1,10 +1,21 @@
+import asyncio
+import os
+import random
 import pytest
+from datetime import datetime, timedelta, timezone
+from uuid import uuid4
 from dao.dao import OrderDAO, BalanceDAO, TransactionDAO, InstrumentDAO
 from schemas.create import MarketOrderCreate, LimitOrderCreate 
 from schemas.request import BalanceRequest, IdRequest, InstrumentRequest
 from misc.enums import DirectionEnum, StatusEnum, OrderEnum
-from services.orderbook import OrderBook
-from services.matching import MatchingEngine
+from services.orderbook import OrderBook, PriceLevelOrderBook
+from services.matching import MatchingEngine, run_matching_engine
+from misc.db_models import Instrument, Order
+from misc.internal_classes import InternalOrder, TradeExecution
+from services.settlement import SettlementBatcher
+from services.snapshot import dump_book, read_snapshot, write_snapshot
+from services.journal import Journal, replay
+from services.tape import TradeTape
 
 
 @pytest.mark.asyncio
@@ -255,4 +266,627 @@ async def test_engine_match_all_with_full_verification(
     assert new_seller_rub.amount == initial_seller_rub_amount + 50
     assert new_seller_token.amount == initial_seller_token_amount # Баланс меняется в services
 
-    assert len(transactions) == 2  
\ No newline at end of file
+    assert len(transactions) == 2  
+
+def make_order(direction: DirectionEnum, price: int | None, qty: int, order_type: OrderEnum = OrderEnum.LIMIT, ticker: str = "AAPL") -> Order:
+    return Order(
+        id=uuid4(),
+        user_id=uuid4(),
+        ticker=ticker,
+        direction=direction,
+        qty=qty,
+        price=price,
+        filled=0,
+        status=StatusEnum.NEW,
+        order_type=order_type,
+        timestamp=datetime.now(timezone.utc))
+
+
+@pytest.mark.parametrize("book_class", [OrderBook, PriceLevelOrderBook])
+def test_cancel_order_uses_id_index(book_class):
+    book = book_class("AAPL")
+    orders = [make_order(DirectionEnum.BUY, 10 + i, 1) for i in range(5)] + [make_order(DirectionEnum.SELL, 100 + i, 1) for i in range(5)]
+    for order in orders:
+        book.add_limit_order(order)
+    assert len(book.orders) == 10
+
+    assert book.cancel_order(orders[2])
+    assert book.cancel_order(orders[7])
+    assert not book.cancel_order(orders[2])
+    assert not book.cancel_order(make_order(DirectionEnum.BUY, 10, 1))
+    assert len(book.get_bids()) == 4
+    assert len(book.get_asks()) == 4
+    assert orders[2].id.int not in book.orders and orders[7].id.int not in book.orders
+
+
+def test_price_level_cancel_keeps_fifo():
+    book = PriceLevelOrderBook("AAPL")
+    orders = [make_order(DirectionEnum.SELL, 100, 1) for _ in range(5)]
+    for order in orders:
+        book.add_limit_order(order)
+    # Отмена из середины и с головы уровня, затем повторное добавление того же ордера - в хвост
+    assert book.cancel_order(orders[2]) and book.cancel_order(orders[0])
+    book.restore([InternalOrder.from_db(orders[0])])
+    assert [order.id for order in book.get_asks()] == [orders[i].id for i in (1, 3, 4, 0)]
+    assert book.ask_levels[100].qty == 4
+
+    book.add_limit_order(make_order(DirectionEnum.BUY, 100, 2))
+    book.matching_orders()
+    assert [order.id for order in book.get_asks()] == [orders[4].id, orders[0].id]
+
+
+@pytest.mark.parametrize("book_class", [OrderBook, PriceLevelOrderBook])
+def test_id_index_follows_matching_and_market_orders(book_class):
+    book = book_class("AAPL")
+    ask1 = make_order(DirectionEnum.SELL, 10, 2)
+    ask2 = make_order(DirectionEnum.SELL, 11, 2)
+    bid = make_order(DirectionEnum.BUY, 10, 3)
+    for order in (ask1, ask2, bid):
+        book.add_limit_order(order)
+
+    trades = book.matching_orders()
+    assert len(trades) == 1
+    assert set(book.orders) == {ask2.id.int, bid.id.int}
+
+    trades = book.add_market_order(make_order(DirectionEnum.BUY, None, 2, OrderEnum.MARKET), balance=1000)
+    assert len(trades) == 1
+    assert set(book.orders) == {bid.id.int}
+    assert not book.cancel_order(ask2)
+    assert book.cancel_order(bid)
+    assert not book.orders
+
+
+@pytest.mark.parametrize("book_class", [OrderBook, PriceLevelOrderBook])
+def test_undo_market_order_restores_book(book_class):
+    book = book_class("AAPL")
+    asks = [make_order(DirectionEnum.SELL, 10, 2), make_order(DirectionEnum.SELL, 10, 2), make_order(DirectionEnum.SELL, 11, 2)]
+    for order in asks:
+        book.add_limit_order(order)
+    book.add_limit_order(make_order(DirectionEnum.BUY, 9, 1))
+    book.add_market_order(make_order(DirectionEnum.BUY, None, 1, OrderEnum.MARKET), balance=1000)
+    before = dump_book(book)
+    cost = book.fill_cost(DirectionEnum.BUY, 6)
+
+    trades = book.add_market_order(make_order(DirectionEnum.BUY, None, 4, OrderEnum.MARKET), balance=1000)
+    assert [trade.executed_qty for trade in trades] == [1, 2, 1]
+    book.undo_market_order(trades)
+    # Снятые ордера вернулись в голову своей очереди, частично исполненный сохранил место
+    assert dump_book(book) == before
+    assert [order.id for order in book.get_asks()] == [order.id for order in asks]
+    assert book.fill_cost(DirectionEnum.BUY, 6) == cost
+    assert [order.status for order in book.get_asks()] == [StatusEnum.PARTIALLY_EXECUTED, StatusEnum.NEW, StatusEnum.NEW]
+
+
+def test_price_level_book_matches_like_sorted_book():
+    random.seed(7)
+    sorted_book = OrderBook("AAPL")
+    level_book = PriceLevelOrderBook("AAPL")
+    resting = []
+    for step in range(300):
+        action = random.random()
+        if action < 0.6 or not resting:
+            order = make_order(random.choice([DirectionEnum.BUY, DirectionEnum.SELL]), random.randint(95, 105), random.randint(1, 5))
+            resting.append(order)
+            sorted_book.add_limit_order(order)
+            level_book.add_limit_order(order)
+        elif action < 0.8:
+            order = resting.pop(random.randrange(len(resting)))
+            assert sorted_book.cancel_order(order) == level_book.cancel_order(order)
+        else:
+            order = make_order(random.choice([DirectionEnum.BUY, DirectionEnum.SELL]), None, random.randint(1, 10), OrderEnum.MARKET)
+            sorted_trades = sorted_book.add_market_order(order, balance=10**9)
+            level_trades = level_book.add_market_order(order, balance=10**9)
+            assert [(t.bid_order.id, t.ask_order.id, t.executed_qty, t.execution_price) for t in sorted_trades] == \
+                [(t.bid_order.id, t.ask_order.id, t.executed_qty, t.execution_price) for t in level_trades]
+
+        if step % 10 == 0:
+            sorted_trades = sorted_book.matching_orders()
+            level_trades = level_book.matching_orders()
+            assert [(t.bid_order.id, t.ask_order.id, t.executed_qty, t.execution_price) for t in sorted_trades] == \
+                [(t.bid_order.id, t.ask_order.id, t.executed_qty, t.execution_price) for t in level_trades]
+
+        assert [(o.id, o.filled) for o in sorted_book.get_bids()] == [(o.id, o.filled) for o in level_book.get_bids()]
+        assert [(o.id, o.filled) for o in sorted_book.get_asks()] == [(o.id, o.filled) for o in level_book.get_asks()]
+
+    for levels in (level_book.bid_levels, level_book.ask_levels):
+        for price, level in levels.items():
+            assert level.qty == sum(o.remaining for o in level.orders.values())
+
+
+@pytest.mark.parametrize("book_class", [OrderBook, PriceLevelOrderBook])
+def test_depth_is_maintained_incrementally(book_class):
+    random.seed(11)
+    book = book_class("AAPL")
+    resting = []
+    for step in range(300):
+        if random.random() < 0.7 or not resting:
+            order = make_order(random.choice([DirectionEnum.BUY, DirectionEnum.SELL]), random.randint(95, 105), random.randint(1, 5))
+            resting.append(order)
+            book.add_limit_order(order)
+        else:
+            book.cancel_order(resting.pop(random.randrange(len(resting))))
+        if step % 7 == 0:
+            book.matching_orders()
+
+        for direction, orders in ((DirectionEnum.BUY, book.get_bids()), (DirectionEnum.SELL, book.get_asks())):
+            expected = {}
+            for order in orders:
+                expected[order.price] = expected.get(order.price, 0) + order.remaining
+            depth = book.get_depth(direction, limit=100)
+            assert dict(depth) == expected
+            assert [price for price, _ in depth] == sorted(expected, reverse=direction == DirectionEnum.BUY)
+            assert book.get_depth(direction, limit=3) == depth[:3]
+
+
+@pytest.mark.asyncio
+async def test_engine_picks_book_class_per_instrument(test_session, filled_test_db, test_instruments):
+    matching_engine = MatchingEngine(interval=1.0, book_classes={test_instruments[0]['ticker']: PriceLevelOrderBook})
+    await matching_engine.startup(session=test_session)
+    assert isinstance(matching_engine.books[test_instruments[0]['ticker']], PriceLevelOrderBook)
+    assert isinstance(matching_engine.books[test_instruments[1]['ticker']], OrderBook)
+    assert len(matching_engine.get_bids_from_book(test_instruments[0]['ticker'])) == 2
+
+
+def test_compact_internal_order_round_trip():
+    order = make_order(DirectionEnum.SELL, 42, 7)
+    internal = InternalOrder.from_db(order)
+    assert not hasattr(internal, "__dict__")
+    assert internal.id == order.id
+    assert internal.user_id == order.user_id
+    assert internal.direction == DirectionEnum.SELL
+    assert internal.order_type == OrderEnum.LIMIT
+    assert internal.status == StatusEnum.NEW
+    assert internal.timestamp == order.timestamp
+    assert internal.ticker is InternalOrder.from_db(make_order(DirectionEnum.BUY, 1, 1)).ticker
+
+    internal.filled = 7
+    internal.status = StatusEnum.EXECUTED
+    assert internal.remaining == 0
+    assert internal.status == StatusEnum.EXECUTED
+
+
+@pytest.mark.parametrize("book_class", [OrderBook, PriceLevelOrderBook])
+def test_fill_cost_matches_linear_walk(book_class):
+    random.seed(5)
+    book = book_class("AAPL")
+    resting = []
+    for step in range(400):
+        action = random.random()
+        if action < 0.6 or not resting:
+            order = make_order(random.choice([DirectionEnum.BUY, DirectionEnum.SELL]), random.randint(90, 110), random.randint(1, 5))
+            resting.append(order)
+            book.add_limit_order(order)
+        elif action < 0.8:
+            book.cancel_order(resting.pop(random.randrange(len(resting))))
+        else:
+            book.add_market_order(make_order(random.choice([DirectionEnum.BUY, DirectionEnum.SELL]), None, random.randint(1, 8), OrderEnum.MARKET), balance=10**9)
+        if step % 9 == 0:
+            book.matching_orders()
+
+        for direction, opposite in ((DirectionEnum.BUY, book.get_asks()), (DirectionEnum.SELL, book.get_bids())):
+            qty = random.randint(1, 40)
+            available, cost, left = 0, 0, qty
+            for order in opposite:
+                take = min(order.remaining, left)
+                available += take
+                cost += take * order.price
+                left -= take
+                if not left:
+                    break
+            assert book.fill_cost(direction, qty) == (available, cost)
+
+
+@pytest.mark.parametrize("book_class", [OrderBook, PriceLevelOrderBook])
+def test_cumulative_depth_survives_level_churn(book_class):
+    book = book_class("AAPL")
+    asks = {price: make_order(DirectionEnum.SELL, price, 2) for price in range(100, 110)}
+    for order in asks.values():
+        book.add_limit_order(order)
+    assert book.fill_cost(DirectionEnum.BUY, 5) == (5, 100 * 2 + 101 * 2 + 102)
+    depth = book.cumulative[DirectionEnum.SELL]
+
+    # Уровни исчезают (отмена, рыночный ордер) и появляются снова: индекс меняется на месте
+    book.cancel_order(asks[100])
+    book.add_market_order(make_order(DirectionEnum.BUY, None, 2, OrderEnum.MARKET), balance=10**6)
+    assert depth.valid
+    assert book.fill_cost(DirectionEnum.BUY, 3) == (3, 102 * 2 + 103)
+    book.add_limit_order(make_order(DirectionEnum.SELL, 100, 1))
+    assert depth.valid
+    assert book.fill_cost(DirectionEnum.BUY, 3) == (3, 100 + 102 * 2)
+
+    # Цены, которой в индексе нет, он не знает: перестройка при следующем запросе
+    book.add_limit_order(make_order(DirectionEnum.SELL, 99, 1))
+    assert not depth.valid
+    assert book.fill_cost(DirectionEnum.BUY, 2) == (2, 99 + 100)
+    assert depth.valid
+
+
+class CountingSessionFactory:
+    """Фабрика сессий-заглушек: считает, сколько раз цикл сопоставления брал сессию."""
+
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        return self
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        return False
+
+    def begin(self):
+        return self
+
+    def in_transaction(self):
+        return True
+
+
+@pytest.mark.asyncio
+async def test_matching_loop_sleeps_until_book_is_crossed(monkeypatch):
+    settled = []
+
+    async def fake_execute_trade(session, executions):
+        settled.extend(executions)
+
+    monkeypatch.setattr("services.matching.trade_executor.execute_trade", fake_execute_trade)
+    engine = MatchingEngine(interval=0.001)
+    book = OrderBook("AAPL")
+    engine.books["AAPL"] = book
+    factory = CountingSessionFactory()
+    task = asyncio.create_task(run_matching_engine(engine, factory))
+    try:
+        engine.add_limit_order(make_order(DirectionEnum.BUY, 10, 1))
+        engine.add_limit_order(make_order(DirectionEnum.SELL, 11, 1))
+        await asyncio.sleep(0.05)
+        assert factory.calls == 0 # Книга не пересечена - соединение не берем
+
+        engine.add_limit_order(make_order(DirectionEnum.SELL, 10, 1))
+        await asyncio.sleep(0.05)
+        assert factory.calls == 1
+        assert len(settled) == 1
+        assert not book.is_crossed()
+
+        await asyncio.sleep(0.05)
+        assert factory.calls == 1
+    finally:
+        task.cancel()
+
+
+@pytest.mark.asyncio
+async def test_book_actors_settle_tickers_independently(monkeypatch):
+    settled = []
+    release_slow = asyncio.Event()
+
+    async def fake_execute_trade(session, executions):
+        ticker = executions[0].bid_order.ticker
+        if ticker == "SLOW":
+            await release_slow.wait()
+        if ticker == "FAIL":
+            raise RuntimeError("settlement failed")
+        settled.append(ticker)
+
+    monkeypatch.setattr("services.matching.trade_executor.execute_trade", fake_execute_trade)
+    engine = MatchingEngine(interval=0)
+    for ticker in ("SLOW", "FAIL", "FAST"):
+        engine.books[ticker] = OrderBook(ticker)
+    task = asyncio.create_task(run_matching_engine(engine, CountingSessionFactory()))
+    try:
+        await asyncio.sleep(0)
+        assert set(engine.actors) == {"SLOW", "FAIL", "FAST"}
+        for ticker in ("SLOW", "FAIL", "FAST"):
+            engine.add_limit_order(make_order(DirectionEnum.BUY, 10, 1, ticker=ticker))
+            engine.add_limit_order(make_order(DirectionEnum.SELL, 10, 1, ticker=ticker))
+        await asyncio.sleep(0.05)
+        # Зависшая и упавшая книги не мешают остальным
+        assert settled == ["FAST"]
+        assert engine.books["SLOW"].lock.locked()
+
+        engine.add_limit_order(make_order(DirectionEnum.BUY, 10, 1, ticker="FAIL"))
+        engine.add_limit_order(make_order(DirectionEnum.SELL, 10, 1, ticker="FAST"))
+        engine.add_limit_order(make_order(DirectionEnum.BUY, 10, 1, ticker="FAST"))
+        await asyncio.sleep(0.05)
+        assert settled == ["FAST", "FAST"]
+
+        release_slow.set()
+        await asyncio.sleep(0.05)
+        assert settled == ["FAST", "FAST", "SLOW"]
+    finally:
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+    assert engine.actors == {}
+
+
+def test_crossed_set_tracks_only_books_that_can_trade():
+    engine = MatchingEngine()
+    for ticker in ("AAPL", "GOOG"):
+        engine.books[ticker] = OrderBook(ticker)
+
+    bid = make_order(DirectionEnum.BUY, 10, 2)
+    engine.add_limit_order(bid)
+    ask = make_order(DirectionEnum.SELL, 12, 1)
+    engine.add_limit_order(ask)
+    assert engine.crossed == set()
+
+    crossing_ask = make_order(DirectionEnum.SELL, 10, 1)
+    engine.add_limit_order(crossing_ask)
+    assert engine.crossed == {"AAPL"}
+
+    # Отмена снимает пересечение
+    engine.cancel_order(crossing_ask)
+    assert engine.crossed == set()
+
+    engine.add_limit_order(make_order(DirectionEnum.SELL, 9, 1))
+    assert engine.crossed == {"AAPL"}
+    # Рыночный ордер съедает лучший bid, книга перестает быть пересеченной
+    engine.add_market_order(make_order(DirectionEnum.SELL, None, 2, OrderEnum.MARKET), balance=10)
+    assert engine.crossed == set()
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("book_class", [OrderBook, PriceLevelOrderBook])
+async def test_snapshot_round_trip(book_class, tmp_path):
+    engine = MatchingEngine(book_class=book_class)
+    for ticker in ("AAPL", "GOOG"):
+        engine.books[ticker] = book_class(ticker)
+    rng = random.Random(7)
+    for _ in range(200):
+        order = make_order(rng.choice([DirectionEnum.BUY, DirectionEnum.SELL]), rng.randint(90, 110), rng.randint(1, 5))
+        engine.add_limit_order(order)
+    engine.books["AAPL"].matching_orders()
+
+    path = str(tmp_path / "books.snapshot")
+    high_water_mark = await write_snapshot(engine, path)
+    loaded_mark, journal_seq, books, book_seqs = read_snapshot(path)
+
+    assert loaded_mark == high_water_mark
+    assert journal_seq == 0
+    assert book_seqs == {"AAPL": 0, "GOOG": 0}
+    assert books["GOOG"] == []
+    restored = book_class("AAPL")
+    restored.restore(books["AAPL"])
+    assert repr(list(restored.get_bids())) == repr(list(engine.books["AAPL"].get_bids()))
+    assert repr(list(restored.get_asks())) == repr(list(engine.books["AAPL"].get_asks()))
+    assert restored.get_depth(DirectionEnum.BUY, 100) == engine.books["AAPL"].get_depth(DirectionEnum.BUY, 100)
+
+
+@pytest.mark.asyncio
+async def test_snapshot_waits_for_book_locks(tmp_path):
+    engine = MatchingEngine()
+    book = engine.books["AAPL"] = OrderBook("AAPL")
+    path = str(tmp_path / "books.snapshot")
+    first = make_order(DirectionEnum.BUY, 100, 3)
+    engine.add_limit_order(first)
+
+    # Идет цикл сопоставления: снапшот ждет его замка и снимает книгу после него
+    async with book.lock:
+        writing = asyncio.create_task(write_snapshot(engine, path))
+        await asyncio.sleep(0.01)
+        assert not writing.done()
+        second = make_order(DirectionEnum.BUY, 101, 1)
+        engine.add_limit_order(second)
+    await writing
+    _, _, books, _ = read_snapshot(path)
+    assert [order.id for order in books["AAPL"]] == [second.id, first.id]
+
+
+@pytest.mark.asyncio
+async def test_snapshot_takes_books_one_at_a_time(tmp_path):
+    journal_path, snapshot_path = str(tmp_path / "engine.journal"), str(tmp_path / "books.snapshot")
+    journal = Journal(journal_path)
+    engine = MatchingEngine(journal=journal)
+    for ticker in ("AAPL", "GOOG"):
+        engine.books[ticker] = OrderBook(ticker)
+        engine.add_limit_order(make_order(DirectionEnum.BUY, 100, 3, ticker=ticker))
+    journal.rotate(engine.books)
+
+    # Пока снапшот ждет замок GOOG, AAPL уже снята и отпущена; обе книги меняются дальше
+    async with engine.books["GOOG"].lock:
+        writing = asyncio.create_task(write_snapshot(engine, snapshot_path))
+        await asyncio.sleep(0.01)
+        assert not writing.done()
+        assert not engine.books["AAPL"].lock.locked()
+        for ticker in ("AAPL", "GOOG"):
+            engine.add_limit_order(make_order(DirectionEnum.SELL, 101, 1, ticker=ticker))
+    await writing
+    engine.add_limit_order(make_order(DirectionEnum.SELL, 102, 1, ticker="GOOG"))
+    journal.close()
+
+    # Каждая книга проигрывает журнал со своего номера: ордер GOOG, попавший в снапшот, не задваивается
+    _, journal_seq, books, book_seqs = read_snapshot(snapshot_path)
+    assert journal_seq == book_seqs["AAPL"] < book_seqs["GOOG"]
+    assert len(books["AAPL"]) == 1 and len(books["GOOG"]) == 2
+    restarted = MatchingEngine()
+    for ticker, orders in books.items():
+        restarted.books[ticker] = OrderBook(ticker)
+        restarted.books[ticker].restore(orders)
+    assert replay(journal_path, restarted, after=journal_seq, book_after=book_seqs)[0] == journal.seq
+    for ticker, book in engine.books.items():
+        assert dump_book(restarted.books[ticker]) == dump_book(book)
+
+
+@pytest.mark.asyncio
+async def test_journal_replay_rebuilds_books_byte_for_byte(tmp_path, monkeypatch):
+    async def fake_execute_trade(session, executions):
+        pass
+
+    monkeypatch.setattr("services.matching.trade_executor.execute_trade", fake_execute_trade)
+    path = str(tmp_path / "engine.journal")
+    journal = Journal(path)
+    engine = MatchingEngine(book_classes={"GOOG": PriceLevelOrderBook}, journal=journal)
+    engine.books["AAPL"] = OrderBook("AAPL")
+    engine.add_limit_order(make_order(DirectionEnum.BUY, 100, 3))
+    journal.rotate(engine.books)
+    engine.add_instrument(Instrument(ticker="GOOG", name="Alphabet"))
+
+    rng = random.Random(11)
+    resting = []
+    for i in range(400):
+        ticker = rng.choice(["AAPL", "GOOG"])
+        direction = rng.choice([DirectionEnum.BUY, DirectionEnum.SELL])
+        action = rng.random()
+        if action < 0.6:
+            engine.inline_matching = rng.random() < 0.3
+            order = make_order(direction, rng.randint(95, 105), rng.randint(1, 5), ticker=ticker)
+            engine.add_limit_order(order)
+            resting.append(order)
+        elif action < 0.75:
+            order = make_order(direction, None, rng.randint(1, 8), OrderEnum.MARKET, ticker=ticker)
+            executions = engine.add_market_order(order, balance=rng.randint(0, 2000))
+            if rng.random() < 0.3:
+                # Проведение не удалось, книга откатывает сделки ордера
+                engine.undo_market_order(order, executions)
+        elif action < 0.9 and resting:
+            engine.cancel_order(resting.pop(rng.randrange(len(resting))))
+        else:
+            await engine.match_book(None, ticker)
+    journal.close()
+
+    replayed = MatchingEngine(book_classes={"GOOG": PriceLevelOrderBook})
+    seq, _ = replay(path, replayed)
+    assert seq == journal.seq
+    assert replayed.books.keys() == engine.books.keys()
+    for ticker, book in engine.books.items():
+        assert type(replayed.books[ticker]) is type(book)
+        assert dump_book(replayed.books[ticker]) == dump_book(book)
+    assert replayed.crossed == engine.crossed
+
+    # Недописанная последняя запись (падение посреди write) отбрасывается
+    with open(path, "ab") as f:
+        f.write(b"\x10\x00\x00\x00garbage")
+    assert replay(path, MatchingEngine())[0] == seq
+
+
+@pytest.mark.asyncio
+async def test_snapshot_checkpoints_journal(tmp_path):
+    journal_path = str(tmp_path / "engine.journal")
+    snapshot_path = str(tmp_path / "books.snapshot")
+    journal = Journal(journal_path)
+    engine = MatchingEngine(journal=journal, inline_matching=True)
+    engine.books["AAPL"] = OrderBook("AAPL")
+    journal.rotate(engine.books)
+    rng = random.Random(5)
+
+    def add_orders(count):
+        for _ in range(count):
+            engine.add_limit_order(make_order(rng.choice([DirectionEnum.BUY, DirectionEnum.SELL]), rng.randint(95, 105), rng.randint(1, 5)))
+
+    add_orders(200)
+    journal.flush()
+    size = os.path.getsize(journal_path)
+    # Снапшот отрезает от журнала все, что покрывает; записи после него остаются
+    await write_snapshot(engine, snapshot_path)
+    assert os.path.getsize(journal_path) == 0
+    add_orders(50)
+    journal.close()
+    assert 0 < os.path.getsize(journal_path) < size
+
+    _, journal_seq, books, book_seqs = read_snapshot(snapshot_path)
+    restarted = MatchingEngine()
+    restarted.books["AAPL"] = OrderBook("AAPL")
+    restarted.books["AAPL"].restore(books["AAPL"])
+    seq, _ = replay(journal_path, restarted, after=journal_seq, book_after=book_seqs)
+    assert seq == journal.seq
+    assert dump_book(restarted.books["AAPL"]) == dump_book(engine.books["AAPL"])
+
+    # Без снапшота хвост журнала не с чего проигрывать
+    with pytest.raises(ValueError):
+        replay(journal_path, MatchingEngine())
+
+
+@pytest.mark.asyncio
+async def test_settlement_batcher_groups_cycles_and_isolates_failures(monkeypatch):
+    committed = []
+
+    async def fake_execute_trade(session, executions):
+        if any(execution.executed_qty == 13 for execution in executions):
+            raise ValueError("bad execution")
+        committed.append(len(executions))
+
+    monkeypatch.setattr("services.settlement.trade_executor.execute_trade", fake_execute_trade)
+    factory = CountingSessionFactory()
+    batcher = SettlementBatcher(max_delay=0.05, max_executions=5)
+    batcher.start(factory)
+
+    def executions(qty: int, count: int = 1):
+        return [TradeExecution(InternalOrder.from_db(make_order(DirectionEnum.BUY, 10, qty)),
+                               InternalOrder.from_db(make_order(DirectionEnum.SELL, 10, qty)), qty, 10)
+                for _ in range(count)]
+    try:
+        # Три цикла по разным тикерам укладываются в одну транзакцию
+        await asyncio.gather(*(batcher.submit(executions(1)) for _ in range(3)))
+        assert committed == [3]
+        assert factory.calls == 1
+
+        # Лимит по числу сделок закрывает пачку раньше задержки
+        await asyncio.gather(batcher.submit(executions(1, 4)), batcher.submit(executions(1, 2)), batcher.submit(executions(1)))
+        assert committed == [3, 6, 1]
+
+        # Упавшая отправка не роняет соседей по пачке
+        good = batcher.submit(executions(1))
+        bad = batcher.submit(executions(13))
+        await good
+        with pytest.raises(ValueError):
+            await bad
+        assert committed[-1] == 1
+        stats = batcher.stats()
+        assert stats["batches"] == 4 and stats["fallbacks"] == 1 and stats["max_batch_executions"] == 6
+    finally:
+        await batcher.stop()
+
+
+@pytest.mark.asyncio
+async def test_settlement_batcher_stop_drains_queue(monkeypatch):
+    committed = []
+
+    async def fake_execute_trade(session, executions):
+        committed.append(len(executions))
+
+    monkeypatch.setattr("services.settlement.trade_executor.execute_trade", fake_execute_trade)
+    batcher = SettlementBatcher(max_delay=10, max_executions=2)
+    batcher.start(CountingSessionFactory())
+    futures = [batcher.submit([TradeExecution(
+        InternalOrder.from_db(make_order(DirectionEnum.BUY, 10, 1)),
+        InternalOrder.from_db(make_order(DirectionEnum.SELL, 10, 1)), 1, 10)]) for _ in range(5)]
+    # Остановка не ждет задержки пачки и не теряет очередь
+    await asyncio.wait_for(batcher.stop(), 1)
+    assert committed == [2, 2, 1]
+    assert all(future.done() and future.exception() is None for future in futures)
+    with pytest.raises(RuntimeError):
+        batcher.submit([])
+
+
+def test_trade_tape():
+    tape = TradeTape(capacity=3)
+    start = tape.seq
+    base = datetime(2026, 1, 1, tzinfo=timezone.utc)
+
+    def trade(second: int, ticker: str = "AAPL") -> dict:
+        return {"id": uuid4(), "buyer_id": uuid4(), "seller_id": uuid4(), "ticker": ticker,
+                "amount": second, "price": 100, "timestamp": base + timedelta(seconds=second)}
+
+    tape.record([trade(1), trade(3)])
+    # Закоммичена позже, но по времени раньше: встает по ключу истории, номер - по commit
+    tape.record([trade(2), trade(1, "GOOG")])
+    assert [t.amount for t in tape.latest("AAPL", 3)] == [3, 2, 1]
+    assert [t.seq - start for t in tape.latest("AAPL", 3)] == [2, 4, 1]
+    assert tape.latest("AAPL", 4) is None
+    assert [t.amount for t in tape.since("AAPL", start + 1, 10)] == [3, 2]
+    # Ограничение по limit берет первые по номеру, чтобы поллер продолжил с последнего отданного
+    assert [t.amount for t in tape.since("AAPL", start, 2)] == [3, 1]
+    assert tape.since("AAPL", start + 4, 10) == []
+
+    tape.record([trade(4)])
+    assert [t.amount for t in tape.latest("AAPL", 3)] == [4, 3, 2]
+    # Сделка 1 вытеснена: с ее номера лента не отвечает, как и с номеров до старта и из будущего
+    assert tape.since("AAPL", start, 10) is None
+    assert [t.amount for t in tape.since("AAPL", start + 1, 10)] == [4, 3, 2]
+    assert tape.since("AAPL", start - 1, 10) is None
+    assert tape.since("AAPL", tape.seq + 1, 10) is None
+    assert tape.since("GOOG", start, 10)[0].amount == 1
+
+    tape.clear()
+    assert tape.seq >= start + 5
+    assert tape.latest("AAPL", 1) is None
@@ -1,16 +1,34 @@
+import asyncio
 from sqlalchemy.ext.asyncio import AsyncSession
 import pytest
-from dao.dao import BalanceDAO, UserDAO, InstrumentDAO, OrderDAO
-from services.public import register_user, get_instruments_list, get_transactions_history, get_orderbook
+from dao.dao import BalanceDAO, UserDAO, InstrumentDAO, OrderDAO, TransactionDAO, SettlementOutboxDAO, CandleDAO
+from services.public import register_user, get_instruments_list, get_transactions_history, get_transactions_page, get_orderbook, get_candles
 from services.balance import get_balances
 from services.order import create_market_order, create_limit_order, get_list_orders, get_order, cancel_order
 from services.admin import delete_user, add_instrument, delete_instrument, update_balance
-from schemas.request import NewUserRequest, TransactionRequest, MarketOrderRequest, LimitOrderRequest, UserAPIRequest, BalanceRequest, IdRequest, InstrumentRequest, TickerRequest, DepositRequest, WithdrawRequest
+from schemas.request import NewUserRequest, TransactionRequest, CandleRequest, MarketOrderRequest, LimitOrderRequest, OrderRequest, UserAPIRequest, BalanceRequest, IdRequest, InstrumentRequest, TickerRequest, DepositRequest, WithdrawRequest
 from schemas.response import InstrumentResponse, L2OrderBook
-from misc.enums import DirectionEnum, StatusEnum, VisibilityEnum
+from misc.enums import DirectionEnum, OrderEnum, ResolutionEnum, StatusEnum, VisibilityEnum
+from misc.db_models import Order, Transaction, User
+from misc.internal_classes import InternalOrder, TradeExecution
 from services.engine import matching_engine
 from services.matching import MatchingEngine
+from services.orderbook import PriceLevelOrderBook
+from services.snapshot import dump_book, write_snapshot
+from services.journal import Journal
+from services.trade_execution import trade_executor
+from services.settlement import OutboxWorkerPool, SettlementBatcher
+from services.ledger import BalanceLedger
+from services.balance_cache import BalanceCache
+from services.tape import TradeTape
+from services.candles import aggregate
+from dao.database import on_commit
+from sqlalchemy.ext.asyncio import async_sessionmaker
+from sqlalchemy import delete, event, update
+from sqlalchemy.exc import DBAPIError
 from fastapi import HTTPException, status
+from datetime import timedelta, timezone
+from uuid import uuid4
 
 
 @pytest.mark.asyncio
@@ -92,6 +110,74 @@ async def test_succesfully_create_market_order(test_session, default_init_db):
     assert seller_balance.amount == 30
 
 
+@pytest.mark.asyncio
+async def test_market_order_rolls_back_book_when_funds_are_gone(test_session, default_init_db, monkeypatch):
+    buyer = await register_user(NewUserRequest(name="buyer"), test_session)
+    seller = await register_user(NewUserRequest(name="seller"), test_session)
+    await add_instrument(test_session, InstrumentRequest(name="MEMECOIN", ticker="MEMECOIN"))
+    await update_balance(test_session, DepositRequest(user_id=buyer.id, ticker="RUB", amount=30))
+    await update_balance(test_session, DepositRequest(user_id=seller.id, ticker="MEMECOIN", amount=3))
+    await create_limit_order(test_session, seller.id, LimitOrderRequest(direction=DirectionEnum.SELL, ticker="MEMECOIN", qty=3, price=10))
+    book = matching_engine.books["MEMECOIN"]
+    depth = book.get_depth(DirectionEnum.SELL, 10)
+
+    # Остаток прочитан без блокировки, а до блокировки строк параллельный запрос его тратит
+    add = OrderDAO.add
+    async def add_with_competitor(session, values):
+        order = await add(session, values)
+        if values.order_type == OrderEnum.MARKET:
+            assert await BalanceDAO.block_balance(session, buyer.id, "RUB", 25)
+        return order
+    monkeypatch.setattr(OrderDAO, "add", add_with_competitor)
+    with pytest.raises(HTTPException) as e:
+        await create_market_order(test_session, buyer.id, MarketOrderRequest(direction=DirectionEnum.BUY, ticker="MEMECOIN", qty=3))
+    assert e.value.status_code == 400
+
+    # Книга вернулась к состоянию до ордера, транзакция откачена целиком
+    assert book.get_depth(DirectionEnum.SELL, 10) == depth
+    assert [(order.filled, order.status) for order in book.get_asks()] == [(0, StatusEnum.NEW)]
+    async with test_session.begin():
+        balance = await BalanceDAO.find_one_by_primary_key(test_session, BalanceRequest(user_id=buyer.id, ticker="RUB"))
+        assert (balance.amount, balance.blocked_amount) == (30, 0)
+        assert not await OrderDAO.find_all(test_session, OrderRequest(user_id=buyer.id))
+
+
+@pytest.mark.asyncio
+async def test_market_order_waits_for_book_cycle(test_session, default_init_db, monkeypatch):
+    seller = await register_user(NewUserRequest(name="seller"), test_session)
+    buyer = await register_user(NewUserRequest(name="buyer"), test_session)
+    other = await register_user(NewUserRequest(name="other"), test_session)
+    await add_instrument(test_session, InstrumentRequest(name="MEMECOIN", ticker="MEMECOIN"))
+    await update_balance(test_session, DepositRequest(user_id=seller.id, ticker="MEMECOIN", amount=3))
+    await update_balance(test_session, DepositRequest(user_id=buyer.id, ticker="RUB", amount=100))
+    await update_balance(test_session, DepositRequest(user_id=other.id, ticker="RUB", amount=100))
+    await create_limit_order(test_session, seller.id, LimitOrderRequest(direction=DirectionEnum.SELL, ticker="MEMECOIN", qty=3, price=10))
+    await create_limit_order(test_session, other.id, LimitOrderRequest(direction=DirectionEnum.BUY, ticker="MEMECOIN", qty=1, price=10))
+    ask = matching_engine.books["MEMECOIN"].get_asks()[0]
+
+    # Цикл актора свел книгу и проводит сделку; пока он держит книгу, запрос ее не трогает
+    settling, release = asyncio.Event(), asyncio.Event()
+    execute_trade = trade_executor.execute_trade
+    async def slow_execute_trade(session, executions, reserve=None):
+        if session is None:
+            settling.set()
+            await release.wait()
+            return
+        await execute_trade(session, executions, reserve)
+    monkeypatch.setattr(trade_executor, "execute_trade", slow_execute_trade)
+    cycle = asyncio.create_task(matching_engine.match_book(None, "MEMECOIN"))
+    await settling.wait()
+    market = asyncio.create_task(create_market_order(test_session, buyer.id, MarketOrderRequest(direction=DirectionEnum.BUY, ticker="MEMECOIN", qty=2)))
+    await asyncio.sleep(0.1)
+    assert not market.done()
+    assert ask.filled == 1
+
+    release.set()
+    await cycle
+    await market
+    assert (ask.filled, ask.status) == (3, StatusEnum.EXECUTED)
+
+
 @pytest.mark.asyncio
 async def test_unsuccesfully_create_market_order_with_no_money(test_session, filled_test_db, test_users, test_instruments):
     try:
@@ -359,4 +445,736 @@ async def test_cancel_executed_limit_order(test_session, default_init_db):
     tocken_balance_user1 = await BalanceDAO.find_one_or_none(test_session, BalanceRequest(user_id=user1.id, ticker="MEMECOIN"))
     tocken_balance_user2 = await BalanceDAO.find_one_or_none(test_session, BalanceRequest(user_id=user2.id, ticker="MEMECOIN"))
     assert tocken_balance_user1.amount == 2 
-    assert tocken_balance_user2.amount == 1
\ No newline at end of file
+    assert tocken_balance_user2.amount == 1
+
+@pytest.mark.asyncio
+async def test_inline_matching_on_limit_order(test_session, default_init_db):
+    user1 = await register_user(NewUserRequest(name="Tester"), test_session)
+    user2 = await register_user(NewUserRequest(name="Tester"), test_session)
+    await add_instrument(test_session, InstrumentRequest(name="MEMECOIN", ticker="MEMECOIN"))
+    await update_balance(test_session, DepositRequest(user_id=user1.id, ticker="MEMECOIN", amount=3))
+    await update_balance(test_session, DepositRequest(user_id=user2.id, ticker="RUB", amount=120))
+
+    matching_engine.inline_matching = True
+    try:
+        sell = await create_limit_order(test_session, user1.id, LimitOrderRequest(direction=DirectionEnum.SELL, ticker="MEMECOIN", qty=3, price=100))
+        buy = await create_limit_order(test_session, user2.id, LimitOrderRequest(direction=DirectionEnum.BUY, ticker="MEMECOIN", qty=1, price=120))
+    finally:
+        matching_engine.inline_matching = False
+
+    # Без match_all: сделка уже проведена в транзакции create_limit_order
+    sell_order = await OrderDAO.find_one_or_none(test_session, IdRequest(id=sell.order_id))
+    buy_order = await OrderDAO.find_one_or_none(test_session, IdRequest(id=buy.order_id))
+    assert buy_order.status == StatusEnum.EXECUTED
+    assert sell_order.status == StatusEnum.PARTIALLY_EXECUTED
+    assert sell_order.filled == 1
+
+    rub_balance_user1 = await BalanceDAO.find_one_or_none(test_session, BalanceRequest(user_id=user1.id, ticker="RUB"))
+    rub_balance_user2 = await BalanceDAO.find_one_or_none(test_session, BalanceRequest(user_id=user2.id, ticker="RUB"))
+    token_balance_user2 = await BalanceDAO.find_one_or_none(test_session, BalanceRequest(user_id=user2.id, ticker="MEMECOIN"))
+    assert rub_balance_user1.amount == 100
+    assert rub_balance_user2.amount == 20
+    assert token_balance_user2.amount == 1
+
+
+@pytest.mark.asyncio
+async def test_inline_matching_waits_for_book_cycle(test_session, default_init_db, monkeypatch):
+    seller = await register_user(NewUserRequest(name="seller"), test_session)
+    buyer = await register_user(NewUserRequest(name="buyer"), test_session)
+    other = await register_user(NewUserRequest(name="other"), test_session)
+    await add_instrument(test_session, InstrumentRequest(name="MEMECOIN", ticker="MEMECOIN"))
+    await update_balance(test_session, DepositRequest(user_id=seller.id, ticker="MEMECOIN", amount=3))
+    await update_balance(test_session, DepositRequest(user_id=buyer.id, ticker="RUB", amount=100))
+    await update_balance(test_session, DepositRequest(user_id=other.id, ticker="RUB", amount=100))
+    await create_limit_order(test_session, seller.id, LimitOrderRequest(direction=DirectionEnum.SELL, ticker="MEMECOIN", qty=3, price=10))
+    await create_limit_order(test_session, other.id, LimitOrderRequest(direction=DirectionEnum.BUY, ticker="MEMECOIN", qty=1, price=10))
+    ask = matching_engine.books["MEMECOIN"].get_asks()[0]
+
+    # Цикл актора проводит сделку, а пересекающий лимитный ордер сводится сразу при добавлении
+    settling, release = asyncio.Event(), asyncio.Event()
+    execute_trade = trade_executor.execute_trade
+    async def slow_execute_trade(session, executions, reserve=None):
+        if session is None:
+            settling.set()
+            await release.wait()
+            return
+        await execute_trade(session, executions, reserve)
+    monkeypatch.setattr(trade_executor, "execute_trade", slow_execute_trade)
+    cycle = asyncio.create_task(matching_engine.match_book(None, "MEMECOIN"))
+    await settling.wait()
+    monkeypatch.setattr(matching_engine, "inline_matching", True)
+    limit = asyncio.create_task(create_limit_order(test_session, buyer.id, LimitOrderRequest(direction=DirectionEnum.BUY, ticker="MEMECOIN", qty=2, price=10)))
+    await asyncio.sleep(0.1)
+    assert not limit.done()
+    assert ask.filled == 1
+
+    release.set()
+    await cycle
+    buy = await limit
+    assert (ask.filled, ask.status) == (3, StatusEnum.EXECUTED)
+    test_session.expunge_all()
+    buy_order = await OrderDAO.find_one_or_none(test_session, IdRequest(id=buy.order_id))
+    assert (buy_order.filled, buy_order.status) == (2, StatusEnum.EXECUTED)
+
+
+@pytest.mark.asyncio
+async def test_startup_from_snapshot_reconciles_changes(test_session, filled_test_db, test_orders, test_users, tmp_path):
+    path = str(tmp_path / "books.snapshot")
+    # Книга ушла вперед БД: сведено в памяти, но не проведено
+    matching_engine.books["GOOG"].sync_order(test_orders[2]["id"].int, 5, StatusEnum.PARTIALLY_EXECUTED)
+    await write_snapshot(matching_engine, path)
+
+    # После снапшота: один ордер исполнен частично, владелец другого удален каскадом (без updated_at), один новый
+    async with test_session.begin():
+        await test_session.execute(
+            update(Order).where(Order.id == test_orders[0]["id"]).values(filled=40, status=StatusEnum.PARTIALLY_EXECUTED))
+        await test_session.execute(delete(Order).where(Order.user_id == test_users[1]["id"]))
+        await test_session.execute(delete(User).where(User.id == test_users[1]["id"]))
+        new_order = Order(
+            user_id=test_users[0]["id"], ticker="AAPL", direction=DirectionEnum.SELL,
+            qty=5, price=20, order_type=OrderEnum.LIMIT)
+        test_session.add(new_order)
+
+    engine = MatchingEngine(snapshot_path=path, snapshot_margin=0)
+    async with test_session.begin():
+        await engine.startup(test_session)
+
+    reference = MatchingEngine()
+    async with test_session.begin():
+        await reference.startup(test_session)
+
+    for ticker in ("AAPL", "GOOG", "RUB"):
+        assert dump_book(engine.books[ticker]) == dump_book(reference.books[ticker])
+    assert [order.id for order in engine.books["AAPL"].get_asks()] == [new_order.id]
+    assert [(order.id, order.filled) for order in engine.books["AAPL"].get_bids()] == [(test_orders[0]["id"], 40)]
+    assert [order.filled for order in engine.books["GOOG"].get_asks()] == [0]
+
+
+@pytest.mark.asyncio
+async def test_reconcile_keeps_queue_position(test_session, filled_test_db, test_orders, tmp_path):
+    path = str(tmp_path / "books.snapshot")
+    # Второй ордер на той же цене встает за первым
+    async with test_session.begin():
+        second = Order(
+            user_id=test_orders[0]["user_id"], ticker="AAPL", direction=DirectionEnum.BUY,
+            qty=10, price=15, order_type=OrderEnum.LIMIT)
+        test_session.add(second)
+    matching_engine.add_limit_order(second)
+    await write_snapshot(matching_engine, path)
+
+    # Первый после снапшота исполнился частично: его updated_at позже второго, но место в очереди то же
+    async with test_session.begin():
+        await test_session.execute(
+            update(Order).where(Order.id == test_orders[0]["id"]).values(filled=40, status=StatusEnum.PARTIALLY_EXECUTED))
+
+    engine = MatchingEngine(snapshot_path=path, snapshot_margin=0, book_class=PriceLevelOrderBook)
+    async with test_session.begin():
+        await engine.startup(test_session)
+    bids = engine.books["AAPL"].get_bids()
+    assert [(order.id, order.filled) for order in bids[:2]] == [(test_orders[0]["id"], 40), (second.id, 0)]
+    assert engine.books["AAPL"].get_depth(DirectionEnum.BUY, 1) == [(15, 70)]
+
+
+@pytest.mark.asyncio
+async def test_startup_replays_journal(test_session, filled_test_db, test_orders, tmp_path):
+    path = str(tmp_path / "engine.journal")
+    engine = MatchingEngine(journal=Journal(path))
+    async with test_session.begin():
+        await engine.startup(test_session)
+    # Отмена дошла до книги и журнала, но не до БД (падение до commit)
+    async with test_session.begin():
+        order = await OrderDAO.find_one_by_primary_key(test_session, IdRequest(id=test_orders[0]["id"]))
+    assert engine.cancel_order(order)
+    engine.journal.close()
+
+    restarted = MatchingEngine(journal=Journal(path))
+    async with test_session.begin():
+        await restarted.startup(test_session)
+    # Сверка с БД возвращает ордер, который в БД остался открытым
+    for ticker in ("AAPL", "GOOG", "RUB"):
+        assert set(restarted.books[ticker].orders) == set(engine.books[ticker].orders) | (
+            {test_orders[0]["id"].int} if ticker == "AAPL" else set())
+    assert restarted.journal.seq > engine.journal.seq
+    restarted.journal.close()
+
+
+@pytest.mark.asyncio
+async def test_startup_replays_journal_after_snapshot(test_session, filled_test_db, test_orders, tmp_path):
+    journal_path, snapshot_path = str(tmp_path / "engine.journal"), str(tmp_path / "books.snapshot")
+    engine = MatchingEngine(journal=Journal(journal_path), snapshot_path=snapshot_path)
+    async with test_session.begin():
+        await engine.startup(test_session)
+    await write_snapshot(engine, snapshot_path)
+    async with test_session.begin():
+        order = await OrderDAO.find_one_by_primary_key(test_session, IdRequest(id=test_orders[0]["id"]))
+    assert engine.cancel_order(order)
+    engine.journal.close()
+
+    # В журнале осталась только отмена после снапшота, старт проигрывает ее поверх снапшота
+    journal_seq = engine.journal.seq
+    restarted = MatchingEngine(journal=Journal(journal_path), snapshot_path=snapshot_path, snapshot_margin=0)
+    _, snapshot = restarted._read_journal(*restarted._read_snapshot())
+    assert restarted.journal.seq == journal_seq
+    assert test_orders[0]["id"].int not in {order.id_int for order in snapshot["AAPL"]}
+    restarted.journal.close()
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("netting", [False, True])
+async def test_settlement_balances(test_session, default_init_db, monkeypatch, netting):
+    monkeypatch.setattr(trade_executor, "netting", netting)
+    seller1 = await register_user(NewUserRequest(name="Seller"), test_session)
+    seller2 = await register_user(NewUserRequest(name="Seller"), test_session)
+    buyer = await register_user(NewUserRequest(name="Buyer"), test_session)
+    await add_instrument(test_session, InstrumentRequest(name="MEMECOIN", ticker="MEMECOIN"))
+    await update_balance(test_session, DepositRequest(user_id=seller1.id, ticker="MEMECOIN", amount=5))
+    await update_balance(test_session, DepositRequest(user_id=seller2.id, ticker="MEMECOIN", amount=5))
+    await update_balance(test_session, DepositRequest(user_id=buyer.id, ticker="RUB", amount=2000))
+
+    await create_limit_order(test_session, seller1.id, LimitOrderRequest(direction=DirectionEnum.SELL, ticker="MEMECOIN", qty=3, price=100))
+    await create_limit_order(test_session, seller2.id, LimitOrderRequest(direction=DirectionEnum.SELL, ticker="MEMECOIN", qty=4, price=110))
+    buy = await create_limit_order(test_session, buyer.id, LimitOrderRequest(direction=DirectionEnum.BUY, ticker="MEMECOIN", qty=6, price=120))
+    statements = []
+    def count_statement(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+    event.listen(test_session.bind.sync_engine, "before_cursor_execute", count_statement)
+    try:
+        async with test_session.begin():
+            await matching_engine.match_all(test_session)
+    finally:
+        event.remove(test_session.bind.sync_engine, "before_cursor_execute", count_statement)
+    # Обе сделки записаны одним INSERT, три ордера (заявка buyer задета дважды) - одним UPDATE
+    assert len([s for s in statements if s.startswith("INSERT INTO transactions")]) == 1
+    assert len([s for s in statements if s.startswith("UPDATE orders")]) == 1
+    # Все строки балансов пачки залочены одним запросом
+    assert len([s for s in statements if s.startswith("SELECT balances")]) == 1
+    buy_order = await OrderDAO.find_one_or_none(test_session, IdRequest(id=buy.order_id))
+    assert (buy_order.filled, buy_order.status) == (6, StatusEnum.EXECUTED)
+    trades = await TransactionDAO.find_all(test_session, TransactionRequest(ticker="MEMECOIN"))
+    assert sorted((t.amount, t.price) for t in trades) == [(3, 100), (3, 110)]
+
+    async def balance(user_id, ticker):
+        row = await BalanceDAO.find_one_or_none(test_session, BalanceRequest(user_id=user_id, ticker=ticker))
+        return row.amount, row.blocked_amount
+
+    # Покупка 3 по 100 и 3 по 110 по заявке 120: сдача 60 + 30
+    assert await balance(buyer.id, "RUB") == (2000 - 720 + 90, 0)
+    assert await balance(buyer.id, "MEMECOIN") == (6, 0)
+    assert await balance(seller1.id, "RUB") == (300, 0)
+    assert await balance(seller1.id, "MEMECOIN") == (2, 0)
+    assert await balance(seller2.id, "RUB") == (330, 0)
+    assert await balance(seller2.id, "MEMECOIN") == (1, 1)
+
+
+@pytest.mark.asyncio
+async def test_balance_ledger(test_session, test_db_engine, default_init_db, monkeypatch):
+    ledger = BalanceLedger()
+    monkeypatch.setattr(trade_executor, "ledger", ledger)
+    async with test_session.begin():
+        await ledger.load(test_session)
+    seller = await register_user(NewUserRequest(name="Seller"), test_session)
+    buyer = await register_user(NewUserRequest(name="Buyer"), test_session)
+    await add_instrument(test_session, InstrumentRequest(name="MEMECOIN", ticker="MEMECOIN"))
+    await update_balance(test_session, DepositRequest(user_id=seller.id, ticker="MEMECOIN", amount=5))
+    await update_balance(test_session, DepositRequest(user_id=buyer.id, ticker="RUB", amount=1000))
+
+    await create_limit_order(test_session, seller.id, LimitOrderRequest(direction=DirectionEnum.SELL, ticker="MEMECOIN", qty=3, price=100))
+    with pytest.raises(HTTPException):
+        await create_limit_order(test_session, buyer.id, LimitOrderRequest(direction=DirectionEnum.BUY, ticker="MEMECOIN", qty=20, price=100))
+    buy = await create_limit_order(test_session, buyer.id, LimitOrderRequest(direction=DirectionEnum.BUY, ticker="MEMECOIN", qty=2, price=120))
+    assert ledger.get(buyer.id, "RUB") == (760, 240)
+
+    # Резерв, сделанный в откатившейся транзакции, снимается вместе с ней
+    with pytest.raises(RuntimeError):
+        async with test_session.begin():
+            assert ledger.block(test_session, buyer.id, "RUB", 700)
+            raise RuntimeError("rollback")
+    assert ledger.get(buyer.id, "RUB") == (760, 240)
+
+    async with test_session.begin():
+        await matching_engine.match_all(test_session)
+    assert ledger.get(buyer.id, "RUB") == (800, 0)
+    assert ledger.get(buyer.id, "MEMECOIN") == (2, 0)
+    assert ledger.get(seller.id, "RUB") == (200, 0)
+    assert ledger.get(seller.id, "MEMECOIN") == (2, 1)
+    assert (await get_balances(test_session, buyer.id)).root == {"RUB": 800, "MEMECOIN": 2}
+    async with test_session.begin():
+        order = await OrderDAO.find_one_or_none(test_session, IdRequest(id=buy.order_id))
+        assert (order.filled, order.status) == (2, StatusEnum.EXECUTED)
+        # Балансы в БД еще не тронуты
+        rub = await BalanceDAO.find_one_or_none(test_session, BalanceRequest(user_id=buyer.id, ticker="RUB"))
+        assert (rub.amount, rub.blocked_amount) == (0, 0)
+
+    # Write-behind: все измененные строки одним проходом
+    assert await ledger.flush(async_sessionmaker(test_db_engine)) == 4
+    assert not ledger.dirty
+    test_session.expunge_all()
+    async with test_session.begin():
+        assert await BalanceDAO.get_user_balances(test_session, buyer.id) == {"RUB": 800, "MEMECOIN": 2}
+        assert await BalanceDAO.get_user_balances(test_session, seller.id) == {"RUB": 200, "MEMECOIN": 3}
+
+    await delete_user(test_session, seller.id)
+    assert ledger.user_balances(seller.id) == {}
+
+@pytest.mark.asyncio
+async def test_settlement_retries_deadlock(test_session, monkeypatch):
+    class DeadlockDetected(Exception):
+        pgcode = "40P01"
+
+    calls = []
+
+    async def flaky_execute_trade(session, executions, reserve=None):
+        calls.append(len(executions))
+        if len(calls) == 1:
+            raise DBAPIError("UPDATE balances", {}, DeadlockDetected())
+        if len(calls) == 3:
+            raise DBAPIError("UPDATE balances", {}, ValueError("not a deadlock"))
+        return []
+
+    monkeypatch.setattr(trade_executor, "_execute_trade", flaky_execute_trade)
+    monkeypatch.setattr(trade_executor, "retry_delay", 0)
+    before = trade_executor.stats()
+    await trade_executor.execute_trade(test_session, [])
+    assert calls == [0, 0]
+    # Остальные ошибки БД не повторяются
+    with pytest.raises(DBAPIError):
+        await trade_executor.execute_trade(test_session, [])
+    assert calls == [0, 0, 0]
+    stats = trade_executor.stats()
+    assert stats["deadlocks"] - before["deadlocks"] == 1
+    assert stats["deadlock_retries"] - before["deadlock_retries"] == 1
+    assert stats["deadlock_retry_failures"] == before["deadlock_retry_failures"]
+
+@pytest.mark.asyncio
+async def test_market_order_with_group_commit(test_session, test_db_engine, default_init_db, monkeypatch):
+    batcher = SettlementBatcher(max_delay=0.001)
+    batcher.start(async_sessionmaker(test_db_engine, expire_on_commit=False))
+    monkeypatch.setattr(matching_engine, "settlement", batcher)
+    try:
+        user1 = await register_user(NewUserRequest(name="Pedro"), test_session)
+        user2 = await register_user(NewUserRequest(name="Antonio"), test_session)
+        await add_instrument(test_session, InstrumentRequest(name="MEMECOIN", ticker="MEMECOIN"))
+        await update_balance(test_session, DepositRequest(user_id=user1.id, ticker="MEMECOIN", amount=3))
+        await update_balance(test_session, DepositRequest(user_id=user2.id, ticker="RUB", amount=200))
+
+        await create_limit_order(test_session, user1.id, LimitOrderRequest(direction=DirectionEnum.SELL, ticker="MEMECOIN", qty=3, price=100))
+        market = await create_market_order(test_session, user2.id, MarketOrderRequest(direction=DirectionEnum.BUY, ticker="MEMECOIN", qty=2))
+    finally:
+        await batcher.stop()
+
+    test_session.expunge_all()
+    order = await OrderDAO.find_one_or_none(test_session, IdRequest(id=market.order_id))
+    assert (order.filled, order.status) == (2, StatusEnum.EXECUTED)
+    rub_balance_user2 = await BalanceDAO.find_one_or_none(test_session, BalanceRequest(user_id=user2.id, ticker="RUB"))
+    token_balance_user2 = await BalanceDAO.find_one_or_none(test_session, BalanceRequest(user_id=user2.id, ticker="MEMECOIN"))
+    assert rub_balance_user2.amount == 0
+    assert token_balance_user2.amount == 2
+    assert batcher.stats()["batches"] == 1
+    assert await SettlementOutboxDAO.find_all(test_session) == []
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("failures", [1, 3])
+async def test_group_commit_market_order_survives_failed_batch(test_session, test_db_engine, default_init_db, monkeypatch, failures):
+    execute_trade = trade_executor.execute_trade
+    calls = []
+    async def failing_execute_trade(session, executions, reserve=None):
+        calls.append(len(executions))
+        if len(calls) <= failures:
+            raise RuntimeError("settlement is down")
+        await execute_trade(session, executions, reserve)
+    monkeypatch.setattr(trade_executor, "execute_trade", failing_execute_trade)
+
+    factory = async_sessionmaker(test_db_engine, expire_on_commit=False)
+    batcher = SettlementBatcher(max_delay=0.001)
+    batcher.start(factory)
+    monkeypatch.setattr(matching_engine, "settlement", batcher)
+    seller = await register_user(NewUserRequest(name="Pedro"), test_session)
+    buyer = await register_user(NewUserRequest(name="Antonio"), test_session)
+    await add_instrument(test_session, InstrumentRequest(name="MEMECOIN", ticker="MEMECOIN"))
+    await update_balance(test_session, DepositRequest(user_id=seller.id, ticker="MEMECOIN", amount=3))
+    await update_balance(test_session, DepositRequest(user_id=buyer.id, ticker="RUB", amount=500))
+    await create_limit_order(test_session, seller.id, LimitOrderRequest(direction=DirectionEnum.SELL, ticker="MEMECOIN", qty=3, price=100))
+    # Ордер и его сделки в outbox закоммичены: ответ успешный, даже если пачка не провелась
+    market = await create_market_order(test_session, buyer.id, MarketOrderRequest(direction=DirectionEnum.BUY, ticker="MEMECOIN", qty=2))
+    assert market.success
+    await batcher.stop()
+
+    test_session.expunge_all()
+    async with test_session.begin():
+        pending = await SettlementOutboxDAO.find_all(test_session)
+    if failures == 1:
+        # Пачка упала, повтор по записям outbox провел сделку сразу
+        assert pending == [] and batcher.stats()["retried"] == 1
+    else:
+        # Повтор тоже не прошел: сделка ждет в outbox следующего старта и проводится им
+        assert [row.attempts for row in pending] == [1]
+        restarted_batcher = SettlementBatcher()
+        async with test_session.begin():
+            await MatchingEngine(settlement=restarted_batcher).startup(test_session)
+        restarted_batcher.start(factory)
+        await restarted_batcher.stop()
+        assert restarted_batcher.stats()["recovered"] == 1
+
+    test_session.expunge_all()
+    async with test_session.begin():
+        assert await SettlementOutboxDAO.find_all(test_session) == []
+        order = await OrderDAO.find_one_or_none(test_session, IdRequest(id=market.order_id))
+        assert (order.filled, order.status) == (2, StatusEnum.EXECUTED)
+        rub = await BalanceDAO.find_one_or_none(test_session, BalanceRequest(user_id=buyer.id, ticker="RUB"))
+        assert (rub.amount, rub.blocked_amount) == (300, 0)
+
+
+@pytest.mark.asyncio
+async def test_group_commit_recovers_executions_after_crash(test_session, test_db_engine, default_init_db, monkeypatch):
+    crashed = SettlementBatcher()
+    # Процесс падает, пока сделки ждут в очереди: пачка так и не коммитится
+    monkeypatch.setattr(crashed, "submit", lambda executions, outbox_ids: None)
+    monkeypatch.setattr(matching_engine, "settlement", crashed)
+    seller = await register_user(NewUserRequest(name="Pedro"), test_session)
+    buyer = await register_user(NewUserRequest(name="Antonio"), test_session)
+    await add_instrument(test_session, InstrumentRequest(name="MEMECOIN", ticker="MEMECOIN"))
+    await update_balance(test_session, DepositRequest(user_id=seller.id, ticker="MEMECOIN", amount=3))
+    await update_balance(test_session, DepositRequest(user_id=buyer.id, ticker="RUB", amount=500))
+    limit = await create_limit_order(test_session, seller.id, LimitOrderRequest(direction=DirectionEnum.SELL, ticker="MEMECOIN", qty=3, price=100))
+    market = await create_market_order(test_session, buyer.id, MarketOrderRequest(direction=DirectionEnum.BUY, ticker="MEMECOIN", qty=2))
+
+    # После рестарта книга учитывает сделку из outbox, а batcher проводит ее раньше новой очереди
+    batcher = SettlementBatcher()
+    restarted = MatchingEngine(settlement=batcher)
+    async with test_session.begin():
+        await restarted.startup(test_session)
+    assert restarted.get_order("MEMECOIN", limit.order_id).filled == 2
+    batcher.start(async_sessionmaker(test_db_engine, expire_on_commit=False))
+    await batcher.stop()
+
+    test_session.expunge_all()
+    async with test_session.begin():
+        assert await SettlementOutboxDAO.find_all(test_session) == []
+        order = await OrderDAO.find_one_or_none(test_session, IdRequest(id=market.order_id))
+        assert (order.filled, order.status) == (2, StatusEnum.EXECUTED)
+        rub = await BalanceDAO.find_one_or_none(test_session, BalanceRequest(user_id=buyer.id, ticker="RUB"))
+        token = await BalanceDAO.find_one_or_none(test_session, BalanceRequest(user_id=buyer.id, ticker="MEMECOIN"))
+        assert (rub.amount, rub.blocked_amount, token.amount) == (300, 0, 2)
+    assert batcher.stats()["recovered"] == 1
+
+
+
+@pytest.mark.asyncio
+async def test_market_order_with_outbox(test_session, test_db_engine, default_init_db, monkeypatch):
+    outbox = OutboxWorkerPool()
+    outbox.session_factory = async_sessionmaker(test_db_engine, expire_on_commit=False)
+    monkeypatch.setattr(matching_engine, "outbox", outbox)
+    seller = await register_user(NewUserRequest(name="Pedro"), test_session)
+    buyer = await register_user(NewUserRequest(name="Antonio"), test_session)
+    await add_instrument(test_session, InstrumentRequest(name="MEMECOIN", ticker="MEMECOIN"))
+    await update_balance(test_session, DepositRequest(user_id=seller.id, ticker="MEMECOIN", amount=3))
+    await update_balance(test_session, DepositRequest(user_id=buyer.id, ticker="RUB", amount=500))
+
+    limit = await create_limit_order(test_session, seller.id, LimitOrderRequest(direction=DirectionEnum.SELL, ticker="MEMECOIN", qty=3, price=100))
+    market = await create_market_order(test_session, buyer.id, MarketOrderRequest(direction=DirectionEnum.BUY, ticker="MEMECOIN", qty=2))
+    assert outbox.wakeup.is_set()
+
+    # Сделка только в outbox: средства заблокированы, ордера в БД еще не тронуты
+    async with test_session.begin():
+        assert len(await SettlementOutboxDAO.find_all(test_session)) == 1
+        rub = await BalanceDAO.find_one_or_none(test_session, BalanceRequest(user_id=buyer.id, ticker="RUB"))
+        assert (rub.amount, rub.blocked_amount) == (300, 200)
+
+    # После рестарта книга учитывает непроведенную сделку, а не состояние ордера в БД
+    restarted = MatchingEngine(outbox=outbox)
+    async with test_session.begin():
+        await restarted.startup(test_session)
+    assert restarted.get_order("MEMECOIN", limit.order_id).filled == 2
+
+    assert await outbox.drain_once()
+    assert not await outbox.drain_once()
+    test_session.expunge_all()
+    async with test_session.begin():
+        assert await SettlementOutboxDAO.find_all(test_session) == []
+        order = await OrderDAO.find_one_or_none(test_session, IdRequest(id=market.order_id))
+        assert (order.filled, order.status) == (2, StatusEnum.EXECUTED)
+        order = await OrderDAO.find_one_or_none(test_session, IdRequest(id=limit.order_id))
+        assert (order.filled, order.status) == (2, StatusEnum.PARTIALLY_EXECUTED)
+        rub = await BalanceDAO.find_one_or_none(test_session, BalanceRequest(user_id=buyer.id, ticker="RUB"))
+        token = await BalanceDAO.find_one_or_none(test_session, BalanceRequest(user_id=buyer.id, ticker="MEMECOIN"))
+        assert (rub.amount, rub.blocked_amount, token.amount) == (300, 0, 2)
+    assert outbox.stats()["executions"] == 1
+
+
+@pytest.mark.asyncio
+async def test_outbox_workers_keep_per_user_order(test_session, test_db_engine, monkeypatch):
+    u1, u2, u3, u4, u5, u6, u7, u8 = (uuid4() for _ in range(8))
+
+    def execution(buyer_id, seller_id, qty=1):
+        return TradeExecution(
+            InternalOrder(buyer_id, DirectionEnum.BUY, "AAPL", qty, OrderEnum.LIMIT, 10, filled=qty, status=StatusEnum.EXECUTED),
+            InternalOrder(seller_id, DirectionEnum.SELL, "AAPL", qty, OrderEnum.LIMIT, 10, filled=qty, status=StatusEnum.EXECUTED),
+            qty, 10)
+
+    async with test_session.begin():
+        await SettlementOutboxDAO.add_executions(test_session, [
+            execution(u1, u2), # Занята другим воркером
+            execution(u3, u4),
+            execution(u3, u1), # Ждет первую из-за u1
+            execution(u5, u6, qty=13), # Падает
+            execution(u6, u7), # Ждет упавшую из-за u6
+            execution(u7, u8), # Ждет предыдущую из-за u7
+            execution(u8, u5), # Ждет упавшую из-за u5
+        ])
+        ids = [row.id for row in await SettlementOutboxDAO.find_all(test_session)]
+
+    settled = []
+
+    async def fake_execute_trade(session, executions):
+        if any(execution.executed_qty == 13 for execution in executions):
+            raise ValueError("bad execution")
+        settled.append([(execution.bid_order.user_id, execution.ask_order.user_id) for execution in executions])
+
+    claim = SettlementOutboxDAO.claim
+
+    async def claim_except_first(session, claim_ids):
+        return await claim(session, [id for id in claim_ids if id != ids[0]])
+
+    monkeypatch.setattr("services.settlement.trade_executor.execute_trade", fake_execute_trade)
+    monkeypatch.setattr(SettlementOutboxDAO, "claim", claim_except_first)
+    outbox = OutboxWorkerPool(max_attempts=1)
+    outbox.session_factory = async_sessionmaker(test_db_engine, expire_on_commit=False)
+
+    assert await outbox.drain_once()
+    # Пачка упала целиком, по одной прошла только независимая сделка
+    assert settled == [[(u3, u4)]]
+    test_session.expunge_all()
+    async with test_session.begin():
+        rows = {row.id: row for row in await SettlementOutboxDAO.find_all(test_session)}
+    assert sorted(rows) == ids[:1] + ids[2:]
+    assert rows[ids[3]].attempts == 1 and rows[ids[3]].last_error == "bad execution"
+    # Упавшая запись отложена и держит своих пользователей, первая все еще занята
+    assert not await outbox.drain_once()
+    assert outbox.stats()["failures"] == 1
+
+
+@pytest.mark.asyncio
+async def test_transactions_from_tape(test_session, default_init_db):
+    seller = await register_user(NewUserRequest(name="Seller"), test_session)
+    buyer = await register_user(NewUserRequest(name="Buyer"), test_session)
+    await add_instrument(test_session, InstrumentRequest(name="MEMECOIN", ticker="MEMECOIN"))
+    await update_balance(test_session, DepositRequest(user_id=seller.id, ticker="MEMECOIN", amount=10))
+    await update_balance(test_session, DepositRequest(user_id=buyer.id, ticker="RUB", amount=1000))
+    await create_limit_order(test_session, seller.id, LimitOrderRequest(direction=DirectionEnum.SELL, ticker="MEMECOIN", qty=10, price=100))
+    await create_market_order(test_session, buyer.id, MarketOrderRequest(direction=DirectionEnum.BUY, ticker="MEMECOIN", qty=1))
+    ticker = TransactionRequest(ticker="MEMECOIN")
+
+    statements = []
+    def count_statement(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+    event.listen(test_session.bind.sync_engine, "before_cursor_execute", count_statement)
+    try:
+        # Последняя страница и опрос с since - из ленты, без БД
+        page = await get_transactions_page(test_session, ticker, limit=1)
+        assert [t.amount for t in page.transactions] == [1]
+        seq = page.seq
+        page = await get_transactions_page(test_session, ticker, since=seq)
+        assert (page.transactions, page.seq, page.reset) == ([], seq, False)
+    finally:
+        event.remove(test_session.bind.sync_engine, "before_cursor_execute", count_statement)
+    assert not statements
+
+    await create_market_order(test_session, buyer.id, MarketOrderRequest(direction=DirectionEnum.BUY, ticker="MEMECOIN", qty=2))
+    await create_market_order(test_session, buyer.id, MarketOrderRequest(direction=DirectionEnum.BUY, ticker="MEMECOIN", qty=3))
+    page = await get_transactions_page(test_session, ticker, limit=1, since=seq)
+    assert [t.amount for t in page.transactions] == [2]
+    page = await get_transactions_page(test_session, ticker, since=page.seq)
+    assert [t.amount for t in page.transactions] == [3]
+
+    # Номер старше ленты (до старта движка) и страница больше ленты - из БД
+    async with test_session.begin():
+        page = await get_transactions_page(test_session, ticker, since=0)
+    assert page.reset
+    assert [t.amount for t in page.transactions] == [3, 2, 1]
+    async with test_session.begin():
+        await test_session.execute(delete(Transaction).where(Transaction.amount == 1))
+    async with test_session.begin():
+        page = await get_transactions_page(test_session, ticker, limit=5)
+    assert [t.amount for t in page.transactions] == [3, 2]
+    with pytest.raises(HTTPException):
+        await get_transactions_page(test_session, ticker, since=seq, before=page.before)
+
+
+@pytest.mark.asyncio
+async def test_candles(test_session, default_init_db):
+    seller = await register_user(NewUserRequest(name="Seller"), test_session)
+    buyer = await register_user(NewUserRequest(name="Buyer"), test_session)
+    await add_instrument(test_session, InstrumentRequest(name="MEMECOIN", ticker="MEMECOIN"))
+    await update_balance(test_session, DepositRequest(user_id=seller.id, ticker="MEMECOIN", amount=10))
+    await update_balance(test_session, DepositRequest(user_id=buyer.id, ticker="RUB", amount=10000))
+    for price in (100, 90, 120):
+        await create_limit_order(test_session, seller.id, LimitOrderRequest(direction=DirectionEnum.SELL, ticker="MEMECOIN", qty=2, price=price))
+    # Три транзакции: 2 по 90, 2 по 100, затем 1 по 120 - свеча вливает каждую в сохраненную
+    await create_market_order(test_session, buyer.id, MarketOrderRequest(direction=DirectionEnum.BUY, ticker="MEMECOIN", qty=2))
+    await create_market_order(test_session, buyer.id, MarketOrderRequest(direction=DirectionEnum.BUY, ticker="MEMECOIN", qty=2))
+    await create_market_order(test_session, buyer.id, MarketOrderRequest(direction=DirectionEnum.BUY, ticker="MEMECOIN", qty=1))
+
+    async with test_session.begin():
+        candles = await get_candles(test_session, CandleRequest(ticker="MEMECOIN", resolution=ResolutionEnum.D1))
+        minutes = await get_candles(test_session, CandleRequest(ticker="MEMECOIN", resolution=ResolutionEnum.M1))
+    assert len(candles) == 1
+    assert (candles[0].open, candles[0].high, candles[0].low, candles[0].close, candles[0].volume) == (90, 120, 90, 120, 5)
+    assert candles[0].start.hour == candles[0].start.minute == 0
+    assert sum(candle.volume for candle in minutes) == 5
+
+    # Диапазон [start, end) по времени начала свечи
+    day = candles[0].start.replace(tzinfo=None)
+    async with test_session.begin():
+        assert await get_candles(test_session, CandleRequest(ticker="MEMECOIN", resolution=ResolutionEnum.D1, start=day, end=day)) == []
+        assert len(await get_candles(test_session, CandleRequest(ticker="MEMECOIN", resolution=ResolutionEnum.D1, start=day))) == 1
+
+
+@pytest.mark.asyncio
+async def test_candles_follow_execution_order(test_session, default_init_db):
+    seller = await register_user(NewUserRequest(name="Seller"), test_session)
+    buyer = await register_user(NewUserRequest(name="Buyer"), test_session)
+    await add_instrument(test_session, InstrumentRequest(name="MEMECOIN", ticker="MEMECOIN"))
+    await update_balance(test_session, DepositRequest(user_id=seller.id, ticker="MEMECOIN", amount=10))
+    await update_balance(test_session, DepositRequest(user_id=buyer.id, ticker="RUB", amount=10000))
+    for price in (120, 90, 100):
+        await create_limit_order(test_session, seller.id, LimitOrderRequest(direction=DirectionEnum.SELL, ticker="MEMECOIN", qty=1, price=price))
+    # Одна пачка из трех сделок: время строго растет в порядке исполнения 90, 100, 120
+    await create_market_order(test_session, buyer.id, MarketOrderRequest(direction=DirectionEnum.BUY, ticker="MEMECOIN", qty=3))
+
+    async with test_session.begin():
+        trades = await get_transactions_history(test_session, TransactionRequest(ticker="MEMECOIN", limit=10))
+        candle, = await get_candles(test_session, CandleRequest(ticker="MEMECOIN", resolution=ResolutionEnum.D1))
+    assert [trade.price for trade in trades] == [120, 100, 90]
+    assert len({trade.timestamp for trade in trades}) == 3
+    assert (candle.open, candle.close) == (90, 120)
+
+    # Пачка с более ранними сделками закоммитилась позже: open сдвигается, close остается
+    first = min(trade.timestamp for trade in trades).replace(tzinfo=timezone.utc)
+    late = [
+        {"id": uuid4(), "ticker": "MEMECOIN", "price": price, "amount": 1, "timestamp": first - timedelta(microseconds=10 - i)}
+        for i, price in enumerate((80, 95))]
+    async with test_session.begin():
+        await CandleDAO.merge_many(test_session, aggregate(late))
+    async with test_session.begin():
+        candle, = await get_candles(test_session, CandleRequest(ticker="MEMECOIN", resolution=ResolutionEnum.D1))
+    assert (candle.open, candle.high, candle.low, candle.close, candle.volume) == (80, 120, 80, 120, 5)
+
+
+@pytest.mark.asyncio
+async def test_balance_cache(test_session, default_init_db, monkeypatch):
+    cache = BalanceCache()
+    monkeypatch.setattr(trade_executor, "balance_cache", cache)
+    seller = await register_user(NewUserRequest(name="Seller"), test_session)
+    buyer = await register_user(NewUserRequest(name="Buyer"), test_session)
+    await add_instrument(test_session, InstrumentRequest(name="MEMECOIN", ticker="MEMECOIN"))
+    await update_balance(test_session, DepositRequest(user_id=seller.id, ticker="MEMECOIN", amount=5))
+    await update_balance(test_session, DepositRequest(user_id=buyer.id, ticker="RUB", amount=1000))
+
+    async with test_session.begin():
+        assert (await get_balances(test_session, buyer.id)).root == {"RUB": 1000}
+        assert (await get_balances(test_session, buyer.id)).root == {"RUB": 1000}
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    # Свои изменения видны сразу после commit: пополнение и сделка сбрасывают запись
+    await update_balance(test_session, DepositRequest(user_id=buyer.id, ticker="RUB", amount=500))
+    async with test_session.begin():
+        assert (await get_balances(test_session, buyer.id)).root == {"RUB": 1500}
+        assert (await get_balances(test_session, seller.id)).root == {"MEMECOIN": 5, "RUB": 0}
+    await create_limit_order(test_session, seller.id, LimitOrderRequest(direction=DirectionEnum.SELL, ticker="MEMECOIN", qty=2, price=100))
+    # Резерв под ордер сумму не меняет, запись остается
+    assert seller.id in cache.entries
+    async with test_session.begin():
+        assert (await get_balances(test_session, seller.id)).root == {"MEMECOIN": 5, "RUB": 0}
+    await create_market_order(test_session, buyer.id, MarketOrderRequest(direction=DirectionEnum.BUY, ticker="MEMECOIN", qty=2))
+    async with test_session.begin():
+        assert (await get_balances(test_session, buyer.id)).root == {"RUB": 1300, "MEMECOIN": 2}
+        assert (await get_balances(test_session, seller.id)).root == {"RUB": 200, "MEMECOIN": 3}
+
+    # Чтение, которое пересеклось со сбросом, в кэш не попадает
+    read = BalanceDAO.get_user_balances
+    async def racing_read(session, user_id):
+        balances = await read(session, user_id)
+        cache._invalidate({user_id})
+        return balances
+    cache._clear()
+    monkeypatch.setattr(BalanceDAO, "get_user_balances", racing_read)
+    async with test_session.begin():
+        await get_balances(test_session, buyer.id)
+    assert buyer.id not in cache.entries
+
+
+@pytest.mark.asyncio
+async def test_transaction_actions_wait_for_root(test_session, default_init_db, monkeypatch):
+    ledger, tape, cache = BalanceLedger(), TradeTape(), BalanceCache()
+    monkeypatch.setattr(trade_executor, "ledger", ledger)
+    monkeypatch.setattr(trade_executor, "tape", tape)
+    monkeypatch.setattr(trade_executor, "balance_cache", cache)
+    async with test_session.begin():
+        await ledger.load(test_session)
+    seller = await register_user(NewUserRequest(name="Seller"), test_session)
+    buyer = await register_user(NewUserRequest(name="Buyer"), test_session)
+    await add_instrument(test_session, InstrumentRequest(name="MEMECOIN", ticker="MEMECOIN"))
+    await update_balance(test_session, DepositRequest(user_id=seller.id, ticker="MEMECOIN", amount=5))
+    await update_balance(test_session, DepositRequest(user_id=buyer.id, ticker="RUB", amount=1000))
+    await create_limit_order(test_session, seller.id, LimitOrderRequest(direction=DirectionEnum.SELL, ticker="MEMECOIN", qty=3, price=100))
+    await create_limit_order(test_session, buyer.id, LimitOrderRequest(direction=DirectionEnum.BUY, ticker="MEMECOIN", qty=2, price=120))
+    cache.entries[buyer.id] = ({"RUB": 1000}, float("inf"))
+
+    # Проведение прошло под своим savepoint-ом, но внешняя транзакция откатилась: в памяти ничего не осталось
+    with pytest.raises(RuntimeError):
+        async with test_session.begin():
+            await matching_engine.match_all(test_session)
+            assert ledger.get(buyer.id, "MEMECOIN") == (2, 0)
+            assert tape.latest("MEMECOIN", 1) is None
+            assert buyer.id in cache.entries
+            raise RuntimeError("rollback")
+    assert ledger.get(buyer.id, "RUB") == (760, 240)
+    assert ledger.get(buyer.id, "MEMECOIN") == (0, 0)
+    assert ledger.get(seller.id, "MEMECOIN") == (2, 3)
+    assert tape.latest("MEMECOIN", 1) is None
+    assert buyer.id in cache.entries
+
+    # Откат savepoint-а снимает только сделанное внутри него, commit корневой выполняет отложенное
+    committed = []
+    async with test_session.begin():
+        ledger.block(test_session, buyer.id, "RUB", 100)
+        with pytest.raises(RuntimeError):
+            async with test_session.begin_nested():
+                ledger.block(test_session, buyer.id, "RUB", 50)
+                raise RuntimeError("rollback savepoint")
+        assert ledger.get(buyer.id, "RUB") == (660, 340)
+        async with test_session.begin_nested():
+            on_commit(test_session, lambda: committed.append(True))
+        assert not committed
+    assert committed == [True]
+    assert ledger.get(buyer.id, "RUB") == (660, 340)
+
+
+@pytest.mark.asyncio
+async def test_market_order_reserves_funds_before_matching(test_session, default_init_db, monkeypatch):
+    ledger = BalanceLedger()
+    monkeypatch.setattr(trade_executor, "ledger", ledger)
+    async with test_session.begin():
+        await ledger.load(test_session)
+    seller = await register_user(NewUserRequest(name="Seller"), test_session)
+    buyer = await register_user(NewUserRequest(name="Buyer"), test_session)
+    await add_instrument(test_session, InstrumentRequest(name="MEMECOIN", ticker="MEMECOIN"))
+    await update_balance(test_session, DepositRequest(user_id=seller.id, ticker="MEMECOIN", amount=5))
+    await update_balance(test_session, DepositRequest(user_id=buyer.id, ticker="RUB", amount=300))
+    await create_limit_order(test_session, seller.id, LimitOrderRequest(direction=DirectionEnum.SELL, ticker="MEMECOIN", qty=5, price=100))
+
+    # Пока ордер пишется в БД, параллельный запрос того же пользователя пытается потратить те же рубли
+    add = OrderDAO.add
+    competing = []
+    async def add_with_competitor(session, values):
+        competing.append(ledger.block(session, buyer.id, "RUB", 300))
+        return await add(session, values)
+    monkeypatch.setattr(OrderDAO, "add", add_with_competitor)
+    market = await create_market_order(test_session, buyer.id, MarketOrderRequest(direction=DirectionEnum.BUY, ticker="MEMECOIN", qty=2))
+    assert competing == [False]
+    assert ledger.get(buyer.id, "RUB") == (100, 0)
+    assert ledger.get(buyer.id, "MEMECOIN") == (2, 0)
+    async with test_session.begin():
+        order = await OrderDAO.find_one_or_none(test_session, IdRequest(id=market.order_id))
+        assert order.status == StatusEnum.EXECUTED